@@ -8,14 +8,25 @@ from wx.core import ButtonNameStr, DD_DEFAULT_STYLE, EVT_LIST_DELETE_ALL_ITEMS,
 
 from klepr.kleprtools import pcb
 from klepr.kleprtools import key
+from klepr.kleprtools import cache
+from klepr.kleprtools import config
+from klepr.kleprtools import trace
+from klepr.kleprtools import spatial
 
+import os
 import json
+import time
 import random
 import math
+import threading
+import traceback
 
 APP_WIDTH = 640
 APP_HEIGHT = 600
 
+# Journal checkpoint of the board before a live preview
+PREVIEW_CHECKPOINT = "preview"
+
 layout = []
 layoutFile = ""
 layoutText = ""
@@ -26,10 +37,21 @@ class EditDialog(wx.Dialog):
   def __init__(self, *args, **kwargs):
     super(EditDialog, self).__init__(*args, **kwargs)
     
-    self.SetSize((240,240))
+    self.SetSize((240,270))
     self.Center()
     self.SetTitle("Change Prefix Entry")
 
+    # Called with a key.Prefix to preview it on the board, when available
+    self.preview = None
+    self.previewCall = None
+    self.saved = False
+    # Set once the dialog is closing; a countdown still due then is dropped
+    self.closed = False
+
+    # Escape and the title bar close the dialog without the buttons
+    self.Bind(wx.EVT_CLOSE, self.OnClose)
+    self.Bind(wx.EVT_WINDOW_DESTROY, self.OnDestroy)
+
   def LoadEntryValues(self, entry):
     """ Loads the values of current entry into dialog """
     self.entry = entry
@@ -84,6 +106,17 @@ class EditDialog(wx.Dialog):
     hbox4.Add(self.aTxtCtrl, proportion=1, flag=wx.LEFT | wx.EXPAND, border=5)
     vbox.Add(hbox4, flag=wx.ALL | wx.EXPAND, border=5)
 
+    ########## Preview the edited values on the board while typing
+
+    self.previewBox = wx.CheckBox(self, label="Live preview on board")
+    self.previewBox.SetFont(font)
+    if self.preview is None:
+      self.previewBox.Disable()
+    self.previewBox.Bind(wx.EVT_CHECKBOX, self.OnFieldChanged)
+    for ctrl in (self.xTxtCtrl, self.yTxtCtrl, self.aTxtCtrl):
+      ctrl.Bind(wx.EVT_TEXT, self.OnFieldChanged)
+    vbox.Add(self.previewBox, flag=wx.ALL | wx.EXPAND, border=5)
+
     ########## Add the bottom buttons
 
     hbox = wx.BoxSizer(wx.HORIZONTAL)
@@ -110,9 +143,73 @@ class EditDialog(wx.Dialog):
     self.yTxtCtrl.Remove(0,self.yTxtCtrl.GetLineLength(0))
     self.aTxtCtrl.Remove(0,self.aTxtCtrl.GetLineLength(0))    
 
+  def OnFieldChanged(self, event):
+    """ Restart the preview countdown after every keystroke """
+    event.Skip()
+
+    if self.preview is None or not self.previewBox.GetValue():
+      return
+
+    if self.previewCall is not None:
+      self.previewCall.Stop()
+    self.previewCall = wx.CallLater(config.PREVIEW_DEBOUNCE_MS, self.PreviewValues)
+
+  def StopPreview(self):
+    """ Drop a preview that is still waiting for the countdown """
+    if self.previewCall is not None:
+      self.previewCall.Stop()
+      self.previewCall = None
+
+  def ClosePreview(self):
+    """ Drop a waiting preview and keep any later countdown from running """
+    self.closed = True
+    self.StopPreview()
+
+  def EndModal(self, retCode):
+    """ Escape ends the modal loop here, without going through the buttons """
+    self.ClosePreview()
+    super(EditDialog, self).EndModal(retCode)
+
+  def OnClose(self, event):
+    """ Closed from the title bar """
+    self.ClosePreview()
+    event.Skip()
+
+  def OnDestroy(self, event):
+    """ Also sent for the child controls; only the dialog itself matters """
+    if event.GetEventObject() is self:
+      self.ClosePreview()
+    event.Skip()
+
+  def PreviewValues(self):
+    """ 
+    Place the parts of the entry with the offsets typed so far. The prefix
+    being edited is always the one previewed; a new prefix only applies on
+    Save
+    """
+    self.previewCall = None
+    if self.closed:
+      return
+
+    # Half-typed numbers are previewed once they parse
+    try:
+      entry = key.Prefix(
+        obj_id=self.entry.id,
+        prefix=self.entry.prefix,
+        off_x=float(self.xTxtCtrl.GetLineText(0)),
+        off_y=float(self.yTxtCtrl.GetLineText(0)),
+        angle=float(self.aTxtCtrl.GetLineText(0)),
+      )
+    except ValueError:
+      return
+
+    self.preview(entry)
+
   def OnSave(self, event):
     """ Save entry for use outside the dialog """
 
+    self.StopPreview()
+
     # Save contents of textCtrl
     try:
       self.prefix = self.refTxtCtrl.GetLineText(0)
@@ -121,6 +218,8 @@ class EditDialog(wx.Dialog):
       self.angle = float(self.aTxtCtrl.GetLineText(0))
       
       print("Saving data...",self.prefix, self.off_x, self.off_y, self.angle)
+      self.saved = True
+      self.ClosePreview()
       self.Destroy()
 
     except ValueError as e:
@@ -137,8 +236,32 @@ class EditDialog(wx.Dialog):
   def OnCancel(self, event):
     """ Cancel text entry """
 
+    self.ClosePreview()
     self.Destroy()
 
+class PrefixList(wx.ListCtrl):
+  """ 
+  Virtual list of the prefix table. Rows are not stored in the control; the
+  visible ones are drawn on demand from a callback
+  """
+
+  def __init__(self, parent, rowText, *args, **kwargs):
+    """ 
+    Constructor
+
+    Parameters:
+
+    parent - (wx.Window)
+      The parent window
+    rowText - (function)
+      Called with (row, column), returns the text of a cell
+    """
+    super(PrefixList, self).__init__(parent, *args, **kwargs)
+    self.rowText = rowText
+
+  def OnGetItemText(self, item, column):
+    return self.rowText(item, column)
+
 class AppFunctions(wx.Panel):
   """ Implements the main functions of the GUI window """
 
@@ -147,13 +270,35 @@ class AppFunctions(wx.Panel):
     self.klepr = pcb.Klepr()
     self.prefixTable = key.PrefixTable()
     self.keyboard = key.Keyboard()
+    self.layoutCache = cache.LayoutCache()
 
     self.klepr.checkKicadFileFormatVersion()
     self.cur_index = 0
     self.cur_id = 0
+
+    # Prefix ids in the order of the list rows, and the number of parts of
+    # every prefix, counted once and kept until the board is rescanned
+    self.rowIds = []
+    self.partCounts = {}
+
     self.InputFile = ""
     self.OutputDir = ""
 
+    # State of the generation running in the background, if any
+    self.worker = None
+    self.cancelled = threading.Event()
+    self.placement = []
+    self.applied = 0
+    self.touched = 0
+    self.skipped = 0
+    self.runStart = None   # Journal offset of the placement run, if started
+    self.startTime = 0.0
+    self.tracePath = None
+
+    # Keys of the live preview in the edit dialog, and whether it moved parts
+    self.previewKeys = None
+    self.previewing = False
+
   def initPanel(self):
 
     self.vbox = wx.BoxSizer(wx.VERTICAL)
@@ -263,10 +408,11 @@ class AppFunctions(wx.Panel):
 
     hbox1 = wx.BoxSizer(wx.HORIZONTAL)
 
-    self.list = wx.ListCtrl(
+    self.list = PrefixList(
       self, 
+      self.GetRowText,
       wx.ID_ANY, 
-      style=wx.LC_REPORT | wx.LC_EDIT_LABELS | wx.LC_HRULES | wx.LC_VRULES
+      style=wx.LC_REPORT | wx.LC_VIRTUAL | wx.LC_EDIT_LABELS | wx.LC_HRULES | wx.LC_VRULES
     )
 
     self.list.InsertColumn(0, 'Prefix', width=100)
@@ -289,6 +435,7 @@ class AppFunctions(wx.Panel):
     
     self.list.Bind(wx.EVT_LIST_ITEM_SELECTED, self.UpdateCursor)
     self.list.Bind(wx.EVT_LIST_ITEM_DESELECTED, self.ResetCursor)
+    self.list.Bind(wx.EVT_LIST_END_LABEL_EDIT, self.OnLabelEdit)
 
     vbox = wx.BoxSizer(wx.VERTICAL)
     vbox.Add(new  , flag=wx.LEFT | wx.EXPAND, border=10)
@@ -307,7 +454,7 @@ class AppFunctions(wx.Panel):
     print("Updating cursor position...")
 
     self.cur_index = event.GetIndex()
-    self.cur_id = self.list.GetItemData(self.cur_index)
+    self.cur_id = self.rowIds[self.cur_index]
 
   def ResetCursor(self, event):
     """ Resets the cursor to the end of the list """
@@ -315,36 +462,80 @@ class AppFunctions(wx.Panel):
     print("Resetting cursor position...")
 
     self.cur_index = self.list.GetItemCount() - 1
-    self.cur_id = self.list.GetItemData(self.cur_index)
+    self.cur_id = self.rowIds[self.cur_index] if self.rowIds else 0
+
+  def GetRowText(self, row, column):
+    """ 
+    Returns the text of a cell of the prefix list
+
+    Parameters:
+
+    row - (int)
+      The row of the list
+    column - (int)
+      The column of the list
+    """
+    entry = self.prefixTable.table[self.rowIds[row]]
+
+    if column == 0:
+      return str(entry.prefix)
+    if column == 1:
+      return str(entry.off_x)
+    if column == 2:
+      return str(entry.off_y)
+    if column == 3:
+      return str(entry.angle)
+    return str(self.GetPartCount(entry.prefix))
+
+  def GetPartCount(self, prefix):
+    """ 
+    Returns the number of parts matching a prefix, counting them only the
+    first time the prefix is shown
+
+    Parameters:
+
+    prefix - (str)
+      The prefix, with or without the underscore
+    """
+    prefix = prefix.split('_')[0]
+    if prefix not in self.partCounts:
+      self.partCounts[prefix] = len(self.klepr.GetReferenceIndex().get(prefix, ()))
+    return self.partCounts[prefix]
+
+  def RefreshRow(self, index):
+    """ Redraw one row of the list after its entry changed, recounting its parts """
+
+    self.list.SetItemCount(len(self.rowIds))
+    if 0 <= index < len(self.rowIds):
+      entry = self.prefixTable.table[self.rowIds[index]]
+      self.partCounts.pop(entry.prefix.split('_')[0], None)
+      self.list.RefreshItem(index)
+
+  def OnLabelEdit(self, event):
+    """ Rename the prefix of a row edited in place in the list """
+
+    # The virtual list does not store labels; the row is redrawn from the table
+    event.Veto()
+
+    prefix = event.GetLabel().strip()
+    if event.IsEditCancelled() or not prefix:
+      return
+
+    index = event.GetIndex()
+    self.prefixTable.table[self.rowIds[index]].prefix = prefix
+    self.RefreshRow(index)
 
   def RefreshRows(self):
-    """ Refreshes the current list of values based on the prefix table """
+    """ Rescans the board for part counts and redraws the visible rows """
 
     print("Refreshing Table...")
 
-    # Don't bother when the list is empty
-    if (self.list.GetItemCount() <= 0) or (len(self.prefixTable.table) <= 0):
-      print("List is empty...")
-      return    
-
-    # Clear the list
-    if self.list.DeleteAllItems() != True:
-      print("Error deleting items")
-
-    # Repopulate the table
-    index = 0
-    numParts = 0
-    for item in self.prefixTable.table.values():
-      self.list.InsertItem(index, item.prefix)
-      self.list.SetItem(index, 1, str(item.off_x))
-      self.list.SetItem(index, 2, str(item.off_y))
-      self.list.SetItem(index, 3, str(item.angle))
-      self.list.SetItemData(index, item.id)
-
-      # Get the number of parts matching the prefix
-      numParts = len(self.klepr.GetPartsByPrefix(item.prefix))
-      self.list.SetItem(index, 4, str(numParts))
-      index += 1
+    # Rescan the board once for this refresh, in case it changed
+    self.klepr.InvalidateReferenceIndex()
+    self.partCounts.clear()
+
+    self.list.SetItemCount(len(self.rowIds))
+    self.list.Refresh()
 
   def OnNew(self, event):
     """ Add new prefix to be tracked """
@@ -362,13 +553,9 @@ class AppFunctions(wx.Panel):
 
     # Populate the entry with the default values
     self.prefixTable.table[newRef.id] = newRef
-    self.list.InsertItem(index, str(newRef.prefix))
-    self.list.SetItem(index, 1, str(newRef.off_x))
-    self.list.SetItem(index, 2, str(newRef.off_y))
-    self.list.SetItem(index, 3, str(newRef.angle))
-    self.list.SetItemData(index, self.cur_id)
+    self.rowIds.append(newRef.id)
 
-    self.RefreshRows()
+    self.RefreshRow(index)
 
   def OnEdit(self, event):
     """ Handler for editing entries """
@@ -379,14 +566,20 @@ class AppFunctions(wx.Panel):
       return  
 
     # Get the current instance of the chosen entry
-    entry = self.prefixTable.table[self.list.GetItemData(self.cur_index)]
+    entry = self.prefixTable.table[self.rowIds[self.cur_index]]
 
-    # Forward the entry to the editing dialog
+    # Forward the entry to the editing dialog. The live preview needs the
+    # KLE file, and is left out while a generation is running
     editBox = EditDialog(self)
     editBox.LoadEntryValues(entry)
+    if self.InputFile and self.worker is None:
+      editBox.preview = self.PreviewEntry
     editBox.InitUI()
     editBox.ShowModal()
 
+    # Keep the previewed poses on Save, put the parts back otherwise
+    self.EndPreview(keep=editBox.saved)
+
     # Process output of the dialog back into the chosen entry
     print("Received: ",editBox.prefix, editBox.off_x, editBox.off_y, editBox.angle)
 
@@ -398,7 +591,52 @@ class AppFunctions(wx.Panel):
     # Write the modified entry back to the prefix table
     self.prefixTable.table[entry.id] = entry
 
-    self.RefreshRows()
+    self.RefreshRow(self.cur_index)
+
+  def PreviewEntry(self, entry):
+    """ 
+    Re-place the parts of one prefix on the open board and redraw it, for
+    the live preview of the edit dialog. The first preview starts a run in
+    the journal, so the parts can be put back, or the edit undone later
+
+    Parameters:
+
+    entry - (key.Prefix)
+      The prefix with the offsets and angle to preview
+    """
+
+    # Read the layout once per dialog; the cache makes this cheap
+    if self.previewKeys is None:
+      self.previewKeys = self.layoutCache.loadLayout(self.InputFile)
+
+    # Later previews start over from the poses before the first one, so the
+    # parts are matched to the keys like Generate would match them
+    if self.previewing:
+      self.klepr.Rollback(PREVIEW_CHECKPOINT)
+    self.previewing = True
+    self.klepr.journal.beginRun()
+    self.klepr.Checkpoint(PREVIEW_CHECKPOINT)
+
+    touched, skipped = self.klepr.PlacePrefix(self.previewKeys, entry, self.prefixTable)
+    self.klepr.RefreshBoard()
+    print("Previewing", entry.prefix, "moved", touched, "parts")
+
+  def EndPreview(self, keep):
+    """ 
+    End the live preview, putting the previewed parts back unless kept
+
+    Parameters:
+
+    keep - (bool)
+      Keep the previewed poses on the board
+    """
+    if self.previewing and not keep:
+      touched, skipped = self.klepr.Rollback(PREVIEW_CHECKPOINT)
+      self.klepr.RefreshBoard()
+      print("Preview reverted,", touched, "parts put back")
+
+    self.previewKeys = None
+    self.previewing = False
 
   def OnDelete(self, event):
     """ Handler for deleting references """
@@ -411,11 +649,13 @@ class AppFunctions(wx.Panel):
     print("Deleting selected prefix...", self.cur_index)
 
     # Delete entry from prefix table
-    self.cur_id = self.list.GetItemData(self.cur_index)
+    self.cur_id = self.rowIds.pop(self.cur_index)
     self.prefixTable.table.pop(self.cur_id)
 
-    # Delete entry from ListCtrl
-    self.list.DeleteItem(self.cur_index)
+    # Shrink the list; the rows after the deleted one move up
+    self.list.SetItemCount(len(self.rowIds))
+    if self.cur_index < len(self.rowIds):
+      self.list.RefreshItems(self.cur_index, len(self.rowIds) - 1)
 
     # Don't bother when the list is empty afterwards
     listSize = self.list.GetItemCount()
@@ -426,7 +666,6 @@ class AppFunctions(wx.Panel):
 
     # Set the cursor to the last entry of the list, for use with consecutive deletes
     self.cur_index = self.list.GetItemCount() - 1
-    self.RefreshRows()
 
   def OnClear(self, event):
     """ Clear all references in the table """
@@ -439,8 +678,8 @@ class AppFunctions(wx.Panel):
     print("Deleting all references...")
 
     # Delete list items completely
-    if self.list.DeleteAllItems() != True:
-      print("Error deleting items")
+    self.rowIds.clear()
+    self.list.SetItemCount(0)
 
     # Delete prefix table entirely
     self.prefixTable.table.clear()
@@ -469,27 +708,246 @@ class AppFunctions(wx.Panel):
     self.vbox.Add(heading,flag=wx.ALL | wx.EXPAND, border=10)
     self.vbox.Add(hbox,flag=wx.ALL | wx.EXPAND, border=10)
 
+    self.undo = wx.Button(self, label='Undo Last Placement')
+    self.undo.Bind(wx.EVT_BUTTON, self.OnUndo, id=self.undo.GetId())
+
     hbox2 = wx.BoxSizer(wx.HORIZONTAL)
     hbox2.Add(self.generate,proportion=1,flag=wx.LEFT | wx.EXPAND, border=10)
+    hbox2.Add(self.undo,flag=wx.LEFT | wx.EXPAND, border=10)
     self.vbox.Add(hbox2,flag=wx.ALL | wx.EXPAND, border=10)
 
+    ########## Progress of the generation
+
+    hbox3 = wx.BoxSizer(wx.HORIZONTAL)
+
+    self.progress = wx.Gauge(self, range=1)
+    self.elapsedTxt = wx.StaticText(self, label="", size=(160, -1))
+    self.cancel = wx.Button(self, label='Cancel')
+    self.cancel.Disable()
+
+    self.cancel.Bind(wx.EVT_BUTTON, self.OnCancelGenerate, id=self.cancel.GetId())
+    self.timer = wx.Timer(self)
+    self.Bind(wx.EVT_TIMER, self.OnTimer, self.timer)
+
+    hbox3.Add(self.progress, proportion=1, flag=wx.LEFT | wx.EXPAND, border=10)
+    hbox3.Add(self.elapsedTxt, flag=wx.LEFT | wx.ALIGN_CENTER_VERTICAL, border=10)
+    hbox3.Add(self.cancel, flag=wx.LEFT | wx.EXPAND, border=10)
+    self.vbox.Add(hbox3,flag=wx.ALL | wx.EXPAND, border=10)
+
     self.vbox.Add((-1, 10))
 
   def OnGenerate(self, event):
-    """ Generates the PCB placement """
+    """ 
+    Generates the PCB placement. The layout is read and the part poses are
+    computed on a worker thread; the board is only touched from the UI
+    thread, a chunk of parts at a time, so the window stays responsive
+    """
+
+    # Only one generation at a time
+    if self.worker is not None:
+      return
 
     print("Generating footprint placements...")
 
-    # Generate the footprint placements and save to new file
-    with open(self.InputFile, 'r') as fp:
-      layout = json.load(fp)
+    # Trace the run into the output directory when asked to
+    self.tracePath = None
+    if os.environ.get(config.TRACE_ENV_VAR):
+      self.tracePath = os.path.join(self.OutputDir, "klepr_trace.json")
+      trace.enable()
+
+    # Work on a copy of the prefix table, so edits made meanwhile don't race
+    prefixTable = key.PrefixTable()
+    for entry in self.prefixTable.table.values():
+      prefixTable.table[entry.id] = key.Prefix(entry.id, entry.prefix, entry.off_x, entry.off_y, entry.angle)
+
+    self.cancelled.clear()
+    self.startTime = time.perf_counter()
+    self.generate.Disable()
+    self.cancel.Enable()
+    self.progress.SetRange(1)
+    self.progress.Pulse()
+    self.timer.Start(config.GUI_TIMER_MS)
+
+    self.worker = threading.Thread(
+      target=self.computePoses, args=(self.InputFile, prefixTable), daemon=True
+    )
+    self.worker.start()
+
+  def computePoses(self, inputFile, prefixTable):
+    """ 
+    Read the layout and compute the pose of every key. Runs on the worker
+    thread, and hands the result back to the UI thread
+
+    Parameters:
+
+    inputFile - (str)
+      The path to the KLE JSON file
+    prefixTable - (key.PrefixTable)
+      List of part prefixes 
+    """
+    try:
+      # Load the key geometry, only re-parsing the KLE file when it changed
+      keys = self.layoutCache.loadLayout(inputFile)
+      print("Layout cache statistics:", self.layoutCache.statistics())
+
+      if self.cancelled.is_set():
+        wx.CallAfter(self.finishGeneration, "Cancelled")
+        return
+
+      prefixPoses = pcb.computePrefixPoses(keys, prefixTable)
+      pcb.reportKeyCollisions(spatial.iterKeyBoxes(keys))
+
+    except Exception as error:
+      wx.CallAfter(self.finishGeneration, "Failed: " + str(error))
+      return
+
+    wx.CallAfter(self.startPlacement, prefixPoses)
 
-      # Parse KLE file
-      self.keyboard.parseLayout(layout)     
+  def startPlacement(self, prefixPoses):
+    """ Match the computed poses to the parts, then apply them in chunks """
 
-      # Place the parts according to KLE
-      self.klepr.PlaceParts(self.keyboard, self.prefixTable, self.OutputDir)
+    if self.cancelled.is_set():
+      self.finishGeneration("Cancelled")
+      return
+
+    try:
+      if not self.OutputDir:
+        raise ValueError("No output directory chosen")
+
+      # Pick up any parts added or renamed since the last run, and show their
+      # counts
+      self.RefreshRows()
+      self.placement = self.klepr.MatchPlacement(prefixPoses)
+
+    except Exception as error:
+      self.failPlacement(error)
+      return
+
+    self.applied = 0
+    self.touched = 0
+    self.skipped = 0
+    self.klepr.journal.beginRun()
+    self.runStart = len(self.klepr.journal)
+    self.progress.SetRange(max(len(self.placement), 1))
+    self.progress.SetValue(0)
+
+    wx.CallAfter(self.applyChunk)
+
+  def applyChunk(self):
+    """ 
+    Apply the next chunk of the placement, and queue the one after it behind
+    any pending UI events. Saves the board after the last chunk
+    """
+
+    # Put back the parts moved so far
+    if self.cancelled.is_set():
+      touched, skipped = self.klepr.RollbackTo(self.runStart)
+      self.finishGeneration("Cancelled, restored %d parts" % touched)
+      return
+
+    try:
+      chunk = self.placement[self.applied:self.applied + config.GUI_CHUNK_SIZE]
+      touched, skipped = self.klepr.ApplyPlacement(chunk)
+      self.touched += touched
+      self.skipped += skipped
+      self.applied += len(chunk)
+      self.progress.SetValue(self.applied)
+
+      if self.applied < len(self.placement):
+        wx.CallAfter(self.applyChunk)
+        return
+
+      print("Moved", self.touched, "parts,", self.skipped, "were already in place")
+      print("End of component placement. Exporting board to", self.OutputDir)
+      self.klepr.SavePlacement(os.path.join(self.OutputDir, "mod_.kicad_pcb")).result()
+
+    except Exception as error:
+      self.failPlacement(error)
+      return
+
+    self.finishGeneration("Moved %d parts" % self.touched, complete=True)
+
+  def failPlacement(self, error):
+    """ 
+    Put back the parts moved by a placement that failed on the UI thread,
+    and reset the controls
+
+    Parameters:
+
+    error - (Exception)
+      The error the placement failed with
+    """
+    traceback.print_exc()
+
+    status = "Failed: " + str(error)
+    if self.runStart is not None:
+      try:
+        touched, skipped = self.klepr.RollbackTo(self.runStart)
+        self.klepr.RefreshBoard()
+        status += ", restored %d parts" % touched
+      except Exception as rollbackError:
+        print("Error: could not put the parts back:", rollbackError)
+
+    self.finishGeneration(status)
+
+  def finishGeneration(self, status, complete=False):
+    """ 
+    Reset the controls after a generation ended, failed or was cancelled
+
+    Parameters:
+
+    status - (str)
+      The outcome shown next to the progress bar
+    complete - (bool)
+      Whether the board was placed and saved
+    """
+
+    self.timer.Stop()
+    self.worker = None
+    self.placement = []
+    self.runStart = None
+
+    self.generate.Enable()
+    self.cancel.Disable()
+    self.progress.SetValue(self.progress.GetRange() if complete else 0)
+    self.elapsedTxt.SetLabel("%s (%.1f s)" % (status, time.perf_counter() - self.startTime))
+    print(status)
+
+    if self.tracePath:
+      tracer = trace.disable()
+      tracer.writeChromeTrace(self.tracePath)
+      tracer.printSummary()
+      self.tracePath = None
+
+  def OnUndo(self, event):
+    """ Put the parts moved by the last generation or kept preview back """
+
+    # Undoing while parts are being placed would interleave with the chunks
+    if self.worker is not None:
+      return
+
+    touched, skipped = self.klepr.UndoLastRun()
+    self.klepr.RefreshBoard()
+    print("Undo put back", touched, "parts")
+    self.elapsedTxt.SetLabel("Undo put back %d parts" % touched)
+
+  def OnCancelGenerate(self, event):
+    """ Ask the running generation to stop at the next chunk """
+
+    print("Cancelling generation...")
+    self.cancelled.set()
+    self.cancel.Disable()
+
+  def OnTimer(self, event):
+    """ Show the time elapsed since Generate was pressed """
+
+    if self.placement:
+      label = "%d / %d parts" % (self.applied, len(self.placement))
+    else:
+      label = "Reading layout"
+      self.progress.Pulse()
 
+    self.elapsedTxt.SetLabel("%s (%.1f s)" % (label, time.perf_counter() - self.startTime))
 
   def finalizeWidgets(self):
     self.SetSizer(self.vbox)
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+""" Benchmarks for the parse, index, place, collision check, save and assign stages, run without KiCAD """
+
+import os
+import io
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import contextlib
+import tracemalloc
+
+from klepr import cli
+from klepr import synth
+from klepr.kleprtools import board
+from klepr.kleprtools import key
+
+# Stages in the order they run
+STAGES = ("parse", "load", "index", "place", "check", "save", "assign")
+
+# Default synthetic layout sizes, in keys
+SYNTHETIC_SIZES = (1000, 10000, 100000)
+
+# Largest layout the assign stage runs on; matching by displacement is
+# solved in pure Python without SciPy
+ASSIGN_MAX_KEYS = 20000
+
+@contextlib.contextmanager
+def measure(samples, stage):
+  """ Record the duration of a stage, and its peak memory when tracing """
+  if tracemalloc.is_tracing():
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+
+  start = time.perf_counter()
+  yield
+  samples[stage] = {'seconds': time.perf_counter() - start}
+
+  if tracemalloc.is_tracing():
+    samples[stage]['peak_bytes'] = tracemalloc.get_traced_memory()[1] - before
+
+def runStages(layoutPath, boardPath, prefixTable, outputDir):
+  """
+  Run every stage once, returning a dict of stage to its measurements
+
+  Parameters:
+
+  layoutPath - (str)
+    The path to the KLE JSON file
+  boardPath - (str)
+    The path to the .kicad_pcb file
+  prefixTable - (key.PrefixTable)
+    List of part prefixes
+  outputDir - (str)
+    Where the placed board is saved
+  """
+  samples = {}
+
+  with measure(samples, "parse"):
+    keyboard = key.Keyboard()
+    keyboard.parseLayout(key.iterLayoutFile(layoutPath))
+
+  with measure(samples, "load"):
+    klepr = board.HeadlessKlepr(boardPath)
+    klepr.checkKicadFileFormatVersion()
+
+  with measure(samples, "index"):
+    klepr.InvalidateReferenceIndex()
+    for entry in prefixTable.table.values():
+      klepr.GetPartsByPrefix(entry.prefix)
+
+  # Everything PlaceParts() does before saving
+  with measure(samples, "place"):
+    klepr.InvalidateReferenceIndex()
+    klepr.ApplyPlacement(klepr.ComputePlacement(keyboard, prefixTable))
+
+  # The collision check SavePlacement() runs before writing
+  with measure(samples, "check"):
+    klepr.CheckCollisions()
+
+  with measure(samples, "save"):
+    klepr.SaveBoard(os.path.join(outputDir, "mod_.kicad_pcb"))
+
+  # Matching parts shifted away from the keys back, lined up with them
+  # first, see pcb.Klepr.AssignByDisplacement()
+  if len(keyboard.keys) <= ASSIGN_MAX_KEYS:
+    synth.shiftParts(klepr, *synth.ASSIGNMENT_OFFSET_MM)
+    klepr.assignment = "aligned"
+    with measure(samples, "assign"):
+      klepr.ComputePlacement(keyboard, prefixTable)
+
+  return samples, len(keyboard.keys), len(klepr.GetParts())
+
+def benchmarkCase(layoutPath, boardPath, prefixTable, repeats=3):
+  """
+  Benchmark one layout and board. Timings are the best of several runs;
+  peak memory is traced in one extra run, so tracing does not slow the
+  timed runs down
+
+  Parameters:
+
+  layoutPath - (str)
+    The path to the KLE JSON file
+  boardPath - (str)
+    The path to the .kicad_pcb file
+  prefixTable - (key.PrefixTable)
+    List of part prefixes
+  repeats - (int)
+    The number of timed runs
+  """
+  stages = {}
+
+  with tempfile.TemporaryDirectory() as outputDir, contextlib.redirect_stdout(io.StringIO()):
+    for _ in range(repeats):
+      samples, keyCount, partCount = runStages(layoutPath, boardPath, prefixTable, outputDir)
+      for stage, sample in samples.items():
+        stages.setdefault(stage, {'seconds': float("inf")})
+        stages[stage]['seconds'] = min(stages[stage]['seconds'], sample['seconds'])
+
+    tracemalloc.start()
+    try:
+      samples, keyCount, partCount = runStages(layoutPath, boardPath, prefixTable, outputDir)
+    finally:
+      tracemalloc.stop()
+
+  for stage, sample in samples.items():
+    stages[stage]['peak_bytes'] = sample['peak_bytes']
+    stages[stage]['keys_per_second'] = keyCount / stages[stage]['seconds'] if stages[stage]['seconds'] else None
+
+  return {
+    'keys': keyCount,
+    'parts': partCount,
+    'seconds': sum(stage['seconds'] for stage in stages.values()),
+    'stages': stages,
+  }
+
+def compareReports(report, baseline, threshold):
+  """
+  Returns the (case, stage, baseline seconds, seconds) of every stage that
+  got slower than the baseline by more than the threshold ratio
+
+  Parameters:
+
+  report - (dict)
+    The report of this run
+  baseline - (dict)
+    A report from an earlier run
+  threshold - (float)
+    The slowdown ratio allowed, such as 1.25
+  """
+  regressions = []
+  for case, result in report['cases'].items():
+    baseCase = baseline.get('cases', {}).get(case)
+    if baseCase is None:
+      continue
+
+    for stage, sample in result['stages'].items():
+      baseSeconds = baseCase['stages'].get(stage, {}).get('seconds')
+      if baseSeconds and sample['seconds'] > baseSeconds * threshold:
+        regressions.append((case, stage, baseSeconds, sample['seconds']))
+
+  return regressions
+
+def printReport(report):
+  """ Print a table of the stage timings of every case """
+  print("%-16s %8s " % ("Case", "Keys") + " ".join("%10s" % stage for stage in STAGES) + " %12s %12s" % ("Keys/s", "Peak MiB"))
+  for case, result in report['cases'].items():
+    stages = result['stages']
+    peak = max(stage['peak_bytes'] for stage in stages.values()) / (1024.0 * 1024.0)
+    print("%-16s %8d " % (case, result['keys']) +
+      " ".join("%10.4f" % stages[stage]['seconds'] if stage in stages else "%10s" % "-" for stage in STAGES) +
+      " %12.0f %12.1f" % (result['keys'] / result['seconds'], peak))
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+    prog="python -m klepr.bench",
+    description="Time the parse, index, place, collision check, save and assign stages on the example and synthetic boards"
+  )
+  parser.add_argument("--examples", default=os.path.join(os.path.dirname(__file__), "..", "example_boards"),
+    help="directory of example board directories")
+  parser.add_argument("--prefixes", default=None,
+    help="prefix table of the example boards, defaults to EXAMPLES/refTable.json")
+  parser.add_argument("--sizes", type=int, nargs="*", default=list(SYNTHETIC_SIZES),
+    help="key counts of the synthetic layouts")
+  parser.add_argument("--no-examples", action="store_true",
+    help="only run the synthetic layouts")
+  parser.add_argument("--repeats", type=int, default=3,
+    help="timed runs per case; the best is reported")
+  parser.add_argument("--output", default="bench_output.json",
+    help="where to write the JSON report")
+  parser.add_argument("--baseline",
+    help="JSON report to compare against")
+  parser.add_argument("--update-baseline", action="store_true",
+    help="write this report to the baseline instead of comparing")
+  parser.add_argument("--threshold", type=float, default=1.25,
+    help="slowdown ratio over the baseline that counts as a regression")
+  args = parser.parse_args(argv)
+
+  prefixTable = key.PrefixTable()
+  prefixTable.importPrefixTable(args.prefixes or os.path.join(args.examples, "refTable.json"))
+
+  report = {
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'repeats': args.repeats,
+    'cases': {},
+  }
+
+  if not args.no_examples:
+    for name in sorted(os.listdir(args.examples)):
+      directory = os.path.join(args.examples, name)
+      if not os.path.isdir(directory):
+        continue
+
+      layoutPath = cli.findFile(directory, "*.json", exclude=("refTable.json", "coordinateMap.json"))
+      boardPath = cli.findFile(directory, "*.kicad_pcb")
+      report['cases'][name] = benchmarkCase(layoutPath, boardPath, prefixTable, args.repeats)
+
+  with tempfile.TemporaryDirectory() as workDir:
+    for size in args.sizes:
+      directory = synth.writeSynthetic(workDir, size)
+      name = os.path.basename(directory)
+
+      syntheticTable = key.PrefixTable()
+      syntheticTable.importPrefixTable(os.path.join(directory, "refTable.json"))
+
+      report['cases'][name] = benchmarkCase(
+        os.path.join(directory, name + ".json"), os.path.join(directory, name + ".kicad_pcb"),
+        syntheticTable, args.repeats
+      )
+
+  printReport(report)
+
+  with open(args.output, "w") as fp:
+    json.dump(report, fp, indent=2)
+
+  if args.baseline and args.update_baseline:
+    with open(args.baseline, "w") as fp:
+      json.dump(report, fp, indent=2)
+    print("Baseline written to", args.baseline)
+
+  elif args.baseline:
+    with open(args.baseline, "r") as fp:
+      baseline = json.load(fp)
+
+    regressions = compareReports(report, baseline, args.threshold)
+    for case, stage, baseSeconds, seconds in regressions:
+      print("Regression: %s %s took %.4fs, baseline %.4fs (%.2fx)" % (case, stage, seconds, baseSeconds, seconds / baseSeconds))
+    if regressions:
+      return 1
+    print("No regressions against", args.baseline)
+
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,425 @@
+#!/usr/bin/env python
+""" Command-line batch runner for placing parts on many boards without KiCAD """
+
+import os
+import io
+import sys
+import json
+import glob
+import time
+import argparse
+import traceback
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from klepr.kleprtools import board
+from klepr.kleprtools import config
+from klepr.kleprtools import key
+from klepr.kleprtools import matrix
+from klepr.kleprtools import netlist
+from klepr.kleprtools import plan
+from klepr.kleprtools import trace
+
+def findFile(directory, pattern, exclude=()):
+  """
+  Returns the only file in a directory matching a glob pattern, preferring
+  the one named after the directory
+
+  Parameters:
+
+  directory - (str)
+    The directory to search
+  pattern - (str)
+    The glob pattern, such as "*.json"
+  exclude - (tuple)
+    File names that never match
+  """
+  name = os.path.basename(os.path.normpath(directory))
+  preferred = os.path.join(directory, pattern.replace("*", name, 1))
+  if os.path.isfile(preferred):
+    return preferred
+
+  matches = [
+    path for path in sorted(glob.glob(os.path.join(directory, pattern)))
+    if os.path.basename(path) not in exclude and not os.path.basename(path).startswith("mod_")
+  ]
+  if len(matches) != 1:
+    raise ValueError("Expected one %s file in %s, found %d" % (pattern, directory, len(matches)))
+  return matches[0]
+
+def findJobs(directories, prefixes, outputDir, requirePrefixes=True):
+  """
+  Returns a job for every board directory. Each directory holds a KLE layout
+  and a board, and optionally a refTable.json overriding the shared prefixes
+
+  Parameters:
+
+  directories - (list)
+    The board directories, such as the ones in example_boards
+  prefixes - (str)
+    The prefix table used when a directory has none
+  outputDir - (str)
+    The output directory; each job writes into a subdirectory of it
+  requirePrefixes - (bool)
+    Fail on directories without a prefix table. Variant jobs bring their own
+  """
+  jobs = []
+  for directory in directories:
+    name = os.path.basename(os.path.normpath(directory))
+    localPrefixes = os.path.join(directory, "refTable.json")
+    if not os.path.isfile(localPrefixes) and prefixes is None and requirePrefixes:
+      raise ValueError("No refTable.json in %s and no --prefixes given" % directory)
+
+    job = {
+      'name': name,
+      'layout': findFile(directory, "*.json", exclude=("refTable.json", "coordinateMap.json")),
+      'board': findFile(directory, "*.kicad_pcb"),
+      'prefixes': localPrefixes if os.path.isfile(localPrefixes) else prefixes,
+      'output': os.path.join(outputDir, name),
+    }
+
+    # Check the part counts against the netlist when there is one
+    if glob.glob(os.path.join(directory, "*.net")):
+      job['netlist'] = findFile(directory, "*.net")
+
+    jobs.append(job)
+
+  return jobs
+
+def variantJobs(jobs, variants):
+  """
+  Returns a job for every prefix table variant of every job. The layout of
+  each job is parsed once here and written next to its output as a binary
+  coordinate map, which the workers memory-map read-only instead of parsing
+  the layout again. Each variant saves mod_<variant>.kicad_pcb
+
+  Parameters:
+
+  jobs - (list)
+    The jobs to make variants of, see runJob()
+  variants - (list)
+    The prefix table of every variant. Variants are named after the file
+  """
+  names = [os.path.splitext(os.path.basename(path))[0] for path in variants]
+  if len(set(names)) != len(names):
+    raise ValueError("The prefix tables of the variants need distinct file names")
+
+  expanded = []
+  for job in jobs:
+    os.makedirs(job['output'], exist_ok=True)
+
+    keys = key.KeyArray()
+    keys.extendFromWalk(key.iterLayoutFile(job['layout']))
+    mapPath = os.path.join(job['output'], "coordinateMap.kcm")
+    with open(mapPath, "wb") as fp:
+      keys.writeCoordinateMap(fp)
+
+    for name, path in zip(names, variants):
+      expanded.append(dict(job,
+        name=job.get('name', job['board']) + "/" + name,
+        prefixes=path,
+        variant=name,
+        keys=mapPath,
+      ))
+
+  return expanded
+
+def generateVariants(layout, board, variants, outputDir, workers=None, netlistPath=None):
+  """
+  Place one board once per prefix table variant, parsing the layout once and
+  spreading the variants over a pool of processes. Returns the summaries of
+  the runs, see runJob()
+
+  Parameters:
+
+  layout - (str)
+    The path to the KLE JSON file
+  board - (str)
+    The path to the .kicad_pcb file
+  variants - (list)
+    The prefix table of every variant. Variants are named after the file
+  outputDir - (str)
+    Where mod_<variant>.kicad_pcb files are saved
+  workers - (int)
+    The number of processes, see runJobs()
+  netlistPath - (str)
+    A netlist to check the part counts of every variant against
+  """
+  job = {'name': os.path.splitext(os.path.basename(board))[0], 'layout': layout, 'board': board, 'output': outputDir}
+  if netlistPath:
+    job['netlist'] = netlistPath
+
+  return runJobs(variantJobs([job], variants), workers)
+
+def runJob(job, saver=None):
+  """
+  Place and save one board, returning a summary of the run. Never raises;
+  failures are reported in the summary. The output of the run is written to
+  klepr.log in the job's output directory, with the traceback when it failed
+
+  Parameters:
+
+  job - (dict)
+    The name, layout, board, prefixes and output of the job, and optionally
+    a netlist to check, a plans directory to reuse placement plans from, the
+    assignment mode, the variant name and coordinate map of a variant job,
+    and whether to plan the switch matrix and trace the run
+
+  saver - (concurrent.futures.Executor)
+    Write the board on this executor without waiting for it. The summary
+    is then pending until passed to finishJob()
+  """
+  result = {'name': job.get('name', job.get('board')), 'status': "ok", 'start': time.perf_counter()}
+
+  keys = None
+  variant = job.get('variant', "")
+  jobSaver = saver
+  log = io.StringIO()
+
+  try:
+    os.makedirs(job['output'], exist_ok=True)
+
+    tracePath = None
+    if job.get('trace'):
+      tracePath = os.path.join(job['output'], "trace_%s.json" % variant if variant else "trace.json")
+
+      # Keep the save in the trace
+      jobSaver = None
+
+    with contextlib.redirect_stdout(log), trace.tracing(tracePath) if tracePath else contextlib.nullcontext():
+      prefixTable = key.PrefixTable()
+      prefixTable.importPrefixTable(job['prefixes'])
+
+      # Variants share the key geometry mapped from the coordinate map
+      if job.get('keys'):
+        keys = key.loadCoordinateMap(job['keys'])
+
+      # Fail early if the layout does not match the netlist
+      prefixes = None
+      if job.get('netlist'):
+        if keys is not None:
+          keyCount = len(keys)
+        else:
+          keyCount = sum(1 for _ in key.walkLayout(key.iterLayoutFile(job['layout'])))
+        prefixes = netlist.readNetlistPrefixes(job['netlist'])
+        mismatches = netlist.checkKeyCounts(prefixes, keyCount, prefixTable)
+        if mismatches:
+          raise ValueError("Part counts do not match the %d keys of the layout: %s" % (
+            keyCount, ", ".join("%s_ has %d" % (prefix, count) for prefix, (count, _) in sorted(mismatches.items()))
+          ))
+
+      klepr = board.HeadlessKlepr(job['board'])
+      klepr.checkKicadFileFormatVersion()
+      klepr.assignment = job.get('assign', "order")
+
+      # Reuse the stored plan of the layout when there is one
+      if job.get('plans'):
+        # Without a netlist the references come from the board, as they are
+        store = plan.PlanStore(job['plans'])
+        clusters = prefixes if prefixes is not None else plan.boardClusters(klepr)
+        placementPlan = store.planLayout(job['layout'], prefixTable, clusters)
+        result['touched'], result['skipped'], _ = placementPlan.apply(klepr)
+        print("Moved", result['touched'], "parts,", result['skipped'], "were already in place")
+        result['pendingSave'] = klepr.SavePlacement(os.path.join(job['output'], "mod_%s.kicad_pcb" % variant), jobSaver)
+      else:
+        layout = keys if keys is not None else key.Keyboard().iterLayout(key.iterLayoutFile(job['layout']))
+        result['touched'], result['skipped'] = klepr.PlaceParts(
+          layout, prefixTable, job['output'], "mod_%s.kicad_pcb" % variant, jobSaver
+        )
+        result['pendingSave'] = klepr.pendingSave
+
+      # The layout was consumed by the placement, so walk it again
+      if job.get('matrix'):
+        layout = keys if keys is not None else key.Keyboard().iterLayout(key.iterLayoutFile(job['layout']))
+        matrixPlan = matrix.planMatrix(layout)
+        matrixPlan.save(
+          os.path.join(job['output'], "matrix_%s.json" % variant if variant else "matrix.json"),
+          prefixes.get(config.ASSIGNMENT_ANCHOR_PREFIX) if prefixes else None
+        )
+        print("Planned a %d x %d switch matrix, about %.0f mm of traces" % (
+          matrixPlan.rowCount(), matrixPlan.columnCount(), matrixPlan.length
+        ))
+
+  except Exception:
+    result['status'] = "failed"
+    result['error'] = traceback.format_exc()
+    log.write(result['error'])
+
+  finally:
+    if keys is not None:
+      try:
+        keys.close()
+      except BufferError as error:
+        # The map stays open until the process exits, the board is unaffected
+        result.setdefault('warnings', []).append(str(error))
+
+    # Keep the log of failed jobs too
+    logName = "klepr_%s.log" % variant if variant else "klepr.log"
+    try:
+      with open(os.path.join(job['output'], logName), "w") as fp:
+        fp.write(log.getvalue())
+    except OSError as error:
+      result.setdefault('warnings', []).append("Could not write %s: %s" % (logName, error))
+
+  if saver is None:
+    return finishJob(result)
+  return result
+
+def finishJob(result):
+  """
+  Wait for the board of a job to be written, and complete its summary
+
+  Parameters:
+
+  result - (dict)
+    The summary returned by runJob()
+  """
+  pendingSave = result.pop('pendingSave', None)
+  if pendingSave is not None:
+    try:
+      result['saved'] = pendingSave.result()
+    except Exception:
+      result['status'] = "failed"
+      result['error'] = traceback.format_exc()
+
+  result['seconds'] = time.perf_counter() - result.pop('start')
+  return result
+
+def runJobsInline(jobs):
+  """
+  Run jobs one after another in this process, returning their summaries in
+  order. Each board is written on a background thread while the next job
+  computes
+
+  Parameters:
+
+  jobs - (list)
+    The jobs to run, see runJob()
+  """
+  results = []
+  pending = None
+
+  with ThreadPoolExecutor(max_workers=1) as saver:
+    for job in jobs:
+      result = runJob(job, saver)
+
+      # Keep at most one board waiting to be written
+      if pending is not None:
+        results.append(finishJob(pending))
+      pending = result
+
+    if pending is not None:
+      results.append(finishJob(pending))
+
+  return results
+
+def runJobs(jobs, workers=None):
+  """
+  Run jobs across a pool of processes, returning their summaries in order.
+  Jobs are handed out one at a time, so a slow board never holds up others
+
+  Parameters:
+
+  jobs - (list)
+    The jobs to run, see runJob()
+  workers - (int)
+    The number of processes. Defaults to the number of CPUs; 1 runs the jobs
+    in this process with runJobsInline()
+  """
+  if workers == 1 or len(jobs) <= 1:
+    return runJobsInline(jobs)
+
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    return list(pool.map(runJob, jobs, chunksize=1))
+
+def printSummary(results, elapsed):
+  """ Print a table of the job summaries """
+  print("%-24s %-8s %10s %8s %8s" % ("Job", "Status", "Seconds", "Moved", "Skipped"))
+  for result in results:
+    print("%-24s %-8s %10.3f %8s %8s" % (
+      result['name'], result['status'], result['seconds'],
+      result.get('touched', "-"), result.get('skipped', "-")
+    ))
+
+  failed = [result for result in results if result['status'] != "ok"]
+  print("%d jobs, %d failed, %.3f seconds" % (len(results), len(failed), elapsed))
+  for result in failed:
+    print("\n" + result['name'] + ":\n" + result['error'])
+  for result in results:
+    for warning in result.get('warnings', ()):
+      print("Warning: %s: %s" % (result['name'], warning))
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+    prog="python -m klepr.cli",
+    description="Place parts on many boards from their KLE layouts, without KiCAD"
+  )
+  parser.add_argument("directories", nargs="*",
+    help="board directories holding a KLE layout and a .kicad_pcb file")
+  parser.add_argument("--jobs",
+    help="JSON list of jobs with layout, board, prefixes, output and optional netlist keys")
+  parser.add_argument("--prefixes",
+    help="prefix table (refTable.json) for directories without their own")
+  parser.add_argument("--output", default="klepr_output",
+    help="output directory, one subdirectory per board directory")
+  parser.add_argument("--plans",
+    help="directory of placement plans, reused across runs and board revisions")
+  parser.add_argument("--variant", action="append", dest="variants",
+    help="prefix table of a variant; repeat to place every board once per variant")
+  parser.add_argument("--assign", choices=config.ASSIGNMENT_MODES, default="order",
+    help="match parts to keys by cluster number, by least displacement, by least displacement once lined up with the keys, or by the displacement of the anchor prefix")
+  parser.add_argument("--matrix", action="store_true",
+    help="plan the rows and columns of the switch matrix, written to matrix.json in the output directory")
+  parser.add_argument("--trace", action="store_true",
+    help="write a Chrome trace of every job to its output directory, with a summary in its log")
+  parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(),
+    help="number of worker processes")
+  parser.add_argument("--summary",
+    help="where to write the JSON summary, defaults to OUTPUT/summary.json")
+  args = parser.parse_args(argv)
+
+  jobs = []
+  if args.jobs:
+    with open(args.jobs, "r") as fp:
+      jobs.extend(json.load(fp))
+  jobs.extend(findJobs(args.directories, args.prefixes, args.output, requirePrefixes=not args.variants))
+
+  if args.variants:
+    jobs = variantJobs(jobs, args.variants)
+
+  if args.plans and args.assign != "order":
+    parser.error("--plans only replays placements matched by cluster number")
+
+  for job in jobs:
+    job.setdefault('assign', args.assign)
+
+  if args.plans:
+    for job in jobs:
+      job.setdefault('plans', args.plans)
+
+  if args.matrix:
+    for job in jobs:
+      job['matrix'] = True
+
+  if args.trace:
+    for job in jobs:
+      job['trace'] = True
+
+  if len(jobs) == 0:
+    parser.error("no jobs given")
+
+  start = time.perf_counter()
+  results = runJobs(jobs, args.workers)
+  elapsed = time.perf_counter() - start
+
+  printSummary(results, elapsed)
+
+  summaryPath = args.summary or os.path.join(args.output, "summary.json")
+  os.makedirs(os.path.dirname(os.path.abspath(summaryPath)), exist_ok=True)
+  with open(summaryPath, "w") as fp:
+    json.dump({'seconds': elapsed, 'workers': args.workers, 'jobs': results}, fp, indent=2)
+
+  return 1 if any(result['status'] != "ok" for result in results) else 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,456 @@
+""" Minimum-displacement matching of parts to key slots """
+
+import math
+import heapq
+
+from klepr.kleprtools import config
+
+# SciPy is optional; without it the candidates come from a grid and the
+# matching is solved here
+try:
+  from scipy.spatial import cKDTree
+  from scipy.sparse import csr_matrix
+  from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+except ImportError:
+  cKDTree = None
+
+# NumPy is optional; without it large problems stay on the sparse solver
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+class NoFullMatching(Exception):
+  """ Raised when the candidates leave a row without any column """
+  pass
+
+def alignSources(sources, targets):
+  """
+  Returns the sources moved and scaled so that, on each axis, their median
+  and the spread between their quartiles match the targets'. Parts shifted
+  away from the keys, or bunched up in a blob, then match the keys they map
+  onto instead of all fighting over the few keys nearest to them. Spreads
+  within config.ASSIGNMENT_ALIGN_SCALE of the targets' are not scaled, and
+  the shift is then refined on the offsets to the nearest targets, so a
+  board moved as a whole lands back exactly on its keys. When
+  config.ASSIGNMENT_ALIGN_SHARE of the sources already sit within half a
+  key of a target, the board is taken as in place and left untouched
+
+  Parameters:
+
+  sources, targets - (list)
+    The (x, y) points, in millimetres
+  """
+  nearest = nearestCandidates(sources, targets, 1)
+  inPlace = sum(1 for found in nearest if found[0][0] <= config.UNIT_SPACING_MM / 2.0)
+  if inPlace >= config.ASSIGNMENT_ALIGN_SHARE * len(sources):
+    return list(sources)
+
+  transforms = []
+  for axis in (0, 1):
+    ends = []
+    for points in (sources, targets):
+      values = sorted(point[axis] for point in points)
+      count = len(values)
+      ends.append((values[count // 2], values[(3 * count) // 4] - values[count // 4]))
+
+    (sourceMid, sourceSpread), (targetMid, targetSpread) = ends
+    scale = 1.0
+    if sourceSpread > 0 and targetSpread > 0:
+      ratio = targetSpread / sourceSpread
+      if max(ratio, 1.0 / ratio) > config.ASSIGNMENT_ALIGN_SCALE:
+        scale = ratio
+    transforms.append((sourceMid, targetMid, scale))
+
+  (sx, tx, kx), (sy, ty, ky) = transforms
+  aligned = [(tx + (x - sx) * kx, ty + (y - sy) * ky) for x, y in sources]
+
+  # Uneven point sets put the medians a little apart; the median offset to
+  # the nearest targets takes up the difference
+  offsets = [
+    (targets[found[0][1]][0] - x, targets[found[0][1]][1] - y)
+    for (x, y), found in zip(aligned, nearestCandidates(aligned, targets, 1))
+  ]
+  dx = sorted(offset[0] for offset in offsets)[len(offsets) // 2]
+  dy = sorted(offset[1] for offset in offsets)[len(offsets) // 2]
+  return [(x + dx, y + dy) for x, y in aligned]
+
+def ringCells(cx, cy, ring, minCell, maxCell):
+  """
+  Yield the grid cells at a Chebyshev distance of ring from a cell, within
+  the cells from minCell to maxCell that can hold targets
+  """
+  if ring == 0:
+    if minCell[0] <= cx <= maxCell[0] and minCell[1] <= cy <= maxCell[1]:
+      yield cx, cy
+    return
+
+  xs = range(max(cx - ring, minCell[0]), min(cx + ring, maxCell[0]) + 1)
+  for gy in (cy - ring, cy + ring):
+    if minCell[1] <= gy <= maxCell[1]:
+      for gx in xs:
+        yield gx, gy
+
+  ys = range(max(cy - ring + 1, minCell[1]), min(cy + ring - 1, maxCell[1]) + 1)
+  for gx in (cx - ring, cx + ring):
+    if minCell[0] <= gx <= maxCell[0]:
+      for gy in ys:
+        yield gx, gy
+
+def nearestCandidates(sources, targets, count):
+  """
+  Returns, for every source point, the (distance, target index) of its
+  nearest target points, closest first. Targets are bucketed into a grid
+  and the rings of cells around each source are searched outwards, until
+  the next ring cannot hold anything closer
+
+  Parameters:
+
+  sources, targets - (list)
+    The (x, y) points, in millimetres
+  count - (int)
+    The number of candidates per source
+  """
+  count = min(count, len(targets))
+  if count == 0:
+    return [[] for _ in sources]
+
+  # Far from the targets the rings are mostly empty, and checking every
+  # pair at once is cheaper
+  if np is not None and len(sources) * len(targets) <= config.ASSIGNMENT_SCAN_LIMIT:
+    return scanCandidates(sources, targets, count)
+
+  xs = [x for x, _ in targets]
+  ys = [y for _, y in targets]
+  spread = max(max(xs) - min(xs), max(ys) - min(ys))
+  cellSize = max(spread / math.sqrt(len(targets)), config.UNIT_SPACING_MM / 4.0)
+
+  cells = {}
+  for index, (x, y) in enumerate(targets):
+    cells.setdefault((math.floor(x / cellSize), math.floor(y / cellSize)), []).append(index)
+
+  minCell = (math.floor(min(xs) / cellSize), math.floor(min(ys) / cellSize))
+  maxCell = (math.floor(max(xs) / cellSize), math.floor(max(ys) / cellSize))
+
+  candidates = []
+  for x, y in sources:
+    cx = math.floor(x / cellSize)
+    cy = math.floor(y / cellSize)
+    found = []
+
+    # Rings short of the cells holding targets are empty, so sources away
+    # from the targets start at the first ring that reaches them
+    ring = max(0, minCell[0] - cx, cx - maxCell[0], minCell[1] - cy, cy - maxCell[1])
+
+    while True:
+      for gx, gy in ringCells(cx, cy, ring, minCell, maxCell):
+        for index in cells.get((gx, gy), ()):
+          found.append((math.hypot(targets[index][0] - x, targets[index][1] - y), index))
+
+      # Every target beyond this ring is at least this far away
+      reach = ring * cellSize
+      if len(found) >= count:
+        found.sort()
+        if found[count - 1][0] <= reach:
+          break
+
+      # Stop once the rings cover every cell holding targets
+      if cx - ring <= minCell[0] and cy - ring <= minCell[1] and cx + ring >= maxCell[0] and cy + ring >= maxCell[1]:
+        found.sort()
+        break
+
+      ring += 1
+
+    candidates.append(found[:count])
+
+  return candidates
+
+def scanCandidates(sources, targets, count):
+  """
+  Same as nearestCandidates(), computing the distance of every pair with
+  NumPy, a block of sources at a time. Ties are broken by target index
+  """
+  xs = np.array([x for x, _ in targets], dtype=float)
+  ys = np.array([y for _, y in targets], dtype=float)
+  block = max(1, (1 << 20) // len(targets))
+
+  candidates = []
+  for start in range(0, len(sources), block):
+    points = np.array(sources[start:start + block], dtype=float).reshape(-1, 2)
+    distances = np.hypot(points[:, :1] - xs, points[:, 1:] - ys)
+
+    # A stable sort keeps equal distances in target order
+    nearest = np.argsort(distances, axis=1, kind='stable')[:, :count]
+    nearestDistances = np.take_along_axis(distances, nearest, axis=1)
+    for rowDistances, rowIndices in zip(nearestDistances.tolist(), nearest.tolist()):
+      candidates.append(list(zip(rowDistances, rowIndices)))
+
+  return candidates
+
+def solveAssignment(candidates, columnCount, partial=False):
+  """
+  Returns the column of every row minimizing the total cost, using only the
+  candidate edges of each row. Every row is matched, so there must be no
+  more rows than columns. Rows are added one at a time along a shortest
+  augmenting path over reduced costs, which stops at the first free column,
+  so rows that already sit on their best column cost next to nothing
+
+  Raises NoFullMatching if the candidates cannot match every row
+
+  Parameters:
+
+  candidates - (list)
+    The (cost, column) edges of every row
+  columnCount - (int)
+    The number of columns
+  partial - (bool)
+    Leave the rows that cannot be added at -1 instead of raising
+  """
+  rowCount = len(candidates)
+  u = [0.0] * rowCount
+  v = [0.0] * columnCount
+  col4row = [-1] * rowCount
+  row4col = [-1] * columnCount
+
+  # Columns reached by a row that could not be added. They are all taken,
+  # and their rows only reach each other, so no later path can end there
+  dead = set()
+
+  for start in range(rowCount):
+    shortest = {}
+    path = {}
+    visitedRows = [start]
+    visitedColumns = []
+    done = set()
+    heap = []
+
+    row = start
+    minValue = 0.0
+    sink = -1
+
+    while sink < 0:
+      for cost, column in candidates[row]:
+        if column in done or column in dead:
+          continue
+        reduced = minValue + cost - u[row] - v[column]
+        if reduced < shortest.get(column, float("inf")):
+          shortest[column] = reduced
+          path[column] = row
+          heapq.heappush(heap, (reduced, column))
+
+      # Closest column not settled yet, skipping stale heap entries
+      while heap and (heap[0][1] in done or heap[0][0] > shortest[heap[0][1]]):
+        heapq.heappop(heap)
+      if not heap:
+        if not partial:
+          raise NoFullMatching(start)
+        dead.update(visitedColumns)
+        break
+
+      minValue, column = heapq.heappop(heap)
+      done.add(column)
+      visitedColumns.append(column)
+
+      if row4col[column] < 0:
+        sink = column
+      else:
+        row = row4col[column]
+        visitedRows.append(row)
+
+    if sink < 0:
+      continue
+
+    # Update the duals of everything settled on the way
+    u[start] += minValue
+    for row in visitedRows[1:]:
+      u[row] += minValue - shortest[col4row[row]]
+    for column in visitedColumns:
+      v[column] -= minValue - shortest[column]
+
+    # Flip the matching along the path
+    column = sink
+    while True:
+      row = path[column]
+      row4col[column] = row
+      column, col4row[row] = col4row[row], column
+      if row == start:
+        break
+
+  return col4row
+
+def matchDense(sources, targets):
+  """
+  Solve over every source and target pair, with no more sources than
+  targets. Same shortest augmenting path as solveAssignment(), with each
+  step vectorized over the targets. The distances of a row are computed
+  when it is reached, so no cost matrix is held in memory
+  """
+  xs = np.array([x for x, _ in targets], dtype=float)
+  ys = np.array([y for _, y in targets], dtype=float)
+  rowCount = len(sources)
+  columnCount = len(targets)
+  u = np.zeros(rowCount)
+  v = np.zeros(columnCount)
+  col4row = np.full(rowCount, -1, dtype=np.int64)
+  row4col = np.full(columnCount, -1, dtype=np.int64)
+
+  for start in range(rowCount):
+    shortest = np.full(columnCount, np.inf)
+    path = np.full(columnCount, -1, dtype=np.int64)
+    free = np.ones(columnCount, dtype=bool)
+    visitedRows = [start]
+
+    row = start
+    minValue = 0.0
+    sink = -1
+
+    while sink < 0:
+      x, y = sources[row]
+      reduced = minValue + np.hypot(xs - x, ys - y) - u[row] - v
+      better = free & (reduced < shortest)
+      shortest[better] = reduced[better]
+      path[better] = row
+
+      column = int(np.argmin(np.where(free, shortest, np.inf)))
+      minValue = shortest[column]
+      free[column] = False
+
+      if row4col[column] < 0:
+        sink = column
+      else:
+        row = int(row4col[column])
+        visitedRows.append(row)
+
+    # Update the duals of everything settled on the way
+    u[start] += minValue
+    for row in visitedRows[1:]:
+      u[row] += minValue - shortest[col4row[row]]
+    settled = ~free
+    v[settled] -= minValue - shortest[settled]
+
+    # Flip the matching along the path
+    column = sink
+    while True:
+      row = int(path[column])
+      row4col[column] = row
+      column, col4row[row] = int(col4row[row]), column
+      if row == start:
+        break
+
+  return col4row.tolist()
+
+def matchSolved(sources, targets, count):
+  """ Solve with the candidates of nearestCandidates() and solveAssignment() """
+  return solveAssignment(nearestCandidates(sources, targets, count), len(targets))
+
+def matchPartial(sources, targets, count):
+  """
+  Solve what the candidates of nearestCandidates() can match, then match
+  the rows left over to the columns left over with matchNearest(), lined up
+  among themselves with alignSources(). Not minimal overall, but bounded on
+  problems too large for matchDense(), where the rows left over crowd the
+  same few columns
+  """
+  col4row = solveAssignment(nearestCandidates(sources, targets, count), len(targets), partial=True)
+
+  rows = [row for row, column in enumerate(col4row) if column < 0]
+  taken = set(col4row)
+  columns = [column for column in range(len(targets)) if column not in taken]
+
+  # The first row always finds a free column, so what is left is smaller
+  matched = matchNearest([sources[row] for row in rows], [targets[column] for column in columns], count, align=True)
+  for row, column in zip(rows, matched):
+    col4row[row] = columns[column]
+  return col4row
+
+def matchSciPy(sources, targets, count):
+  """ Solve with SciPy's KD-tree and sparse bipartite matching """
+  count = min(count, len(targets))
+  distances, indices = cKDTree(targets).query(sources, k=count)
+  if count == 1:
+    distances = distances.reshape(-1, 1)
+    indices = indices.reshape(-1, 1)
+
+  # Missing entries are not edges, so shift every cost off zero. Every row
+  # is matched once, which leaves the best matching the same
+  rows = [row for row in range(len(sources)) for _ in range(count)]
+  graph = csr_matrix((distances.ravel() + 1.0, (rows, indices.ravel())), shape=(len(sources), len(targets)))
+
+  try:
+    rowIndices, columnIndices = min_weight_full_bipartite_matching(graph)
+  except ValueError:
+    raise NoFullMatching()
+
+  col4row = [-1] * len(sources)
+  for row, column in zip(rowIndices, columnIndices):
+    col4row[row] = int(column)
+  return col4row
+
+def matchNearest(sources, targets, count=config.ASSIGNMENT_CANDIDATES, align=False):
+  """
+  Returns the index of the target matched to every source, or None for
+  sources left over when there are more sources than targets. The total
+  distance between matched sources and targets is minimal among the
+  matchings using each point's nearest neighbours; the neighbourhood grows
+  until every point can be matched
+
+  Parameters:
+
+  sources, targets - (list)
+    The (x, y) points, in millimetres
+  count - (int)
+    The number of nearest neighbours each point starts with. When they
+    cannot match every point, or once they reach
+    config.ASSIGNMENT_DENSE_SHARE of the points, every pair is considered at
+    once instead, up to config.ASSIGNMENT_DENSE_LIMIT pairs
+  align - (bool)
+    Line the sources up with the targets first, see alignSources(). A board
+    shifted as a whole then matches as if it were not, but the distance
+    minimised is the one left after the shift, not the one from where the
+    sources are
+  """
+  if not sources or not targets:
+    return [None] * len(sources)
+
+  if align:
+    sources = alignSources(sources, targets)
+
+  # Match from the smaller side, so every row gets a column
+  transposed = len(sources) > len(targets)
+  rows, columns = (targets, sources) if transposed else (sources, targets)
+  solve = matchSciPy if cKDTree is not None else matchSolved
+
+  dense = (
+    solve is matchSolved and np is not None and
+    len(rows) * len(columns) <= config.ASSIGNMENT_DENSE_LIMIT
+  )
+
+  while True:
+    if dense and count >= config.ASSIGNMENT_DENSE_SHARE * len(columns):
+      col4row = matchDense(rows, columns)
+      break
+
+    try:
+      col4row = solve(rows, columns, count)
+      break
+    except NoFullMatching:
+      if count >= len(columns):
+        raise
+
+      # Past the first miss, solving every pair at once is cheaper than
+      # growing the neighbourhoods again and again
+      if dense:
+        count = max(count * 2, int(math.ceil(config.ASSIGNMENT_DENSE_SHARE * len(columns))))
+      elif solve is matchSolved:
+        col4row = matchPartial(rows, columns, count)
+        break
+      else:
+        count *= 2
+
+  if not transposed:
+    return col4row
+
+  matched = [None] * len(sources)
+  for row, column in enumerate(col4row):
+    matched[column] = row
+  return matched
@@ -0,0 +1,501 @@
+""" A pure-Python .kicad_pcb backend, for placing parts without PCBNew """
+
+import os
+import re
+import mmap
+import shutil
+import hashlib
+import functools
+
+from klepr.kleprtools import config
+from klepr.kleprtools import pcb
+from klepr.kleprtools import spatial
+from klepr.kleprtools import trace
+
+# Parentheses, quoted strings and bare atoms of an s-expression. The board is
+# tokenized as bytes, so every offset is a byte offset into the file
+TOKEN_RE = re.compile(rb'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+
+# List keywords that hold a footprint, in the stable and nightly formats
+FOOTPRINT_KEYWORDS = (b'module', b'footprint')
+
+# Footprint children whose (at) angle includes the footprint rotation
+ROTATED_CHILD_KEYWORDS = (b'pad', b'fp_text', b'property')
+
+# Lists whose atoms are needed while indexing the file
+COLLECTED_KEYWORDS = (b'at', b'size', b'version', b'fp_text', b'property')
+
+def unquote(atom):
+  """ Returns the value of an s-expression atom as a str, removing quotes if present """
+  atom = atom.decode('utf-8')
+  if atom.startswith('"'):
+    return atom[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+  return atom
+
+def formatNumber(value):
+  """ Format a number like PCBNew does: nanometre precision, no trailing zeros """
+  text = ('%.6f' % value).rstrip('0').rstrip('.')
+  return "0" if text in ("", "-0") else text
+
+def splitAtoms(atoms):
+  """ 
+  Returns the leading numeric atoms of a list as floats, and the atoms after
+  them, like the locked or unlocked flag of an (at x y angle unlocked) list
+  """
+  numbers = []
+  for atom in atoms:
+    try:
+      numbers.append(float(atom))
+    except ValueError:
+      break
+  return numbers, tuple(atoms[len(numbers):])
+
+def formatAt(x, y, angle, tail=()):
+  """ 
+  Format an (at x y angle) list as bytes, leaving out the angle when it is
+  zero. The atoms of tail are written back after the numbers
+  """
+  if formatNumber(angle) == "0":
+    text = "(at %s %s" % (formatNumber(x), formatNumber(y))
+  else:
+    text = "(at %s %s %s" % (formatNumber(x), formatNumber(y), formatNumber(angle))
+  return text.encode('ascii') + b"".join(b" " + atom for atom in tail) + b")"
+
+def spliceEdits(data, edits, offset=0):
+  """ 
+  Returns data from offset onwards with the edits applied
+
+  Parameters:
+
+  data - (bytes)
+    The original content
+  edits - (list)
+    Sorted (start, end, replacement) tuples, all starting at or after offset
+  offset - (int)
+    The byte offset to start from
+  """
+  chunks = []
+  for start, end, text in edits:
+    chunks.append(data[offset:start])
+    chunks.append(text)
+    offset = end
+  chunks.append(data[offset:])
+  return b"".join(chunks)
+
+class BoardPart():
+  """ A footprint of a BoardFile, and where its pose is stored in the file """
+
+  __slots__ = ('reference', 'x', 'y', 'orientation', 'atSpan', 'atTail', 'childAts', 'pads', 'outline', 'original')
+
+  def __init__(self):
+    self.reference = ""
+
+    # Position in millimetres and orientation in tenths of a degree, as PCBNew
+    self.x = 0.0
+    self.y = 0.0
+    self.orientation = 0.0
+
+    # Byte span of the footprint's (at) list and the atoms after its numbers,
+    # and the (at) lists of its pads and texts as (start, end, x, y, angle,
+    # tail) tuples
+    self.atSpan = None
+    self.atTail = ()
+    self.childAts = []
+
+    # The [x, y, angle, width, height] of every pad, by the offset of the pad
+    self.pads = {}
+    self.outline = False   # See Outline()
+
+    # The pose as it was read from the file
+    self.original = (0.0, 0.0, 0.0)
+
+  def IsModified(self):
+    """ Returns True if the pose differs from the one read from the file """
+    return (self.x, self.y, self.orientation) != self.original
+
+  def Outline(self):
+    """
+    Returns the (min x, min y, max x, max y) around the pads in footprint
+    coordinates, or None for footprints without pads. Pads never move
+    relative to the footprint, so the box is computed once
+    """
+    if self.outline is not False:
+      return self.outline
+
+    outline = None
+    for x, y, angle, width, height in self.pads.values():
+
+      # Pad angles include the footprint rotation as it was read
+      padAngle = angle - self.original[2] / 10.0
+      outline = spatial.unionBounds(outline, spatial.boxBounds((x, y, width / 2.0, height / 2.0, -padAngle)))
+
+    self.outline = outline
+    return self.outline
+
+class BoardFile():
+  """
+  An indexed .kicad_pcb file. Only the footprints and their poses are parsed;
+  everything else is kept as the original bytes and written back untouched.
+  """
+
+  def __init__(self, path):
+    """
+    Constructor
+
+    Parameters:
+
+    path - (str)
+      The path of the .kicad_pcb file to load
+    """
+    self.path = path
+    self.version = 0
+    self.parts = []
+    self.digest = None   # See contentHash()
+
+    with open(path, 'rb') as fp:
+      self.data = fp.read()
+      self.sourceStat = self.statSignature(os.fstat(fp.fileno()))
+
+    self.indexData()
+
+  def statSignature(self, stat):
+    """ Returns the parts of a stat result that change when a file is rewritten """
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+  @trace.traced
+  def indexData(self):
+    """ Tokenize the board once, recording every footprint and its (at) lists """
+
+    # One frame per open list: [keyword, start offset, atoms or None, nested]
+    stack = []
+    expectKeyword = False
+    part = None
+    partDepth = 0
+
+    for match in TOKEN_RE.finditer(self.data):
+      token = match.group()
+
+      if token == b'(':
+        if stack:
+          stack[-1][3] = True
+        stack.append([None, match.start(), None, False])
+        expectKeyword = True
+        continue
+
+      if token == b')':
+        keyword, start, atoms, nested = stack.pop()
+        depth = len(stack)
+
+        # Footprint (at x y angle), or the (at) of one of its pads and texts
+        # KiCad 6 may follow the numbers with a flag, as in (at x y unlocked)
+        if keyword == b'at' and part is not None and atoms and not nested:
+          numbers, tail = splitAtoms(atoms)
+          if len(numbers) < 2:
+            continue
+          x, y = numbers[0], numbers[1]
+          angle = numbers[2] if len(numbers) > 2 else 0.0
+
+          if depth == partDepth + 1:
+            part.atSpan = (start, match.end())
+            part.atTail = tail
+            part.x, part.y, part.orientation = x, y, angle * 10.0
+            part.original = (part.x, part.y, part.orientation)
+          elif depth == partDepth + 2 and stack[-1][0] in ROTATED_CHILD_KEYWORDS:
+            part.childAts.append((start, match.end(), x, y, angle, tail))
+            if stack[-1][0] == b'pad':
+              part.pads.setdefault(stack[-1][1], [0.0, 0.0, 0.0, 0.0, 0.0])[0:3] = [x, y, angle]
+
+        elif keyword == b'size' and part is not None and depth == partDepth + 2 and stack[-1][0] == b'pad':
+          if len(atoms) > 1:
+            part.pads.setdefault(stack[-1][1], [0.0, 0.0, 0.0, 0.0, 0.0])[3:5] = [float(atoms[0]), float(atoms[1])]
+
+        elif keyword == b'fp_text' and part is not None and depth == partDepth + 1:
+          if atoms and atoms[0] == b'reference':
+            part.reference = unquote(atoms[1])
+
+        elif keyword == b'property' and part is not None and depth == partDepth + 1:
+          if atoms and unquote(atoms[0]) == 'Reference':
+            part.reference = unquote(atoms[1])
+
+        elif keyword == b'version' and depth == 1 and atoms:
+          self.version = int(atoms[0])
+
+        elif part is not None and depth == partDepth:
+          self.parts.append(part)
+          part = None
+
+        continue
+
+      if expectKeyword:
+        expectKeyword = False
+        stack[-1][0] = token
+
+        if token in COLLECTED_KEYWORDS:
+          stack[-1][2] = []
+        elif token in FOOTPRINT_KEYWORDS and len(stack) == 2:
+          part = BoardPart()
+          partDepth = len(stack) - 1
+        continue
+
+      atoms = stack[-1][2]
+      if atoms is not None:
+        atoms.append(token)
+
+  def iterEdits(self):
+    """
+    Yield (start, end, text) replacements for the (at) lists of every moved
+    footprint, in file order
+    """
+    for part in self.parts:
+      if not part.IsModified() or part.atSpan is None:
+        continue
+
+      yield part.atSpan[0], part.atSpan[1], formatAt(part.x, part.y, part.orientation / 10.0, part.atTail)
+
+      # Pads and texts store their angle including the footprint rotation
+      delta = (part.orientation - part.original[2]) / 10.0
+      if formatNumber(delta) == "0":
+        continue
+      for start, end, x, y, angle, tail in part.childAts:
+        yield start, end, formatAt(x, y, (angle + delta) % 360.0, tail)
+
+  def Render(self):
+    """ Returns the bytes of the board with every moved footprint updated """
+    return spliceEdits(self.data, sorted(self.iterEdits()))
+
+  def contentHash(self):
+    """ Returns the SHA-256 of the loaded file, computed once """
+    if self.digest is None:
+      self.digest = hashlib.sha256(self.data).hexdigest()
+    return self.digest
+
+  def placementHash(self, edits):
+    """
+    Returns a hash identifying the bytes a list of edits renders to: the
+    hash of the loaded file and of every edit
+
+    Parameters:
+
+    edits - (list)
+      The sorted (start, end, text) edits, see iterEdits()
+    """
+    digest = hashlib.sha256(self.contentHash().encode('ascii'))
+    for start, end, text in edits:
+      digest.update(b"%d %d " % (start, end))
+      digest.update(text)
+      digest.update(b"\n")
+    return digest.hexdigest()
+
+  @trace.traced
+  def Save(self, name, edits=None):
+    """
+    Write the board to a file, only touching the bytes that changed.
+
+    The loaded file is copied to a temporary file next to the destination,
+    every (at) list that fits its original span is patched in place through
+    a memory map, and the copy is renamed over the destination. If a
+    replacement is longer than its span, the file is rewritten from that
+    point onwards.
+
+    A shorter list is padded with spaces before its closing parenthesis, so
+    the file keeps its size and layout, and reloads to the same board. The
+    trade-off is that the saved bytes differ from Render(), and the padding
+    stays until KiCAD saves the board again.
+
+    Parameters:
+
+    name - (str)
+      The full path and filename of the modified file
+
+    edits - (list)
+      The sorted edits to write, taken from the parts when not given. Edits
+      snapshot the poses, so the parts can move on while another thread
+      writes them
+    """
+    if edits is None:
+      edits = sorted(self.iterEdits())
+    tmpPath = name + ".tmp"
+
+    # Let the OS copy the source, unless it changed since it was indexed
+    try:
+      sourceUnchanged = self.statSignature(os.stat(self.path)) == self.sourceStat
+    except OSError:
+      sourceUnchanged = False
+
+    if sourceUnchanged:
+      shutil.copyfile(self.path, tmpPath)
+    else:
+      with open(tmpPath, 'wb') as fp:
+        fp.write(self.data)
+
+    # Edits before the first one that grows are patched in place
+    growing = len(edits)
+    for num, (start, end, text) in enumerate(edits):
+      if len(text) > end - start:
+        growing = num
+        break
+
+    try:
+      with open(tmpPath, 'r+b') as fp:
+        if growing > 0:
+          with mmap.mmap(fp.fileno(), 0) as view:
+            for start, end, text in edits[:growing]:
+              view[start:end] = text[:-1].ljust(end - start - 1) + b")"
+            view.flush()
+
+        if growing < len(edits):
+          fp.seek(edits[growing][0])
+          fp.write(spliceEdits(self.data, edits[growing:], edits[growing][0]))
+          fp.truncate()
+
+      os.replace(tmpPath, name)
+
+    except BaseException:
+      os.remove(tmpPath)
+      raise
+
+class HeadlessKlepr(pcb.Klepr):
+  """
+  Klepr backend working on a .kicad_pcb file directly, for running placement
+  outside of a KiCAD process. Angles use the same units as PCBNew, tenths of
+  a degree
+  """
+
+  # Boards are written from byte snapshots, which any thread can do
+  backgroundSaves = True
+
+  def __init__(self, path, *args, **kwargs):
+    """
+    Constructor
+
+    Parameters:
+
+    path - (str)
+      The path of the .kicad_pcb file to place parts on
+    """
+    super(HeadlessKlepr, self).__init__(*args, board=BoardFile(path), **kwargs)
+
+  ######################################################################
+  # Start of compatibility layer
+  ######################################################################
+
+  @trace.traced
+  def checkKicadFileFormatVersion(self):
+    """ Checks the file format version of the loaded board """
+    kicadVer = self.pcb.version
+    self.isNightly = (kicadVer >= config.KICAD_NIGHTLY_VERSION) and not (kicadVer < config.KICAD_STABLE_VERSION)
+
+  @trace.traced
+  def GetParts(self):
+    """ Returns the list of parts on the board """
+    return self.pcb.parts
+
+  @trace.traced
+  def FindPartByReference(self, reference):
+    """
+    Returns the first part with the given reference, or None
+
+    Parameters:
+
+    reference - (str)
+      The part reference to search ("K_11", "LED_34", etc.)
+    """
+    for part in self.pcb.parts:
+      if part.reference == reference:
+        return part
+    return None
+
+  @trace.traced
+  def SetPartPosition(self, part, x, y):
+    """
+    Set a part's position, rounded to the nanometre like PCBNew
+
+    Parameters:
+
+    part - (board.BoardPart)
+      Part to be placed
+
+    x - (float)
+      X coordinate of part in millimetres
+
+    y - (float)
+      Y coordinate of part in millimetres
+    """
+    part.x = round(float(x), 6)
+    part.y = round(float(y), 6)
+
+  @trace.traced
+  def SetPartOrientation(self, part, angle):
+    """
+    Set a part's rotation
+
+    Parameters:
+
+    part - (board.BoardPart)
+      Part to be rotated
+
+    angle - (float)
+      Rotation in tenths of a degree
+    """
+    part.orientation = float(angle) % 3600.0
+
+  @trace.traced
+  def GetPartPosition(self, part):
+    """ Returns a part's position in millimetres """
+    return part.x, part.y
+
+  @trace.traced
+  def GetPartOrientation(self, part):
+    """ Returns a part's rotation in tenths of a degree """
+    return part.orientation
+
+  @trace.traced
+  def GetPartReference(self, part):
+    """ Returns a part's reference """
+    return part.reference
+
+  @trace.traced
+  def GetPartOutline(self, part):
+    """ Returns the box around a part's pads in footprint coordinates, or None """
+    return part.Outline()
+
+  @trace.traced
+  def SaveBoard(self, name):
+    """
+    Save the board to a new file
+
+    Parameters
+
+    name - (str)
+      The full path and filename of the modified file
+    """
+    self.pcb.Save(name)
+
+  @trace.traced
+  def IsBoardModified(self):
+    """ Only part poses can be edited without PCBNew, and they are saved """
+    return False
+
+  @trace.traced
+  def PrepareSave(self, name):
+    """
+    Snapshot the moved parts for saving. Returns the placement hash of the
+    snapshot and a function writing it, which is safe to call from another
+    thread
+
+    Parameters:
+
+    name - (str)
+      The full path and filename of the modified file
+    """
+    edits = sorted(self.pcb.iterEdits())
+    return self.pcb.placementHash(edits), functools.partial(self.pcb.Save, name, edits)
+
+  @trace.traced
+  def RefreshBoard(self):
+    """ There is no canvas to redraw without PCBNew """
+    pass
+
+  ######################################################################
+  # End of compatibility layer
+  ######################################################################
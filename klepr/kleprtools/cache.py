@@ -0,0 +1,259 @@
+""" Content-addressed on-disk cache for parsed KLE layouts """
+
+import os
+import json
+import atexit
+import struct
+import hashlib
+from array import array
+
+from klepr.kleprtools import config
+from klepr.kleprtools import key
+from klepr.kleprtools import trace
+
+# Entry file layout: magic, parser version, key count, then one column per field
+ENTRY_MAGIC = b"KLEPRKC1"
+ENTRY_HEADER = struct.Struct("<8sII")
+ENTRY_SUFFIX = ".keys"
+
+# Typecodes for each field in key.Key.ARRAY_FIELDS, the same as the columns
+# of key.KeyArray
+FIELD_TYPECODES = {
+  'ref': 'q',
+  'abs_x': 'd',
+  'abs_y': 'd',
+  'width': 'd',
+  'height': 'd',
+  'angle': 'd',
+  'stab_angle': 'd',
+}
+
+STATS_NAME = "stats.json"
+
+def hashLayoutFile(path):
+  """ 
+  Returns a hash of the content of a KLE file and the parser version
+
+  Parameters:
+
+  path - (str)
+    The path to the KLE JSON file
+  """
+  digest = hashlib.sha256()
+  digest.update(b"parser-%d\0" % config.LAYOUT_PARSER_VERSION)
+
+  with open(path, 'rb') as fp:
+    for chunk in iter(lambda: fp.read(1 << 20), b""):
+      digest.update(chunk)
+
+  return digest.hexdigest()
+
+class LayoutCache():
+  """ 
+  Stores the key geometry of parsed KLE layouts on disk, keyed by a hash of
+  the layout content and the parser version.
+
+  Entries are kept as raw typed columns so they load without re-parsing, and
+  are returned as a key.KeyArray over those columns. The cache is bounded in
+  size and evicts the least recently used entries first. The statistics are
+  written once, when the process exits
+  """
+
+  def __init__(self, cacheDir=config.CACHE_DIR, maxBytes=config.CACHE_MAX_BYTES):
+    """ 
+    Constructor
+
+    Parameters:
+
+    cacheDir - (str)
+      The directory the cache entries are stored in
+    maxBytes - (int)
+      The total size of all entries before old ones are evicted
+    """
+    self.cacheDir = os.path.expanduser(cacheDir)
+    self.maxBytes = maxBytes
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.statsRegistered = False
+
+    os.makedirs(self.cacheDir, exist_ok=True)
+
+  def layoutHash(self, path):
+    """ 
+    Returns the cache key of a KLE file: a hash of its content and the parser
+    version
+
+    Parameters:
+
+    path - (str)
+      The path to the KLE JSON file
+    """
+    return hashLayoutFile(path)
+
+  def entryPath(self, digest):
+    """ Returns the path of the entry for a given cache key """
+    return os.path.join(self.cacheDir, digest + ENTRY_SUFFIX)
+
+  def get(self, digest):
+    """ 
+    Returns the key.KeyArray stored under a cache key, or None on a miss
+
+    Parameters:
+
+    digest - (str)
+      The cache key returned by layoutHash()
+    """
+    path = self.entryPath(digest)
+
+    try:
+      with open(path, 'rb') as fp:
+        magic, version, count = ENTRY_HEADER.unpack(fp.read(ENTRY_HEADER.size))
+        if magic != ENTRY_MAGIC or version != config.LAYOUT_PARSER_VERSION:
+          raise ValueError("Stale cache entry")
+
+        columns = []
+        for name in key.Key.ARRAY_FIELDS:
+          column = array(FIELD_TYPECODES[name])
+          column.fromfile(fp, count)
+          columns.append(column)
+
+    except (OSError, EOFError, ValueError, struct.error):
+      self.misses += 1
+      return None
+
+    # Mark the entry as recently used, unless another process evicted it
+    try:
+      os.utime(path)
+    except FileNotFoundError:
+      pass
+    self.hits += 1
+
+    # The columns are taken as they are, without a Key object per key
+    keys = key.KeyArray()
+    keys.extendColumns(dict(zip(key.Key.ARRAY_FIELDS, columns)))
+    return keys
+
+  def put(self, digest, keys):
+    """ 
+    Store the keys of a layout under a cache key, then evict old entries
+
+    Parameters:
+
+    digest - (str)
+      The cache key returned by layoutHash()
+    keys - (key.KeyArray or list)
+      The keys of the parsed layout, as columns or as Key objects
+    """
+    path = self.entryPath(digest)
+
+    # Processes caching the same layout each write their own file
+    tmpPath = "%s.%d.tmp" % (path, os.getpid())
+
+    with open(tmpPath, 'wb') as fp:
+      fp.write(ENTRY_HEADER.pack(ENTRY_MAGIC, config.LAYOUT_PARSER_VERSION, len(keys)))
+      for name in key.Key.ARRAY_FIELDS:
+        if isinstance(keys, key.KeyArray):
+          column = keys.columns[name]
+        else:
+          column = array(FIELD_TYPECODES[name], (getattr(k, name) for k in keys))
+        fp.write(column)
+
+    # Swap the entry in atomically, so readers never see a partial file
+    os.replace(tmpPath, path)
+    self.evict()
+
+  @trace.traced
+  def loadLayout(self, path):
+    """ 
+    Returns the keys of a KLE file as a key.KeyArray, parsing it only on a
+    miss
+
+    Parameters:
+
+    path - (str)
+      The path to the KLE JSON file
+    """
+    digest = self.layoutHash(path)
+    keys = self.get(digest)
+
+    if keys is None:
+      keys = key.KeyArray()
+      keys.extendFromWalk(key.iterLayoutFile(path))
+      self.put(digest, keys)
+
+    # Every lookup of this process is written in one go, see saveStatistics()
+    if not self.statsRegistered:
+      self.statsRegistered = True
+      atexit.register(self.saveStatistics)
+
+    return keys
+
+  def evict(self):
+    """ 
+    Remove the least recently used entries until the cache fits in maxBytes.
+    Other processes may evict the same entries meanwhile
+    """
+    entries = []
+    for name in os.listdir(self.cacheDir):
+      if name.endswith(ENTRY_SUFFIX):
+        try:
+          stat = os.stat(os.path.join(self.cacheDir, name))
+        except FileNotFoundError:
+          continue
+        entries.append((stat.st_mtime, stat.st_size, name))
+
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+
+    for _, size, name in entries:
+      if total <= self.maxBytes:
+        break
+      try:
+        os.remove(os.path.join(self.cacheDir, name))
+        self.evictions += 1
+      except FileNotFoundError:
+        pass
+      total -= size
+
+  def statistics(self):
+    """ Returns the hit, miss and eviction counts, including earlier sessions """
+    stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    try:
+      with open(os.path.join(self.cacheDir, STATS_NAME), 'r') as fp:
+        stats.update(json.load(fp))
+    except (OSError, ValueError):
+      pass
+
+    stats['hits'] += self.hits
+    stats['misses'] += self.misses
+    stats['evictions'] += self.evictions
+    return stats
+
+  def saveStatistics(self):
+    """ 
+    Add the statistics of this session to the ones in the cache directory.
+    The file is swapped in whole, so a reader or a crash never leaves half
+    of it. The counts are best-effort: the file is read and written back
+    without a lock, so processes exiting at the same time may drop each
+    other's counts
+    """
+    if not (self.hits or self.misses or self.evictions):
+      return
+
+    stats = self.statistics()
+    path = os.path.join(self.cacheDir, STATS_NAME)
+    tmpPath = "%s.%d.tmp" % (path, os.getpid())
+
+    try:
+      with open(tmpPath, 'w') as fp:
+        json.dump(stats, fp)
+      os.replace(tmpPath, path)
+    except OSError as error:
+      print("Warning: could not save the layout cache statistics:", error)
+      return
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
@@ -14,3 +14,73 @@ ANGLE_SCALING_FACTOR_DEG = -10.0
 UNIT_SPACING_MM = 19.05
 UNIT_SPACING_IN = 0.75
 UNIT_SPACING_MILS = 750
+
+# Bump whenever key.Keyboard.parseLayout() changes its output
+LAYOUT_PARSER_VERSION = 1
+
+# On-disk cache for parsed layouts
+CACHE_DIR = "~/.cache/klepr"
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Parts closer than this to their target pose are left untouched
+PLACEMENT_TOLERANCE_MM = 0.0001
+PLACEMENT_TOLERANCE_ANGLE = 0.01
+
+# Bump whenever the format of saved placement plans changes
+PLAN_FORMAT_VERSION = 1
+PLAN_DIR = "~/.cache/klepr/plans"
+
+# Parts placed per UI event while generating, and how often the elapsed
+# time is refreshed
+GUI_CHUNK_SIZE = 200
+GUI_TIMER_MS = 100
+
+# Quiet time after the last keystroke before the edit dialog previews it
+PREVIEW_DEBOUNCE_MS = 300
+
+# Set this environment variable to trace Generate runs, see trace.py
+TRACE_ENV_VAR = "KLEPR_TRACE"
+
+# Saved boards get a record of their placement hash next to them, so saving
+# the same placement again is skipped
+SAVE_RECORD_SUFFIX = ".save.json"
+
+# Keys and parts overlapping by less than this only touch, see spatial.py
+COLLISION_TOLERANCE_MM = 0.01
+
+# Overlapping pairs listed by the collision check before saving
+COLLISION_REPORT_LIMIT = 10
+
+# How parts are matched to keys: "order" by cluster number, "nearest" by the
+# least total displacement, "aligned" by the least displacement once the parts
+# are lined up with the keys, or "cluster" to match the anchor prefix by
+# displacement and the other prefixes by the anchor's cluster numbers
+ASSIGNMENT_MODES = ("order", "nearest", "aligned", "cluster")
+ASSIGNMENT_ANCHOR_PREFIX = "K"
+
+# Nearest keys considered per part before widening the search
+ASSIGNMENT_CANDIDATES = 8
+
+# In the "aligned" mode, parts are lined up with the keys before matching,
+# unless this share of them already sits on a key, see assign.alignSources().
+# Parts spread out within this ratio of the keys are only moved, not scaled
+ASSIGNMENT_ALIGN_SHARE = 0.5
+ASSIGNMENT_ALIGN_SCALE = 1.25
+
+# Once the nearest keys cover this share of the keys, every part and key
+# pair is solved at once, when there are no more pairs than the limit.
+# Larger problems match what the nearest keys can, then line the rest up with
+# the keys left and match them apart
+ASSIGNMENT_DENSE_SHARE = 0.25
+ASSIGNMENT_DENSE_LIMIT = 40000
+
+# Up to this many part and key pairs, the nearest keys of every part are
+# found by checking every pair instead of searching a grid
+ASSIGNMENT_SCAN_LIMIT = 4000000
+
+# Matrix planning, see matrix.py. Keys of the same rotation closer than the
+# group gap, in key units, share a group such as a thumb cluster. Each row
+# or column costs at least this much trace, so groups share lines when it pays
+MATRIX_GROUP_GAP = 0.6
+MATRIX_PIN_COST_MM = 150.0
+MATRIX_FORMAT_VERSION = 1
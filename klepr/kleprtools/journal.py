@@ -0,0 +1,112 @@
+""" A compact journal of part poses, for undoing placements without reloading the board """
+
+from array import array
+
+class PositionJournal():
+  """
+  Records the pose every part had before it was moved, as typed columns of
+  (reference, x, y, angle). References are stored once in a string table.
+
+  Runs and named checkpoints are offsets into the columns. Rolling back to
+  an offset replays the earliest pose recorded after it for every part,
+  which is the pose the part had at that offset.
+  """
+
+  def __init__(self):
+    self.references = array('I')
+    self.xs = array('d')
+    self.ys = array('d')
+    self.angles = array('d')
+
+    self.strings = []
+    self.stringIndex = {}
+
+    # Offsets where each run starts, and of each named checkpoint
+    self.runs = array('Q')
+    self.checkpoints = {}
+
+  def __len__(self):
+    return len(self.references)
+
+  def nbytes(self):
+    """ Returns the size of the pose columns in bytes """
+    return sum(len(column) * column.itemsize for column in (self.references, self.xs, self.ys, self.angles))
+
+  def record(self, reference, x, y, angle):
+    """
+    Record the pose of a part before it is moved
+
+    Parameters:
+
+    reference - (str)
+      The part reference ("K_11", "LED_34", etc.)
+    x, y - (float)
+      The position in millimetres
+    angle - (float)
+      The orientation in KiCAD angle units
+    """
+    index = self.stringIndex.get(reference)
+    if index is None:
+      index = self.stringIndex[reference] = len(self.strings)
+      self.strings.append(reference)
+
+    self.references.append(index)
+    self.xs.append(x)
+    self.ys.append(y)
+    self.angles.append(angle)
+
+  def beginRun(self):
+    """ Mark the start of a placement run, for undoLastRun() """
+    if not self.runs or self.runs[-1] != len(self):
+      self.runs.append(len(self))
+
+  def lastRunStart(self):
+    """ Returns the offset of the last run with recorded poses, or None """
+    for start in reversed(self.runs):
+      if start < len(self):
+        return start
+    return None
+
+  def checkpoint(self, name):
+    """ Name the current offset, for rolling back to it later """
+    self.checkpoints[name] = len(self)
+
+  def checkpointOffset(self, name):
+    """ Returns the offset of a named checkpoint """
+    if name not in self.checkpoints:
+      raise ValueError("No checkpoint named " + repr(name))
+    return self.checkpoints[name]
+
+  def posesSince(self, offset):
+    """
+    Returns a dict of reference to the (x, y, angle) the part had at an
+    offset, for every part moved after it
+
+    Parameters:
+
+    offset - (int)
+      The offset to roll back to
+    """
+    poses = {}
+    for num in range(offset, len(self)):
+      reference = self.strings[self.references[num]]
+      if reference not in poses:
+        poses[reference] = (self.xs[num], self.ys[num], self.angles[num])
+    return poses
+
+  def truncate(self, offset):
+    """
+    Forget every pose, run and checkpoint recorded after an offset
+
+    Parameters:
+
+    offset - (int)
+      The offset to keep the journal up to
+    """
+    for column in (self.references, self.xs, self.ys, self.angles):
+      del column[offset:]
+
+    while self.runs and self.runs[-1] >= offset:
+      self.runs.pop()
+
+    self.checkpoints = {name: at for name, at in self.checkpoints.items() if at <= offset}
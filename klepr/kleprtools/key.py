@@ -1,11 +1,23 @@
 """ This is a Python implementation of the Keyboard Layout Editor classes """
 
+import os
 import json
 import math
+import mmap
+import struct
 import sys
 import random
+from array import array
 from datetime import datetime
 
+from klepr.kleprtools import trace
+
+# NumPy is optional; KiCAD's bundled Python does not always ship it
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
 def rotateAroundPoint(point, degrees, origin=[0,0]):
   """ Rotate a point [X,Y] around a defined origin [X,Y] """
 
@@ -18,6 +30,205 @@ def rotateAroundPoint(point, degrees, origin=[0,0]):
 
   return qx,qy
 
+def rotateAroundPoints(xs, ys, degrees, origin_xs, origin_ys):
+  """ 
+  Rotate arrays of points around arrays of origins, one angle per point.
+
+  The sine and cosine are only evaluated once per distinct angle, and the
+  arithmetic is ordered exactly as in rotateAroundPoint() so that both
+  functions return bit-identical coordinates.
+
+  Parameters:
+
+  xs, ys - (numpy.ndarray)
+    The X and Y coordinates of the points
+  degrees - (numpy.ndarray)
+    The rotation of each point, in degrees
+  origin_xs, origin_ys - (numpy.ndarray)
+    The X and Y coordinates of the rotation origin of each point
+  """
+  angles, group = np.unique(degrees, return_inverse=True)
+  cos = np.array([math.cos(math.radians(float(a))) for a in angles])[group]
+  sin = np.array([math.sin(math.radians(float(a))) for a in angles])[group]
+
+  dx = xs - origin_xs
+  dy = ys - origin_ys
+  qx = origin_xs + cos*dx - sin*dy
+  qy = origin_ys + cos*dy + sin*dx
+
+  return qx,qy
+
+def iterLayoutRows(fp, chunk_size=65536):
+  """ 
+  Lazily yield the rows of a KLE JSON file, one decoded row at a time.
+
+  Only the row being decoded is held in memory, so arbitrarily large layouts
+  can be streamed from a file or a pipe.
+
+  Parameters:
+
+  fp - (file)
+    A text file object positioned at the start of a KLE JSON array
+  chunk_size - (int)
+    The number of characters read from the file at a time
+  """
+  decoder = json.JSONDecoder()
+  buffer = ""
+  pos = 0
+  eof = False
+  started = False
+
+  while True:
+
+    # Skip whitespace and row separators, reading more when we run dry
+    while pos < len(buffer) and (buffer[pos].isspace() or (started and buffer[pos] == ",")):
+      pos += 1
+    if pos >= len(buffer):
+      if eof:
+        raise ValueError("Unexpected end of KLE layout")
+      chunk = fp.read(chunk_size)
+      buffer = buffer[pos:] + chunk
+      pos = 0
+      eof = (len(chunk) == 0)
+      continue
+
+    if not started:
+      if buffer[pos] != "[":
+        raise ValueError("KLE layout must be a JSON array")
+      started = True
+      pos += 1
+      continue
+
+    if buffer[pos] == "]":
+      return
+
+    # Decode the next row, reading more when it is incomplete. Bare numbers
+    # are only trusted once something follows them
+    try:
+      row, end = decoder.raw_decode(buffer, pos)
+      if end == len(buffer) and not eof and not isinstance(row, (list, dict, str)):
+        raise ValueError
+    except ValueError:
+      if eof:
+        raise
+      chunk = fp.read(chunk_size)
+      buffer = buffer[pos:] + chunk
+      pos = 0
+      eof = (len(chunk) == 0)
+      continue
+
+    # The buffer is only cut when it is refilled, not after every row
+    yield row
+    pos = end
+
+def iterLayoutFile(path, chunk_size=65536):
+  """ 
+  Lazily yield the rows of a KLE JSON file by path. Reads from stdin when the
+  path is "-"
+
+  Parameters:
+
+  path - (str)
+    The path to the KLE JSON file
+  chunk_size - (int)
+    The number of characters read from the file at a time
+  """
+  if path == "-":
+    yield from iterLayoutRows(sys.stdin, chunk_size)
+    return
+
+  with open(path, 'r') as fp:
+    yield from iterLayoutRows(fp, chunk_size)
+
+def walkLayout(layout, state=None):
+  """ 
+  Walk a KLE layout and yield the unrotated geometry of every key, in the
+  order the keys are created.
+
+  Each key is yielded as a tuple of
+  (key_num, x, y, width, height, angle, origin_x, origin_y), where (x, y) is
+  the key centre before rotation and (origin_x, origin_y) is the point it
+  should be rotated around.
+
+  Parameters:
+
+  layout - (iterable)
+    The rows of a KLE layout, either as loaded from its JSON file or
+    streamed by iterLayoutRows()
+  state - (LayoutState)
+    The parser state to start from. It is advanced in place and is up to date
+    at every row boundary, so walking can be resumed from it later
+  """
+  if state is None:
+    state = LayoutState()
+
+  cur_abs = state.cur_abs
+  cur_rel = state.cur_rel
+  cur_angle = state.cur_angle
+  key_width = state.key_width
+  key_height = state.key_height
+  key_num = state.key_num
+
+  # Extract all rows
+  for row in layout:
+    if isinstance(row, list):
+
+      # Set default key size
+      key_width = 1
+      key_height = 1
+
+      # Extract all information from row
+      for item in row:
+
+        # Key descriptors show up as dicts, parse accordingly
+        if isinstance(item, dict):
+
+          for key, value in item.items():
+            if key == "x":
+              cur_abs.x += value
+            if key == "y":
+              cur_abs.y += value
+            if key == "w":
+              key_width = value
+            if key == "h":
+              key_height = value
+            if key == "r":
+              cur_angle = value
+
+            # Edge case, if rx or ry is missing, 
+            # Use current coordinates for rotation point
+            if key == "rx":
+              cur_rel.x = value
+              cur_abs.x = value
+              cur_abs.y = cur_rel.y
+
+            if key == "ry":
+              cur_rel.y = value
+              cur_abs.y = value
+              cur_abs.x = cur_rel.x
+
+        # Keyboard keys show up as str
+        # Yield key based on current key descriptor
+        elif isinstance(item,str):
+          x = cur_abs.x + key_width / 2.0  
+          y = cur_abs.y + key_height / 2.0
+          yield (key_num, x, y, key_width, key_height, cur_angle, cur_rel.x, cur_rel.y)
+
+          # Reset for the next key
+          cur_abs.x += key_width
+          key_height = 1
+          key_width = 1
+          key_num += 1
+          
+      cur_abs.y += 1
+      cur_abs.x = cur_rel.x
+
+    # Record the state at the row boundary
+    state.cur_angle = cur_angle
+    state.key_width = key_width
+    state.key_height = key_height
+    state.key_num = key_num
+
 class Prefix():
   """ Contains additional information about  """
 
@@ -52,10 +263,10 @@ class Prefix():
     """ Export Prefix as JSON """
     return json.dumps(vars(self))
   
-  def Json2Prefix(self, json):
+  def Json2Prefix(self, jsonStr):
     """ Import JSON as a Prefix """
 
-    attribute = json.loads(json)
+    attribute = json.loads(jsonStr)
     self.id = attribute['id']
     self.prefix = attribute['prefix']
     self.off_x = attribute['off_x']
@@ -80,12 +291,30 @@ class PrefixTable():
   def exportPrefixTable(self, outputDir):
     """ Export keyboard information as a JSON """
     table = []
-    for prefix in self.table:
-      table.append(prefix.Prefix2Json)
+    for prefix in self.table.values():
+      table.append(prefix.Prefix2Json())
     
     with open(outputDir + "/refTable.json", "w") as fp:
       json.dump(table, fp)
 
+  def importPrefixTable(self, path):
+    """ 
+    Import a prefix table written by exportPrefixTable(), adding its entries
+    to this table
+
+    Parameters:
+
+    path - (str)
+      The path to the refTable.json file
+    """
+    with open(path, "r") as fp:
+      table = json.load(fp)
+
+    for jsonStr in table:
+      prefix = Prefix()
+      prefix.Json2Prefix(jsonStr)
+      self.table[prefix.id] = prefix
+
 class Point():
   """ Placeholder for XY coordinates """
   
@@ -95,9 +324,44 @@ class Point():
     self.y = y
     self.angle = angle
 
+class LayoutState():
+  """ The state of walkLayout() at a KLE row boundary """
+
+  def __init__(self):
+    self.cur_abs = Point(x=0,y=0)
+    self.cur_rel = Point(x=0,y=0)
+    self.cur_angle = 0
+    self.key_width = 1
+    self.key_height = 1
+    self.key_num = 0
+
+  def astuple(self):
+    """ Returns the state as a flat tuple, for comparisons """
+    return (
+      self.cur_abs.x, self.cur_abs.y, self.cur_rel.x, self.cur_rel.y,
+      self.cur_angle, self.key_width, self.key_height, self.key_num
+    )
+
+  def copy(self):
+    """ Returns an independent snapshot of the state """
+    snapshot = LayoutState()
+    snapshot.cur_abs = Point(x=self.cur_abs.x, y=self.cur_abs.y)
+    snapshot.cur_rel = Point(x=self.cur_rel.x, y=self.cur_rel.y)
+    snapshot.cur_angle = self.cur_angle
+    snapshot.key_width = self.key_width
+    snapshot.key_height = self.key_height
+    snapshot.key_num = self.key_num
+    return snapshot
+
+  def __eq__(self, other):
+    return isinstance(other, LayoutState) and self.astuple() == other.astuple()
+
 class Key():
   """ Information as pertains to each keyswitch. """
 
+  # Attributes computed by Keyboard.parseLayoutArrays(), in order
+  ARRAY_FIELDS = ('ref', 'abs_x', 'abs_y', 'width', 'height', 'angle', 'stab_angle')
+
   def __init__(self, * args, **kwargs):
     self.ref = 0
 
@@ -147,14 +411,380 @@ class Key():
     """ Return JSON-encoded string representation of itself """
     return json.dumps(vars(self))
     
+# Binary coordinate map: header, then each KeyArray column in FIELDS order,
+# then the string table as a JSON list
+COORDINATE_MAP_MAGIC = b"KLEPRCM\0"
+COORDINATE_MAP_VERSION = 1
+COORDINATE_MAP_HEADER = struct.Struct("<8sHHIQQ")
+
+class KeyView():
+  """ 
+  A lightweight view of one key inside a KeyArray. Reads and writes go
+  straight to the columns, and it exposes the same attributes as Key.
+  """
+
+  __slots__ = ('keyArray', 'index')
+
+  def __init__(self, keyArray, index):
+    self.keyArray = keyArray
+    self.index = index
+
+  def Key2Json(self):
+    """ Return JSON-encoded string representation of itself """
+    return json.dumps({name: getattr(self, name) for name in KeyArray.FIELDS})
+
+def _columnProperty(name):
+  """ Returns a property reading and writing a numeric KeyArray column """
+
+  def getter(self):
+    return self.keyArray.columns[name][self.index]
+
+  def setter(self, value):
+    self.keyArray.columns[name][self.index] = value
+
+  return property(getter, setter)
+
+def _stringProperty(name):
+  """ Returns a property reading and writing a string KeyArray column """
+
+  def getter(self):
+    return self.keyArray.strings[self.keyArray.columns[name][self.index]]
+
+  def setter(self, value):
+    self.keyArray.columns[name][self.index] = self.keyArray.internString(value)
+
+  return property(getter, setter)
+
+class KeyArray():
+  """ 
+  Columnar storage for many keys. Each attribute of Key is held in one typed
+  array, and string attributes are stored as indices into a shared table, so
+  a key costs about a hundred bytes instead of a full Python object.
+
+  Iterating or indexing yields KeyView objects for code that wants per-key
+  access. The columns can be read directly through self.columns, or as NumPy
+  arrays without copying through asNumpy().
+  """
+
+  # Every attribute of Key, in the order Key2Json() writes them
+  FIELDS = (
+    'ref', 'abs_x', 'abs_y', 'abs_x2', 'abs_y2', 'angle', 'stab_angle',
+    'width', 'height', 'width2', 'height2', 'switchType', 'stabilizerType'
+  )
+
+  # Array typecode of each column, strings are indices into self.strings
+  TYPECODES = {
+    'ref': 'q',
+    'abs_x': 'd',
+    'abs_y': 'd',
+    'abs_x2': 'd',
+    'abs_y2': 'd',
+    'angle': 'd',
+    'stab_angle': 'd',
+    'width': 'd',
+    'height': 'd',
+    'width2': 'd',
+    'height2': 'd',
+    'switchType': 'I',
+    'stabilizerType': 'I',
+  }
+
+  STRING_FIELDS = ('switchType', 'stabilizerType')
+
+  def __init__(self):
+    self.columns = {name: array(self.TYPECODES[name]) for name in self.FIELDS}
+    self.strings = [""]
+    self.stringIndex = {"": 0}
+
+  def __len__(self):
+    return len(self.columns['ref'])
+
+  def __getitem__(self, index):
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError("KeyArray index out of range")
+    return KeyView(self, index)
+
+  def __iter__(self):
+    for index in range(len(self)):
+      yield KeyView(self, index)
+
+  def internString(self, value):
+    """ Returns the index of a string in the shared string table """
+    try:
+      return self.stringIndex[value]
+    except KeyError:
+      self.stringIndex[value] = len(self.strings)
+      self.strings.append(value)
+      return self.stringIndex[value]
+
+  def append(self, key):
+    """ 
+    Append a key to the end of the array
+
+    Parameters:
+
+    key - (Key or KeyView)
+      The key to be copied into the array
+    """
+    for name in self.FIELDS:
+      value = getattr(key, name)
+      if name in self.STRING_FIELDS:
+        value = self.internString(value)
+      self.columns[name].append(value)
+
+  def extend(self, keys):
+    """ 
+    Append many keys to the end of the array
+
+    Parameters:
+
+    keys - (iterable)
+      The Key or KeyView objects to be copied into the array
+    """
+    for key in keys:
+      self.append(key)
+
+  def extendFromWalk(self, layout):
+    """ 
+    Parse a KLE layout straight into the columns, without creating any Key
+    objects along the way. Produces the same values as Keyboard.iterLayout()
+
+    Parameters:
+
+    layout - (iterable)
+      The rows of a KLE layout, either as loaded from its JSON file or
+      streamed by iterLayoutRows()
+    """
+    columns = self.columns
+    appends = [columns[name].append for name in Key.ARRAY_FIELDS]
+    appendRef, appendX, appendY, appendWidth, appendHeight, appendAngle, appendStabAngle = appends
+
+    for key_num, x, y, key_width, key_height, cur_angle, rel_x, rel_y in walkLayout(layout):
+      abs_x, abs_y = rotateAroundPoint([x,y], cur_angle, [rel_x, rel_y])
+
+      # If keyswitch is vertical, turn it
+      stab_angle = cur_angle + 90 if key_height > key_width else cur_angle
+
+      appendRef(key_num)
+      appendX(abs_x)
+      appendY(abs_y)
+      appendWidth(key_width)
+      appendHeight(key_height)
+      appendAngle(cur_angle)
+      appendStabAngle(stab_angle)
+
+    # Pad the columns that the walk does not fill
+    count = len(columns['ref'])
+    for name in self.FIELDS:
+      missing = count - len(columns[name])
+      if missing > 0:
+        columns[name].extend(array(self.TYPECODES[name], bytes(missing * columns[name].itemsize)))
+
+  def extendColumns(self, arrays):
+    """ 
+    Append whole columns at once, such as the arrays returned by
+    Keyboard.parseLayoutArrays(). Columns that are not given are zeroed
+
+    Parameters:
+
+    arrays - (dict{str : sequence})
+      Equal length sequences of values, keyed by field name
+    """
+    count = len(next(iter(arrays.values())))
+    for name in self.FIELDS:
+      column = self.columns[name]
+      if name not in arrays:
+        column.extend(array(column.typecode, bytes(count * column.itemsize)))
+      elif np is not None and isinstance(arrays[name], np.ndarray):
+        column.frombytes(np.ascontiguousarray(arrays[name], dtype=column.typecode).tobytes())
+      else:
+        column.extend(arrays[name])
+
+  def writeCoordinateMap(self, fp):
+    """ 
+    Write the keys as a binary coordinate map, one bulk write per column.
+    Load it back with loadCoordinateMap()
+
+    Parameters:
+
+    fp - (file)
+      A binary file object to write to
+    """
+    count = len(self)
+    stringTable = json.dumps(self.strings).encode("utf-8")
+
+    # Keep the string table 8-byte aligned after the columns
+    columnBytes = sum(len(column) * column.itemsize for column in self.columns.values())
+    padding = -(COORDINATE_MAP_HEADER.size + columnBytes) % 8
+    stringOffset = COORDINATE_MAP_HEADER.size + columnBytes + padding
+
+    fp.write(COORDINATE_MAP_HEADER.pack(
+      COORDINATE_MAP_MAGIC, COORDINATE_MAP_VERSION, len(self.FIELDS), 0, count, stringOffset
+    ))
+
+    for name in self.FIELDS:
+      column = self.columns[name]
+
+      # The file is always little-endian
+      if sys.byteorder == "big":
+        column = array(column.typecode, column)
+        column.byteswap()
+      fp.write(column)
+
+    fp.write(bytes(padding))
+    fp.write(stringTable)
+
+  def asNumpy(self):
+    """ Returns the numeric columns as NumPy arrays sharing the same memory """
+    if np is None:
+      raise ImportError("asNumpy() requires NumPy")
+
+    return {
+      name: np.frombuffer(self.columns[name], dtype=self.TYPECODES[name])
+      for name in self.FIELDS if name not in self.STRING_FIELDS
+    }
+
+class MappedKeyArray(KeyArray):
+  """ 
+  A read-only KeyArray backed by a memory-mapped binary coordinate map. The
+  columns are views into the mapped file, so nothing is copied on load.
+  """
+
+  def __init__(self, path):
+    """ 
+    Constructor
+
+    Parameters:
+
+    path - (str)
+      The path to a coordinate map written by KeyArray.writeCoordinateMap()
+    """
+    with open(path, 'rb') as fp:
+      self.map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+      magic, version, fieldCount, _, count, stringOffset = COORDINATE_MAP_HEADER.unpack_from(self.map)
+    except struct.error:
+      self.map.close()
+      raise ValueError("Not a KLEPR coordinate map: " + path)
+
+    if magic != COORDINATE_MAP_MAGIC or fieldCount != len(self.FIELDS):
+      self.map.close()
+      raise ValueError("Not a KLEPR coordinate map: " + path)
+    if version != COORDINATE_MAP_VERSION:
+      self.map.close()
+      raise ValueError("Unsupported coordinate map version %d" % version)
+
+    self.count = count
+    self.columns = self.mapColumns(self.FIELDS)
+
+    self.strings = json.loads(self.map[stringOffset:].decode("utf-8"))
+    self.stringIndex = {value: num for num, value in enumerate(self.strings)}
+
+  def mapColumns(self, names):
+    """ Returns views of the named columns into the mapped file """
+    buffer = memoryview(self.map)
+    offset = COORDINATE_MAP_HEADER.size
+    columns = {}
+    for name in self.FIELDS:
+      size = self.count * array(self.TYPECODES[name]).itemsize
+      if name in names:
+        columns[name] = buffer[offset:offset + size].cast(self.TYPECODES[name])
+      offset += size
+    buffer.release()
+    return columns
+
+  def append(self, key):
+    raise TypeError("MappedKeyArray is read-only")
+
+  def extendFromWalk(self, layout):
+    raise TypeError("MappedKeyArray is read-only")
+
+  def extendColumns(self, arrays):
+    raise TypeError("MappedKeyArray is read-only")
+
+  def close(self):
+    """ 
+    Release the column views and unmap the file. The arrays returned by
+    asNumpy() share the mapped memory, so they must be deleted first: while
+    one is alive this raises BufferError, and the array is left open and
+    usable
+    """
+    if self.map.closed:
+      return
+
+    released = []
+    try:
+      for name, column in self.columns.items():
+        column.release()
+        released.append(name)
+      self.map.close()
+    except BufferError:
+      # Map the columns released so far again, so nothing changed
+      self.columns.update(self.mapColumns(released))
+      raise BufferError("Delete the arrays from asNumpy() before closing the coordinate map")
+
+    self.columns = {name: array(self.TYPECODES[name]) for name in self.FIELDS}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+def loadCoordinateMap(path):
+  """ 
+  Load a coordinate map exported by Keyboard.exportCoordinateMap(). Binary
+  maps are memory-mapped into a MappedKeyArray, JSON maps are returned as a
+  list of Key objects
+
+  Parameters:
+
+  path - (str)
+    The path to coordinateMap.json or coordinateMap.kcm
+  """
+  with open(path, 'rb') as fp:
+    magic = fp.read(len(COORDINATE_MAP_MAGIC))
+
+  if magic == COORDINATE_MAP_MAGIC:
+    return MappedKeyArray(path)
+
+  with open(path, 'r') as fp:
+    keys = []
+    for jsonStr in json.load(fp):
+      newKey = Key()
+      newKey.Json2Key(jsonStr)
+      keys.append(newKey)
+    return keys
+
+for _name in KeyArray.FIELDS:
+  if _name in KeyArray.STRING_FIELDS:
+    setattr(KeyView, _name, _stringProperty(_name))
+  else:
+    setattr(KeyView, _name, _columnProperty(_name))
+
 class Keyboard():
   """ Information that pertains to the whole keyboard """
 
-  def __init__(self, name="", author=""):
-    """ Constructor for the circuit """
+  def __init__(self, name="", author="", compact=False):
+    """ 
+    Constructor for the circuit 
+
+    Parameters:
+
+    compact - (bool)
+      Store the keys in a columnar KeyArray instead of a list of Key objects
+    """
 
     # For storing Key Objects
-    self.keys = []
+    self.keys = KeyArray() if compact else []
+
+    # The rows of the last incremental parse, and the parser state at the
+    # start of each row plus the state after the last row
+    self.layoutRows = []
+    self.checkpoints = [LayoutState()]
 
     # Other metadata
     self.name = name
@@ -170,88 +800,225 @@ class Keyboard():
       i.switchType = self.args.switch_type
       i.stabilizerType = self.args.stabilizer_type
 
-  def parseLayout(self, layout):
-    """ Parse the layout information from KLE layout """
+  @trace.traced
+  def parseLayout(self, layout, batch=False):
+    """ 
+    Parse the layout information from KLE layout 
+
+    Parameters:
+
+    layout - (list)
+      The rows of a KLE layout, as loaded from its JSON file
+    batch - (bool)
+      Compute the coordinates with parseLayoutArrays() instead of one key at
+      a time. Falls back to the per-key path when NumPy is not available
+    """
     
     print("Parsing the layout information from KLE layout")
 
-    cur_abs = Point(x=0,y=0)
-    cur_rel = Point(x=0,y=0)
-    cur_angle = 0
-    key_num = 0
-
-    # Extract all rows
-    for row in layout:
-      if isinstance(row, list):
-
-        # Set default key size
-        key_width = 1
-        key_height = 1
-
-        # Extract all information from row
-        for item in row:
-
-          # Key descriptors show up as dicts, parse accordingly
-          if isinstance(item, dict):
-
-            for key, value in item.items():
-              if key == "x":
-                cur_abs.x += value
-              if key == "y":
-                cur_abs.y += value
-              if key == "w":
-                key_width = value
-              if key == "h":
-                key_height = value
-              if key == "r":
-                cur_angle = value
-
-              # Edge case, if rx or ry is missing, 
-              # Use current coordinates for rotation point
-              if key == "rx":
-                cur_rel.x = value
-                cur_abs.x = value
-                cur_abs.y = cur_rel.y
-
-              if key == "ry":
-                cur_rel.y = value
-                cur_abs.y = value
-                cur_abs.x = cur_rel.x
-
-          # Keyboard keys show up as str
-          # Create key based on current key descriptor
-          elif isinstance(item,str):
-            newKey = Key()
-            newKey.ref = key_num
-            newKey.width = key_width
-            newKey.height = key_height
-            newKey.angle = cur_angle
-            newKey.stab_angle = cur_angle
-
-            # If keyswitch is vertical, turn it
-            if key_height > key_width:
-              newKey.stab_angle += 90
-
-            # Calculate the X-Y coordinates, and rotate around reference point
-            x = cur_abs.x + key_width / 2.0  
-            y = cur_abs.y + key_height / 2.0
-            newKey.abs_x, newKey.abs_y = rotateAroundPoint([x,y], cur_angle, [cur_rel.x, cur_rel.y])
-
-            # Add to cache and reset for the next key
-            self.keys.append(newKey)
-            cur_abs.x += key_width
-            key_height = 1
-            key_width = 1
-            key_num += 1
-            
-        cur_abs.y += 1
-        cur_abs.x = cur_rel.x
-
-  def exportCoordinateMap(self, outputDir):
-    """ Export Keyboard as a JSON """
-    coor_map = []
-    for key in self.keys:
-      coor_map.append(key.Key2Json())
-    
+    if isinstance(self.keys, KeyArray):
+      if batch and np is not None:
+        self.keys.extendColumns(self.parseLayoutArrays(layout))
+      else:
+        self.keys.extendFromWalk(layout)
+      return
+
+    if batch and np is not None:
+      arrays = self.parseLayoutArrays(layout)
+      columns = zip(*(arrays[name].tolist() for name in Key.ARRAY_FIELDS))
+      for ref, abs_x, abs_y, width, height, angle, stab_angle in columns:
+        newKey = Key()
+        newKey.ref = ref
+        newKey.abs_x = abs_x
+        newKey.abs_y = abs_y
+        newKey.width = width
+        newKey.height = height
+        newKey.angle = angle
+        newKey.stab_angle = stab_angle
+        self.keys.append(newKey)
+      return
+
+    self.keys.extend(self.iterLayout(layout))
+
+  def iterLayout(self, layout, state=None):
+    """ 
+    Lazily yield a Key for every key of a KLE layout, without storing them.
+
+    Parameters:
+
+    layout - (iterable)
+      The rows of a KLE layout, either as loaded from its JSON file or
+      streamed by iterLayoutRows()
+    state - (LayoutState)
+      The parser state to start from, see walkLayout()
+    """
+    for key_num, x, y, key_width, key_height, cur_angle, rel_x, rel_y in walkLayout(layout, state):
+      newKey = Key()
+      newKey.ref = key_num
+      newKey.width = key_width
+      newKey.height = key_height
+      newKey.angle = cur_angle
+      newKey.stab_angle = cur_angle
+
+      # If keyswitch is vertical, turn it
+      if key_height > key_width:
+        newKey.stab_angle += 90
+
+      # Rotate around reference point
+      newKey.abs_x, newKey.abs_y = rotateAroundPoint([x,y], cur_angle, [rel_x, rel_y])
+
+      yield newKey
+
+  @trace.traced
+  def reparseLayout(self, layout):
+    """ 
+    Parse a KLE layout incrementally against the previous call, and return
+    the sorted indices of the keys that changed.
+
+    The parser state is checkpointed at every row boundary. Parsing resumes
+    from the first row that differs from the previous layout, reusing the
+    keys before it, and stops early once the rows after the edit reach a
+    checkpoint identical to the previous parse. Indices of keys that were
+    removed from the end of the layout are reported too.
+
+    The rows are kept for comparison on the next call, so they must not be
+    modified in place afterwards.
+
+    Parameters:
+
+    layout - (iterable)
+      The rows of a KLE layout, either as loaded from its JSON file or
+      streamed by iterLayoutRows()
+    """
+    if isinstance(self.keys, KeyArray):
+      raise TypeError("reparseLayout() requires a Keyboard storing Key objects")
+
+    layout = list(layout)
+    oldRows = self.layoutRows
+    oldCheckpoints = self.checkpoints
+    oldKeys = self.keys
+
+    # Rows before start are unchanged
+    start = 0
+    limit = min(len(layout), len(oldRows))
+    while start < limit and layout[start] == oldRows[start]:
+      start += 1
+
+    # Rows from end onwards are unchanged, shifted by the number of added rows
+    shift = len(layout) - len(oldRows)
+    end = len(layout)
+    while end > start and end - 1 - shift >= start and layout[end - 1] == oldRows[end - 1 - shift]:
+      end -= 1
+
+    state = oldCheckpoints[start].copy()
+    keys = oldKeys[:state.key_num]
+    checkpoints = oldCheckpoints[:start]
+
+    for num in range(start, len(layout)):
+
+      # Past the edit, reuse the previous parse once the states line up again
+      if num >= end and state == oldCheckpoints[num - shift]:
+        keys.extend(oldKeys[state.key_num:])
+        checkpoints.extend(oldCheckpoints[num - shift:])
+        break
+
+      checkpoints.append(state.copy())
+      keys.extend(self.iterLayout([layout[num]], state))
+
+    else:
+      checkpoints.append(state.copy())
+
+    # Report every index whose key is new, gone or different
+    changed = []
+    for num in range(oldCheckpoints[start].key_num, max(len(keys), len(oldKeys))):
+      if num >= len(keys) or num >= len(oldKeys):
+        changed.append(num)
+      elif keys[num] is not oldKeys[num] and vars(keys[num]) != vars(oldKeys[num]):
+        changed.append(num)
+
+    self.layoutRows = layout
+    self.checkpoints = checkpoints
+    self.keys = keys
+
+    return changed
+
+  def parseLayoutArrays(self, layout):
+    """ 
+    Parse the KLE layout into flat NumPy arrays without creating Key objects.
+
+    The layout is walked once into flat arrays, then every key is rotated in a
+    single vectorized operation. Returns a dict of arrays keyed by the Key
+    attribute names: ref, abs_x, abs_y, width, height, angle and stab_angle.
+
+    Parameters:
+
+    layout - (list)
+      The rows of a KLE layout, as loaded from its JSON file
+    """
+    if np is None:
+      raise ImportError("parseLayoutArrays() requires NumPy")
+
+    # One column per field yielded by walkLayout()
+    columns = [[] for _ in range(8)]
+    for walked in walkLayout(layout):
+      for column, value in zip(columns, walked):
+        column.append(value)
+
+    ref, x, y, width, height, angle, rel_x, rel_y = (np.asarray(c) for c in columns)
+    abs_x, abs_y = rotateAroundPoints(
+      x.astype(float), y.astype(float), angle, rel_x.astype(float), rel_y.astype(float)
+    )
+
+    # If keyswitch is vertical, turn it
+    stab_angle = angle + np.where(height > width, 90, 0)
+
+    return {
+      'ref': ref.astype(int),
+      'abs_x': abs_x,
+      'abs_y': abs_y,
+      'width': width,
+      'height': height,
+      'angle': angle,
+      'stab_angle': stab_angle,
+    }
+
+  @trace.traced
+  def exportCoordinateMap(self, outputDir, keys=None, fileFormat="json"):
+    """ 
+    Export Keyboard as a coordinate map. JSON keys are written one at a
+    time, so a stream from iterLayout() can be exported without holding it
+    in memory
+
+    Parameters:
+
+    outputDir - (str)
+      The output directory for the coordinate map
+    keys - (iterable)
+      The Key objects to export. Defaults to the keys of this Keyboard
+    fileFormat - (str)
+      "json" for coordinateMap.json, or "binary" for the memory-mappable
+      coordinateMap.kcm read by loadCoordinateMap()
+    """
+    if keys is None:
+      keys = self.keys
+
+    if fileFormat == "binary":
+      if not isinstance(keys, KeyArray):
+        keyArray = KeyArray()
+        keyArray.extend(keys)
+        keys = keyArray
+
+      with open(os.path.join(outputDir, "coordinateMap.kcm"), "wb") as fp:
+        keys.writeCoordinateMap(fp)
+      return
+
+    if fileFormat != "json":
+      raise ValueError("Unknown coordinate map format: " + str(fileFormat))
+
     with open(outputDir + "/coordinateMap.json", "w") as fp:
-      json.dump(coor_map, fp)
\ No newline at end of file
+      fp.write("[")
+      for num, key in enumerate(keys):
+        if num > 0:
+          fp.write(", ")
+        fp.write(json.dumps(key.Key2Json()))
+      fp.write("]")
@@ -0,0 +1,466 @@
+""" Switch matrix planning: a row and column for every key, keeping the traces short """
+
+import os
+import json
+
+from klepr.kleprtools import config
+from klepr.kleprtools import key
+from klepr.kleprtools import spatial
+
+# NumPy is optional; KiCAD's bundled Python does not always ship it
+try:
+  import numpy as np
+except ImportError:
+  np = None
+
+# Offsets tried when snapping keys to rows and columns, in key units
+SNAP_PHASES = (0.25, 0.5, 0.75)
+
+def keyArrays(layout):
+  """
+  Returns the abs_x, abs_y, width, height and angle of the keys of a layout
+  as NumPy arrays, in key units and degrees
+
+  Parameters:
+
+  layout - (key.Keyboard or iterable)
+    The keys, as taken by pcb.iterPartPoses()
+  """
+  keys = layout.keys if isinstance(layout, key.Keyboard) else layout
+
+  if isinstance(keys, key.KeyArray):
+    columns = keys.asNumpy()
+    return tuple(columns[name].astype(float) for name in ('abs_x', 'abs_y', 'width', 'height', 'angle'))
+
+  keys = list(keys)
+  return tuple(
+    np.array([getattr(k, name) for k in keys], dtype=float)
+    for name in ('abs_x', 'abs_y', 'width', 'height', 'angle')
+  )
+
+def groupKeys(abs_x, abs_y, width, height, angle):
+  """
+  Returns the group of every key: keys with the same rotation whose edges
+  are closer than config.MATRIX_GROUP_GAP belong to the same group, such as
+  one half of a split board or one thumb cluster. Neighbours are found with
+  a spatial.SpatialGrid of the grown keys
+
+  Parameters:
+
+  abs_x, abs_y, width, height, angle - (numpy.ndarray)
+    The keys, see keyArrays()
+  """
+  gap = config.MATRIX_GROUP_GAP
+  boxes = [
+    spatial.keyBox(x, y, w + gap, h + gap, a)
+    for x, y, w, h, a in zip(abs_x.tolist(), abs_y.tolist(), width.tolist(), height.tolist(), angle.tolist())
+  ]
+  rotation = np.round(angle, 3).tolist()
+  pairs = spatial.buildGrid(boxes).collisions(0.0, lambda i, j: rotation[i] == rotation[j])
+
+  # Union-find over the touching pairs
+  parents = list(range(len(boxes)))
+
+  def root(index):
+    while parents[index] != index:
+      parents[index] = parents[parents[index]]
+      index = parents[index]
+    return index
+
+  for i, j in pairs:
+    parents[root(i)] = root(j)
+
+  return np.unique([root(index) for index in range(len(boxes))], return_inverse=True)[1].reshape(-1)
+
+def snapLines(along, across, rowPhase, columnPhase):
+  """
+  Returns the row and column of every key of a group. Rows snap the
+  coordinate across the rows to whole key units; columns snap the coordinate
+  along them, and keys sharing a column within a row are pushed to the next
+  columns, so every (row, column) holds one key
+
+  Parameters:
+
+  along, across - (numpy.ndarray)
+    The key centres along and across the rows, in key units
+  rowPhase, columnPhase - (float)
+    Where between two units a key moves to the next row or column
+  """
+  count = len(along)
+  rows = np.floor(across - across.min() + rowPhase).astype(np.int64)
+  columns = np.floor(along - along.min() + columnPhase).astype(np.int64)
+
+  order = np.lexsort((along, rows))
+  sortedRows = rows[order]
+
+  # Rank of every key within its row
+  starts = np.flatnonzero(np.r_[True, sortedRows[1:] != sortedRows[:-1]])
+  rank = np.arange(count) - np.repeat(starts, np.diff(np.r_[starts, count]))
+
+  # column = max(snapped, previous + 1) along each row, as a running maximum
+  # of column - rank, with every row lifted above the ones before it
+  lift = 2 * (count + int(columns.max()) + 1)
+  running = np.maximum.accumulate(columns[order] - rank + sortedRows * lift)
+
+  pushed = np.empty(count, dtype=np.int64)
+  pushed[order] = running - sortedRows * lift + rank
+  return rows, pushed
+
+def compactLines(labels, position):
+  """
+  Returns labels renumbered from 0 without gaps, ordered by the mean
+  position of their keys
+
+  Parameters:
+
+  labels - (numpy.ndarray)
+    The row or column of every key
+  position - (numpy.ndarray)
+    The key coordinate to order the lines by
+  """
+  unique, inverse = np.unique(labels, return_inverse=True)
+  inverse = inverse.reshape(-1)
+  means = np.bincount(inverse, weights=position) / np.bincount(inverse)
+  rank = np.empty(len(unique), dtype=np.int64)
+  rank[np.argsort(means, kind='stable')] = np.arange(len(unique))
+  return rank[inverse]
+
+def lineLength(labels, x, y):
+  """
+  Returns the length of the traces joining the keys of every line in turn,
+  in the units of x and y. The keys of a line are joined in order along the
+  axis the line spreads furthest on, so turned lines are not zigzagged
+
+  Parameters:
+
+  labels - (numpy.ndarray)
+    The row or column of every key
+  x, y - (numpy.ndarray)
+    The key centres
+  """
+  if len(labels) < 2:
+    return 0.0
+
+  unique, inverse = np.unique(labels, return_inverse=True)
+  inverse = inverse.reshape(-1)
+
+  spread = []
+  for values in (x, y):
+    low = np.full(len(unique), np.inf)
+    high = np.full(len(unique), -np.inf)
+    np.minimum.at(low, inverse, values)
+    np.maximum.at(high, inverse, values)
+    spread.append(high - low)
+
+  along = np.where((spread[0] >= spread[1])[inverse], x, y)
+  order = np.lexsort((along, inverse))
+  same = inverse[order][1:] == inverse[order][:-1]
+  return float(np.hypot(np.diff(x[order]), np.diff(y[order]))[same].sum())
+
+def matrixCost(rows, columns, x, y, pinCost):
+  """
+  Returns the estimated cost of a matrix: the length of every row and
+  column trace plus the cost of a pin for every line
+
+  Parameters:
+
+  rows, columns - (numpy.ndarray)
+    The row and column of every key
+  x, y - (numpy.ndarray)
+    The key centres in millimetres
+  pinCost - (float)
+    The cost of one more row or column, in millimetres of trace
+  """
+  lines = len(np.unique(rows)) + len(np.unique(columns))
+  return lineLength(rows, x, y) + lineLength(columns, x, y) + pinCost * lines
+
+def matchLines(sources, targets):
+  """
+  Returns the index of the target matched to every source, or None for
+  sources left over when there are more sources than targets, minimizing the
+  total distance. On a line the best matching never crosses, so it is found
+  over the sorted points, one row of partial costs at a time
+
+  Parameters:
+
+  sources, targets - (list)
+    The positions of the points
+  """
+  transposed = len(sources) > len(targets)
+  rows, columns = (targets, sources) if transposed else (sources, targets)
+  if not rows:
+    return [None] * len(sources)
+
+  rowOrder = np.argsort(rows, kind='stable')
+  columnOrder = np.argsort(columns, kind='stable')
+  a = np.asarray(rows, dtype=float)[rowOrder]
+  b = np.asarray(columns, dtype=float)[columnOrder]
+
+  # costs[i, j] is the best cost of the first i + 1 rows with row i on
+  # column j; the running minimum gives the best with row i on column j or
+  # before it
+  costs = np.empty((len(a), len(b)))
+  best = np.zeros(len(b))
+  for i in range(len(a)):
+    costs[i] = np.abs(b - a[i])
+    if i > 0:
+      costs[i, :i] = np.inf
+      costs[i, i:] += best[i - 1:-1]
+    best = np.minimum.accumulate(costs[i])
+
+  col4row = [0] * len(a)
+  limit = len(b)
+  for i in range(len(a) - 1, -1, -1):
+    limit = int(np.argmin(costs[i, :limit]))
+    col4row[rowOrder[i]] = int(columnOrder[limit])
+
+  if not transposed:
+    return col4row
+
+  matched = [None] * len(sources)
+  for row, column in enumerate(col4row):
+    matched[column] = row
+  return matched
+
+def mapLines(groupMeans, globalMeans):
+  """
+  Returns the line of the matrix each line of a group joins, matched by
+  mean position with matchLines(). Group lines left over get new lines
+  after the existing ones
+
+  Parameters:
+
+  groupMeans, globalMeans - (list)
+    The mean position of every line
+  """
+  mapping = []
+  extra = len(globalMeans)
+  for line in matchLines(groupMeans, globalMeans):
+    if line is None:
+      line = extra
+      extra += 1
+    mapping.append(line)
+  return np.array(mapping, dtype=np.int64)
+
+def onLines(labels, lines):
+  """
+  Returns a mask of the keys on any of some lines, like numpy.isin() with a
+  lookup table. Keys without a line yet, labelled -1, are never on one
+  """
+  hit = np.zeros(max(int(labels.max()), int(lines.max())) + 2, dtype=bool)
+  hit[lines] = True
+  return hit[labels]
+
+def lineMeans(labels, position):
+  """ Returns the mean position of the keys of every line, by line number """
+  return (np.bincount(labels, weights=position) / np.maximum(np.bincount(labels), 1)).tolist()
+
+class MatrixPlan():
+  """
+  The switch matrix of a layout: the row and column of every key, in key
+  order, and the estimated length of the row and column traces
+  """
+
+  def __init__(self, rows, columns, length):
+    """
+    Constructor
+
+    Parameters:
+
+    rows, columns - (list)
+      The row and column of every key, in key order
+    length - (float)
+      The estimated length of the row and column traces, in millimetres
+    """
+    self.rows = list(rows)
+    self.columns = list(columns)
+    self.length = length
+
+  def __len__(self):
+    return len(self.rows)
+
+  def rowCount(self):
+    return max(self.rows) + 1 if self.rows else 0
+
+  def columnCount(self):
+    return max(self.columns) + 1 if self.columns else 0
+
+  def grid(self):
+    """ Returns the key number at every row and column, or None """
+    grid = [[None] * self.columnCount() for _ in range(self.rowCount())]
+    for num, (row, column) in enumerate(zip(self.rows, self.columns)):
+      grid[row][column] = num
+    return grid
+
+  def references(self, clusters=None):
+    """
+    Returns the reference of the switch of every key: the nth key is the
+    switch with the nth cluster number, like compilePlan() places them
+
+    Parameters:
+
+    clusters - (list)
+      The cluster numbers of the switches, see netlist.readNetlistPrefixes().
+      Defaults to numbering the keys from 0
+    """
+    prefix = config.ASSIGNMENT_ANCHOR_PREFIX + "_"
+    if clusters is None:
+      return [prefix + str(num) for num in range(len(self))]
+    return [prefix + str(cluster) for cluster in clusters[:len(self)]]
+
+  def nets(self, clusters=None):
+    """
+    Returns a dict of net name to the references of the switches on it,
+    with one ROW<n> and one COL<n> net per line
+
+    Parameters:
+
+    clusters - (list)
+      See references()
+    """
+    nets = {}
+    for row in range(self.rowCount()):
+      nets["ROW%d" % row] = []
+    for column in range(self.columnCount()):
+      nets["COL%d" % column] = []
+
+    for reference, row, column in zip(self.references(clusters), self.rows, self.columns):
+      nets["ROW%d" % row].append(reference)
+      nets["COL%d" % column].append(reference)
+    return nets
+
+  def save(self, path, clusters=None):
+    """
+    Write the matrix to a JSON file: the row and column of every key, the
+    key at every row and column, and the switches of every row and column
+    net, for generating the netlist
+
+    Parameters:
+
+    path - (str)
+      The path of the matrix file
+    clusters - (list)
+      See references()
+    """
+    tmpPath = path + ".tmp"
+    with open(tmpPath, 'w') as fp:
+      json.dump({
+        'version': config.MATRIX_FORMAT_VERSION,
+        'rows': self.rowCount(),
+        'columns': self.columnCount(),
+        'length_mm': round(self.length, 3),
+        'keys': [
+          {'key': num, 'reference': reference, 'row': row, 'column': column}
+          for num, (reference, row, column) in enumerate(zip(self.references(clusters), self.rows, self.columns))
+        ],
+        'grid': self.grid(),
+        'nets': self.nets(clusters),
+      }, fp, indent=1)
+    os.replace(tmpPath, path)
+
+def planMatrix(layout, pinCost=None):
+  """
+  Plan the switch matrix of a layout. Keys are split into groups of the same
+  rotation, such as the halves and thumb clusters of a split board. Each
+  group is snapped to rows and columns in its own rotated frame, keeping
+  the snap with the cheapest traces. Groups are then added largest first,
+  sharing the rows of the matrix, sharing its columns, or taking new ones,
+  whichever costs least. Returns a MatrixPlan
+
+  Parameters:
+
+  layout - (key.Keyboard or iterable)
+    The keys, as taken by pcb.iterPartPoses()
+  pinCost - (float)
+    The cost of one more row or column, in millimetres of trace. Higher
+    costs share more lines between groups. Defaults to the route of a line
+    to the controller: half the diagonal of the layout, and at least
+    config.MATRIX_PIN_COST_MM
+  """
+  if np is None:
+    raise ImportError("planMatrix() requires NumPy")
+
+  abs_x, abs_y, width, height, angle = keyArrays(layout)
+  count = len(abs_x)
+  if count == 0:
+    return MatrixPlan([], [], 0.0)
+
+  x = abs_x * config.UNIT_SPACING_MM
+  y = abs_y * config.UNIT_SPACING_MM
+  groups = groupKeys(abs_x, abs_y, width, height, angle)
+
+  if pinCost is None:
+    pinCost = max(config.MATRIX_PIN_COST_MM, float(np.hypot(np.ptp(x), np.ptp(y))) / 2.0)
+
+  rows = np.full(count, -1, dtype=np.int64)
+  columns = np.full(count, -1, dtype=np.int64)
+  rowTotal = 0
+  columnTotal = 0
+
+  for group in np.argsort(-np.bincount(groups), kind='stable'):
+    members = np.flatnonzero(groups == group)
+    gx = x[members]
+    gy = y[members]
+
+    # Snap in the frame of the group, where its rows are horizontal
+    radians = np.radians(angle[members[0]])
+    along = np.cos(radians) * abs_x[members] + np.sin(radians) * abs_y[members]
+    across = np.cos(radians) * abs_y[members] - np.sin(radians) * abs_x[members]
+
+    snaps = []
+    for rowPhase in SNAP_PHASES:
+      for columnPhase in SNAP_PHASES:
+        groupRows, groupColumns = snapLines(along, across, rowPhase, columnPhase)
+        snaps.append((matrixCost(groupRows, groupColumns, gx, gy, pinCost), groupRows, groupColumns))
+    _, groupRows, groupColumns = min(snaps, key=lambda snap: snap[0])
+    groupRows = compactLines(groupRows, across)
+    groupColumns = compactLines(groupColumns, along)
+
+    if rowTotal == 0:
+      rows[members] = groupRows
+      columns[members] = groupColumns
+      rowTotal = int(groupRows.max()) + 1
+      columnTotal = int(groupColumns.max()) + 1
+      continue
+
+    placed = rows >= 0
+    rowMap = mapLines(lineMeans(groupRows, gy), lineMeans(rows[placed], y[placed]))
+    columnMap = mapLines(lineMeans(groupColumns, gx), lineMeans(columns[placed], x[placed]))
+
+    options = (
+      (rowMap[groupRows], groupColumns + columnTotal),
+      (groupRows + rowTotal, columnMap[groupColumns]),
+      (groupRows + rowTotal, groupColumns + columnTotal),
+    )
+
+    def linesLength(keys, optionRows, optionColumns):
+      inRows = keys & onLines(rows, optionRows)
+      inColumns = keys & onLines(columns, optionColumns)
+      return (
+        lineLength(rows[inRows], x[inRows], y[inRows]) +
+        lineLength(columns[inColumns], x[inColumns], y[inColumns])
+      )
+
+    grown = placed.copy()
+    grown[members] = True
+
+    # Only the lines the group joins change length, so compare the options
+    # by how much they add to those lines, and by the lines they add
+    best = None
+    for optionRows, optionColumns in options:
+      rows[members] = optionRows
+      columns[members] = optionColumns
+
+      newLines = np.count_nonzero(np.unique(optionRows) >= rowTotal) + np.count_nonzero(np.unique(optionColumns) >= columnTotal)
+      cost = linesLength(grown, optionRows, optionColumns) - linesLength(placed, optionRows, optionColumns) + pinCost * newLines
+      if best is None or cost < best[0]:
+        best = (cost, optionRows, optionColumns)
+
+    rows[members] = best[1]
+    columns[members] = best[2]
+    rowTotal = int(rows.max()) + 1
+    columnTotal = int(columns.max()) + 1
+
+  rows = compactLines(rows, y)
+  columns = compactLines(columns, x)
+  return MatrixPlan(rows.tolist(), columns.tolist(), lineLength(rows, x, y) + lineLength(columns, x, y))
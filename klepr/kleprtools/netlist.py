@@ -0,0 +1,173 @@
+""" Streaming reader for KiCAD and SKiDL netlists (.net files) """
+
+import re
+import sys
+import math
+import random
+
+from klepr.kleprtools import key
+from klepr.kleprtools import pcb
+from klepr.kleprtools import trace
+
+# Parentheses, quoted strings and bare atoms of an s-expression, like
+# board.TOKEN_RE on text
+TOKEN_RE = re.compile(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()"]+')
+
+def iterNetlistTokens(fp, chunk_size=65536):
+  """
+  Lazily yield the tokens of an s-expression file, reading one chunk at a
+  time. A token cut by the end of a chunk is held back until the next one
+
+  Parameters:
+
+  fp - (file)
+    A text file object
+  chunk_size - (int)
+    The number of characters read from the file at a time
+  """
+  buffer = ""
+  eof = False
+
+  while not eof:
+    chunk = fp.read(chunk_size)
+    eof = (len(chunk) == 0)
+    buffer += chunk
+
+    pos = 0
+    for match in TOKEN_RE.finditer(buffer):
+
+      # Only whitespace is skipped between tokens, anything else is the start
+      # of a string the chunk cut off
+      if not eof and '"' in buffer[pos:match.start()]:
+        break
+      if not eof and match.end() == len(buffer):
+        break
+      yield match.group()
+      pos = match.end()
+
+    buffer = buffer[pos:]
+
+def iterNetlistReferences(path):
+  """
+  Lazily yield the reference of every component in a netlist, in file order.
+  The (comp) and (ref) lists may span lines, and the reference may be quoted
+
+  Parameters:
+
+  path - (str)
+    The path to the .net file
+  """
+  depth = 0
+  compDepth = None
+  previous = None
+  inRef = False
+
+  with open(path, 'r') as fp:
+    for token in iterNetlistTokens(fp):
+      if token == '(':
+        depth += 1
+      elif token == ')':
+        if depth == compDepth:
+          compDepth = None
+        depth -= 1
+      elif inRef:
+        yield token[1:-1] if token.startswith('"') else token
+        inRef = False
+      elif previous == '(':
+        if token == 'comp' and compDepth is None:
+          compDepth = depth
+
+        # Nets refer to components too, only take the (ref) of a (comp)
+        elif token == 'ref' and compDepth is not None and depth == compDepth + 1:
+          inRef = True
+
+      previous = token
+
+@trace.traced
+def readNetlistPrefixes(path):
+  """
+  Returns a dict of prefix to the sorted cluster numbers of its components,
+  without loading the board. Prefixes are keyed like
+  pcb.Klepr.GetReferenceIndex(), without the underscore; clusters that are
+  not numbers are kept as strings and sorted last
+
+  Parameters:
+
+  path - (str)
+    The path to the .net file
+  """
+  references = {}
+  for reference in iterNetlistReferences(path):
+    references.setdefault(reference.partition('_')[0], []).append(reference)
+
+  # Sort like the board, then keep the clusters
+  prefixes = {}
+  for prefix, names in references.items():
+    names.sort(key=pcb.referenceSortKey)
+    clusters = (name.partition('_')[2] for name in names)
+    prefixes[prefix] = [int(cluster) if cluster.isdigit() else cluster for cluster in clusters]
+
+  return prefixes
+
+def countNetlistParts(path):
+  """
+  Returns a dict of prefix to the number of components with that prefix
+
+  Parameters:
+
+  path - (str)
+    The path to the .net file
+  """
+  return {prefix: len(clusters) for prefix, clusters in readNetlistPrefixes(path).items()}
+
+def fillPrefixTable(prefixes, prefixTable=None):
+  """
+  Add a zero-offset Prefix entry for every netlist prefix missing from a
+  prefix table, and return the table
+
+  Parameters:
+
+  prefixes - (dict)
+    The prefixes returned by readNetlistPrefixes()
+  prefixTable - (key.PrefixTable)
+    The table to fill. A new one is created when not given
+  """
+  if prefixTable is None:
+    prefixTable = key.PrefixTable()
+
+  existing = set(entry.prefix.split('_')[0] for entry in prefixTable.table.values())
+  for prefix in sorted(prefixes):
+    if prefix in existing:
+      continue
+
+    newRef = key.Prefix(obj_id=math.ceil(random.random()*sys.maxsize), prefix=prefix + '_')
+    prefixTable.table[newRef.id] = newRef
+
+  return prefixTable
+
+def checkKeyCounts(prefixes, keyCount, prefixTable=None):
+  """
+  Returns a dict of prefix to (part count, key count) for every prefix whose
+  number of components does not match the number of keys of the layout
+
+  Parameters:
+
+  prefixes - (dict)
+    The prefixes returned by readNetlistPrefixes()
+  keyCount - (int)
+    The number of keys in the KLE layout
+  prefixTable - (key.PrefixTable)
+    Only check the prefixes of this table. Checks every prefix when not given
+  """
+  if prefixTable is None:
+    checked = prefixes.keys()
+  else:
+    checked = [entry.prefix.split('_')[0] for entry in prefixTable.table.values()]
+
+  mismatches = {}
+  for prefix in checked:
+    partCount = len(prefixes.get(prefix, []))
+    if partCount != keyCount:
+      mismatches[prefix] = (partCount, keyCount)
+
+  return mismatches
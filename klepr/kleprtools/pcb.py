@@ -1,18 +1,203 @@
+import os
 import sys
+import json
 import math
 import random
-import pcbnew
+from concurrent.futures import Future
+from klepr.kleprtools import assign
 from klepr.kleprtools import config
+from klepr.kleprtools import journal
 from klepr.kleprtools import key
+from klepr.kleprtools import spatial
+from klepr.kleprtools import trace
+
+# PCBNew is only available inside KiCAD, see board.HeadlessKlepr otherwise
+try:
+  import pcbnew
+except ImportError:
+  pcbnew = None
+
+def iterPartPoses(layout, prefixTable):
+  """
+  Yield the pose of the part of every prefix for every key, as
+  (key index, key.Prefix, x, y, angle) tuples in millimetres and KiCAD
+  angles. Does not need a board
+
+  Parameters:
+
+  layout - (key.Keyboard or iterable)
+    List of Key objects containing XY coordinates AND numerical references.
+    Either a key.Keyboard, a key.KeyArray, or a stream of Key objects such
+    as the one returned by key.Keyboard.iterLayout(). The keys are only
+    walked once
+
+  prefixTable - (key.PrefixTable)
+    List of part prefixes 
+  """
+  entries = list(prefixTable.table.values())
+  keys = layout.keys if isinstance(layout, key.Keyboard) else layout
+
+  # Read columnar key stores directly, without a view per key
+  if isinstance(keys, key.KeyArray):
+    coordinates = zip(keys.columns['abs_x'], keys.columns['abs_y'], keys.columns['angle'])
+  else:
+    coordinates = ((k.abs_x, k.abs_y, k.angle) for k in keys)
+
+  for num, (abs_x, abs_y, angle) in enumerate(coordinates):
+    cur_x = float(abs_x * config.UNIT_SPACING_MM)
+    cur_y = float(abs_y * config.UNIT_SPACING_MM)
+
+    for entry in entries:
+
+      # Calculate the specified offsets for given prefix
+      off_x = cur_x + float(entry.off_x)
+      off_y = cur_y + float(entry.off_y)
+      off_x, off_y = key.rotateAroundPoint([off_x, off_y], angle,[cur_x, cur_y])
+      off_angle = float((float(angle) + float(entry.angle)) * config.ANGLE_SCALING_FACTOR_DEG)
+
+      yield num, entry, off_x, off_y, off_angle
+
+def referenceSortKey(reference):
+  """ 
+  Sort key for a part reference by its numeric cluster suffix, so "K_10"
+  sorts after "K_9". References without a numeric suffix sort last
+
+  Parameters:
+
+  reference - (str)
+    The part reference ("K_11", "LED_34", etc.)
+  """
+  suffix = reference.partition('_')[2]
+  if suffix.isdigit():
+    return (0, int(suffix), "")
+  return (1, 0, suffix)
+
+def computePrefixPoses(layout, prefixTable):
+  """
+  Returns a dict of prefix, without the underscore, to the (x, y, angle) pose
+  of its part for every key, in key order. Only the layout is read, so this
+  can run on a different thread than the one owning the board
+
+  Parameters:
+
+  layout - (key.Keyboard or iterable)
+    The keys, as taken by iterPartPoses()
+
+  prefixTable - (key.PrefixTable)
+    List of part prefixes 
+  """
+  poses = {}
+  for num, entry, x, y, angle in iterPartPoses(layout, prefixTable):
+    keyPoses = poses.setdefault(entry.prefix.split('_')[0], [])
+
+    # A later entry for the same prefix wins, like on the board
+    if num < len(keyPoses):
+      keyPoses[num] = (x, y, angle)
+    else:
+      keyPoses.append((x, y, angle))
+
+  return poses
+
+def reportKeyCollisions(boxes, tolerance=config.COLLISION_TOLERANCE_MM):
+  """
+  Print a warning for the keys that overlap, up to
+  config.COLLISION_REPORT_LIMIT pairs. Returns the (i, j) index pairs
+
+  Parameters:
+
+  boxes - (iterable)
+    The box of every key, see spatial.iterKeyBoxes()
+  tolerance - (float)
+    See spatial.boxesOverlap()
+  """
+  keyCollisions = spatial.buildGrid(boxes).collisions(tolerance)
+  for first, second in keyCollisions[:config.COLLISION_REPORT_LIMIT]:
+    print("Warning: keys %d and %d overlap" % (first, second))
+  if len(keyCollisions) > config.COLLISION_REPORT_LIMIT:
+    print("Warning: %d more pairs of keys overlap" % (len(keyCollisions) - config.COLLISION_REPORT_LIMIT))
+
+  return keyCollisions
+
+def isSaved(name, digest):
+  """
+  Returns whether a file was last saved with a placement hash, and has not
+  been touched since
+
+  Parameters:
+
+  name - (str)
+    The path of the saved board
+  digest - (str)
+    The placement hash, see Klepr.PrepareSave()
+  """
+  try:
+    with open(name + config.SAVE_RECORD_SUFFIX, 'r') as fp:
+      record = json.load(fp)
+    stat = os.stat(name)
+  except (OSError, ValueError):
+    return False
+
+  return record.get('hash') == digest and record.get('size') == stat.st_size and record.get('mtime_ns') == stat.st_mtime_ns
+
+def recordSave(name, digest):
+  """
+  Record the placement hash a file was saved with, next to it
+
+  Parameters:
+
+  name - (str)
+    The path of the saved board
+  digest - (str)
+    The placement hash, or None to forget the record
+  """
+  recordPath = name + config.SAVE_RECORD_SUFFIX
+  if digest is None:
+    if os.path.exists(recordPath):
+      os.remove(recordPath)
+    return
+
+  stat = os.stat(name)
+  tmpPath = recordPath + ".tmp"
+  with open(tmpPath, 'w') as fp:
+    json.dump({'hash': digest, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}, fp)
+  os.replace(tmpPath, recordPath)
 
 class Klepr():
   """  Main backend class for Klepr application
   """
 
-  def __init__(self, *args, **kwargs):
-    """ Constructor """
-    self.pcb = pcbnew.GetBoard()  
+  # PCBNew objects belong to the thread running KiCAD
+  backgroundSaves = False
+
+  def __init__(self, *args, board=None, **kwargs):
+    """ 
+    Constructor 
+
+    Parameters:
+
+    board - (pcbnew.BOARD)
+      The board to place parts on. Defaults to the board open in PCBNew
+    """
+    if board is None:
+      if pcbnew is None:
+        raise ImportError("PCBNew is not available, use board.HeadlessKlepr outside of KiCAD")
+      board = pcbnew.GetBoard()
+
+    self.pcb = board
     self.isNightly = False   # Fallback to KiCAD stable
+    self.referenceIndex = None   # Built on demand by GetReferenceIndex()
+    self.partsByReference = {}
+    self.pendingSave = None   # The Future of the last PlaceParts() save
+
+    # How MatchPlacement() pairs parts with keys, see config.ASSIGNMENT_MODES
+    self.assignment = "order"
+
+    # Poses of parts before they were moved, for UndoLastRun() and Rollback()
+    self.journal = journal.PositionJournal()
+
+    # Whether the board had unsaved edits before parts were first moved,
+    # see HasUnsavedEdits()
+    self.unsavedEdits = None
 
   ######################################################################
   ######################################################################
@@ -23,6 +208,7 @@ class Klepr():
   ######################################################################
   ######################################################################
 
+  @trace.traced
   def checkKicadFileFormatVersion(self):
       """ Checks version of the running instance of PCBNew """
 
@@ -30,6 +216,7 @@ class Klepr():
       kicadVer = pcbnew.SEXPR_BOARD_FILE_VERSION
       self.isNightly = (kicadVer >= config.KICAD_NIGHTLY_VERSION) and not (kicadVer < config.KICAD_STABLE_VERSION)
 
+  @trace.traced
   def GetParts(self):
     """ 
     Compatibility layer for returning a list of parts from board
@@ -48,6 +235,7 @@ class Klepr():
     else:
       return self.pcb.GetModules()
 
+  @trace.traced
   def FindPartByReference(self, reference):
     """ 
     Compatibility layer for finding a part by reference
@@ -67,6 +255,7 @@ class Klepr():
     else:
       return self.pcb.FindModuleByReference(reference)
 
+  @trace.traced
   def SetPartPosition(self, part, x, y):
     """ 
     Compatibility layer for setting a part's position
@@ -92,6 +281,7 @@ class Klepr():
     else:
       part.SetPosition(pcbnew.wxPointMM(float(x), float(y)))
 
+  @trace.traced
   def SetPartOrientation(self, part, angle):
     """ 
     Compatibility layer for rottating a part in degrees
@@ -117,6 +307,49 @@ class Klepr():
     else:
       part.SetOrientation(angle)
 
+  @trace.traced
+  def GetPartPosition(self, part):
+    """ 
+    Compatibility layer for getting a part's position in millimetres
+
+    PCBNew's Python API for calling components is as such:
+
+    GetPosition() - For KiCAD nightly API
+    GetPosition() - For KiCAD stable API
+
+    Parameters:
+
+    part - (pcbnew.FOOTPRINT) 
+      Part to be checked
+    """
+    if self.isNightly == True:
+      position = part.GetPosition()
+    else:
+      position = part.GetPosition()
+    return pcbnew.ToMM(position.x), pcbnew.ToMM(position.y)
+
+  @trace.traced
+  def GetPartOrientation(self, part):
+    """ 
+    Compatibility layer for getting a part's rotation, in the same units as
+    SetPartOrientation()
+
+    PCBNew's Python API for calling components is as such:
+
+    GetOrientation() - For KiCAD nightly API
+    GetOrientation() - For KiCAD stable API
+
+    Parameters:
+
+    part - (pcbnew.FOOTPRINT) 
+      Part to be checked
+    """
+    if self.isNightly == True:
+      return part.GetOrientation()
+    else:
+      return part.GetOrientation()
+
+  @trace.traced
   def GetPartReference(self, part):
     """ 
     Compatibility layer for getting a part's reference
@@ -137,6 +370,43 @@ class Klepr():
     else:
       return part.GetReference()
 
+  @trace.traced
+  def GetPartOutline(self, part):
+    """
+    Compatibility layer for getting the box around a part's pads, as
+    (min x, min y, max x, max y) in millimetres in footprint coordinates.
+    Returns None for footprints without pads
+
+    PCBNew's Python API for calling components is as such:
+
+    Pads(), GetPos0(), GetSize(), GetOrientation() - For KiCAD nightly API
+    Pads(), GetPos0(), GetSize(), GetOrientation() - For KiCAD stable API
+
+    Parameters:
+
+    part - (pcbnew.FOOTPRINT)
+      Part to be checked
+    """
+    if self.isNightly == True:
+      pads = part.Pads()
+    else:
+      pads = part.Pads()
+
+    outline = None
+    for pad in pads:
+      position = pad.GetPos0()
+      size = pad.GetSize()
+
+      # Pad orientations include the footprint rotation
+      padAngle = (pad.GetOrientation() - part.GetOrientation()) / 10.0
+      outline = spatial.unionBounds(outline, spatial.boxBounds((
+        pcbnew.ToMM(position.x), pcbnew.ToMM(position.y),
+        pcbnew.ToMM(size.x) / 2.0, pcbnew.ToMM(size.y) / 2.0, -padAngle
+      )))
+
+    return outline
+
+  @trace.traced
   def SaveBoard(self, name):
     """
     Compatibility layer for saving the board to a new file
@@ -156,6 +426,83 @@ class Klepr():
     else:
       self.pcb.Save(name)
 
+  @trace.traced
+  def IsBoardModified(self):
+    """
+    Compatibility layer for telling whether the board has edits that are not
+    saved to its file. Boards that cannot tell count as modified
+
+    PCBNew's Python API for calling components is as such:
+
+    IsModified() - For KiCAD nightly API
+    IsModified() - For KiCAD stable API
+    """
+    if self.isNightly == True:
+      isModified = getattr(self.pcb, "IsModified", None)
+      return True if isModified is None else bool(isModified())
+    else:
+      isModified = getattr(self.pcb, "IsModified", None)
+      return True if isModified is None else bool(isModified())
+
+  @trace.traced
+  def PrepareSave(self, name):
+    """
+    Compatibility layer for snapshotting the board before saving it. Returns
+    the placement hash of the snapshot, or None when the board has edits
+    other than placement that are not saved to its file, and a function
+    writing the snapshot
+
+    KiCAD stable saves to a temporary file next to the destination, which is
+    then renamed over it. The placement hash is that of the file the board
+    was last saved to with the poses of its parts, see SavedBoardCopy()
+
+    KiCAD nightly closes KiCAD after Save() returns, so when the board has
+    no unsaved edits, the poses of its parts are written onto a copy of the
+    file it was last saved to without PCBNew instead. Boards with unsaved
+    edits are still saved through PCBNew, so the edits are not lost
+
+    Parameters
+
+    name - (str)
+      The full path and filename of the modified file
+    """
+    copy = None
+    if self.HasUnsavedEdits():
+      print("Warning: the board has edits that are not saved to its file. Saving through PCBNew...")
+    else:
+      copy = self.SavedBoardCopy()
+
+    if self.isNightly == True:
+      if copy is not None:
+        return copy.PrepareSave(name)
+      return None, lambda: self.SaveBoard(name)
+
+    def write():
+      directory, fileName = os.path.split(name)
+      tmpPath = os.path.join(directory, ".tmp_" + fileName)
+      try:
+        self.SaveBoard(tmpPath)
+        os.replace(tmpPath, name)
+      except BaseException:
+        if os.path.exists(tmpPath):
+          os.remove(tmpPath)
+        raise
+
+    digest = copy.PrepareSave(name)[0] if copy is not None else None
+    return digest, write
+
+  @trace.traced
+  def RefreshBoard(self):
+    """
+    Compatibility layer for redrawing the board canvas after parts moved
+
+    PCBNew's Python API for calling components is as such:
+
+    pcbnew.Refresh() - For KiCAD nightly API
+    pcbnew.Refresh() - For KiCAD stable API
+    """
+    pcbnew.Refresh()
+
   ######################################################################
   ######################################################################
   # End of compatibility layer
@@ -170,29 +517,59 @@ class Klepr():
     """ Convert degrees to KiCAD angles. Scaling factor was derived from experimentation """
     return float(angle * config.ANGLE_SCALING_FACTOR_DEG)
 
+  def referenceSortKey(self, reference):
+    """ 
+    Sort key for a part reference by its numeric cluster suffix, so "K_10"
+    sorts after "K_9". References without a numeric suffix sort last
+
+    Parameters:
+
+    reference - (str)
+      The part reference ("K_11", "LED_34", etc.)
+    """
+    return referenceSortKey(reference)
+
+  @trace.traced
+  def GetReferenceIndex(self):
+    """ 
+    Returns a dict of prefix to the list of parts with that prefix, sorted by
+    cluster number. The index is built in a single pass over the board and
+    reused until InvalidateReferenceIndex() is called
+    """
+    if self.referenceIndex is not None:
+      return self.referenceIndex
+
+    index = {}
+    self.partsByReference = {}
+    for part in self.GetParts():
+      reference = self.GetPartReference(part)
+      self.partsByReference[reference] = part
+      index.setdefault(reference.split('_')[0], []).append((self.referenceSortKey(reference), part))
+
+    self.referenceIndex = {}
+    for prefix, parts in index.items():
+      parts.sort(key=lambda entry: entry[0])
+      self.referenceIndex[prefix] = [part for _, part in parts]
+
+    return self.referenceIndex
+
+  def InvalidateReferenceIndex(self):
+    """ Forget the reference index, so the next lookup rescans the board """
+    self.referenceIndex = None
+    self.partsByReference = {}
+
+  @trace.traced
   def  GetPartsByPrefix(self, prefix):
     """ 
-    Returns a list of KiCAD parts with a given prefix 
+    Returns a list of KiCAD parts with a given prefix, sorted by cluster
+    number
 
     Parameters:
 
     prefix - (str)   
       Prefix to be checked
     """
-
-    prefixedParts = []
-    parts = self.GetParts()
-
-    # Look for parts that contain the specified prefix
-    for part in parts:
-      cmpRefPfx = self.GetPartReference(part)
-      cmpRefPfx = cmpRefPfx.split('_')[0]
-      refPfx = prefix.split('_')[0]
-      
-      if (cmpRefPfx == refPfx):
-        prefixedParts.append(part) 
-  
-    return prefixedParts
+    return list(self.GetReferenceIndex().get(prefix.split('_')[0], []))
 
   def MovePartsToLocation(self,x,y):
     """ 
@@ -206,66 +583,540 @@ class Klepr():
     y - (float)     
       The Y coordinate in millimeters
     """
+    if self.unsavedEdits is None:
+      self.unsavedEdits = self.IsBoardModified()
+
     for part in self.GetParts():
       self.SetPartPosition(part, x, y)
 
-  def PlaceParts(self, layout, prefixTable, outputDir):
+  @trace.traced
+  def ComputePlacement(self, layout, prefixTable):
     """
-    Position components based on layout and prefix, and export modified PCB to
-    output directory
+    Compute the final pose of every part on the board without touching it.
+    Returns a list of (part, x, y, angle) tuples in millimetres and KiCAD
+    angles. Parts that no key maps to are sent to the corner with an angle of
+    None, which keeps their current orientation
 
     Parameters:
 
-    layout - (key.Keyboard)
-      List of Key objects containing XY coordinates AND numerical references
+    layout - (key.Keyboard or iterable)
+      List of Key objects containing XY coordinates AND numerical references.
+      Either a key.Keyboard, a key.KeyArray, or a stream of Key objects such
+      as the one returned by key.Keyboard.iterLayout(). The keys are only
+      walked once
 
     prefixTable - (key.PrefixTable)
       List of part prefixes 
+    """
 
-    outputDir - (str)
-      The output directory for resulting PCB
+    return self.MatchPlacement(computePrefixPoses(layout, prefixTable))
+
+  @trace.traced
+  def MatchPlacement(self, prefixPoses):
+    """
+    Match the key poses from computePrefixPoses() to the parts on the board,
+    in the way self.assignment names, see AssignParts(). Returns a list of
+    (part, x, y, angle) tuples like ComputePlacement()
+
+    Parameters:
+
+    prefixPoses - (dict)
+      The poses of every prefix, in key order
+    """
+    if self.assignment not in config.ASSIGNMENT_MODES:
+      raise ValueError("Unknown assignment mode " + repr(self.assignment))
+
+    index = self.GetReferenceIndex()
+
+    # Map coordinate index with part index, and send the parts without a
+    # key out of the way
+    slots = self.AssignParts(index, prefixPoses)
+
+    placement = []
+    for prefix, parts in index.items():
+      keyPoses = prefixPoses.get(prefix, ())
+      for part, slot in zip(parts, slots[prefix]):
+        if slot is not None:
+          x, y, angle = keyPoses[slot]
+          placement.append((part, x, y, angle))
+        else:
+          placement.append((part, config.CORNER_X, config.CORNER_Y, None))
+
+    for prefix, keyPoses in prefixPoses.items():
+      assigned = sum(1 for slot in slots.get(prefix, ()) if slot is not None)
+      for _ in range(len(keyPoses) - assigned):
+        print("Error: no components found with this prefix. Skipping...")
+
+    return placement
+
+  def AssignParts(self, index, prefixPoses):
+    """
+    Returns a dict of prefix to the key index of each of its parts, or None
+    for parts without a key, following self.assignment
+
+    Parameters:
+
+    index - (dict)
+      The parts of every prefix, see GetReferenceIndex()
+
+    prefixPoses - (dict)
+      The poses of every prefix, in key order
     """
+    if self.assignment == "order":
+      return {prefix: self.AssignByOrder(parts, prefixPoses.get(prefix, ())) for prefix, parts in index.items()}
+
+    if self.assignment in ("nearest", "aligned"):
+      align = self.assignment == "aligned"
+      return {prefix: self.AssignByDisplacement(parts, prefixPoses.get(prefix, ()), align) for prefix, parts in index.items()}
 
-    # Start with all parts out of the way
-    self.MovePartsToLocation(config.CORNER_X,config.CORNER_Y)
+    # The anchor prefix is matched by displacement, and every other part
+    # follows the anchor part with the same cluster number
+    anchor = config.ASSIGNMENT_ANCHOR_PREFIX
+    if anchor not in index or anchor not in prefixPoses:
+      anchor = next((prefix for prefix in prefixPoses if prefix in index), None)
+    if anchor is None:
+      return {prefix: self.AssignByOrder(parts, ()) for prefix, parts in index.items()}
+
+    anchorSlots = self.AssignByDisplacement(index[anchor], prefixPoses[anchor])
+    clusterSlots = {}
+    for part, slot in zip(index[anchor], anchorSlots):
+      if slot is not None:
+        clusterSlots[self.GetPartReference(part).partition('_')[2]] = slot
+
+    slots = {anchor: anchorSlots}
+    for prefix, parts in index.items():
+      if prefix != anchor:
+        hints = [clusterSlots.get(self.GetPartReference(part).partition('_')[2]) for part in parts]
+        slots[prefix] = self.AssignByHint(hints, len(prefixPoses.get(prefix, ())))
+
+    return slots
+
+  def AssignByOrder(self, parts, keyPoses):
+    """
+    Returns the key index of each part, giving the nth key to the nth part
+
+    Parameters:
+
+    parts - (list)
+      The parts of one prefix, sorted by cluster number
+    keyPoses - (list)
+      The poses of the prefix, in key order
+    """
 
     # #######################################################################
     #
     # By nature of method key.Keyboard.parseLayout(), the coordinates are
-    # stored in numerical order in which they are created. It also happens
-    # that self.GetPartsByPrefix() returns a list of parts containing the 
-    # prefix in numerical order. This effectively eliminates the need to 
+    # stored in numerical order in which they are created. Likewise,
+    # self.GetPartsByPrefix() returns the parts containing the prefix sorted
+    # by their cluster number. This effectively eliminates the need to 
     # match the index numbers to the part reference, eliminating risk of 
     # off-by-one errors due to indexing issues.
     #
     # #######################################################################
-    for entry in prefixTable.table.values():
-      parts = self.GetPartsByPrefix(entry.prefix)
+    return [num if num < len(keyPoses) else None for num in range(len(parts))]
 
-      for num, coordinate in enumerate(layout.keys):
+  def AssignByHint(self, hints, keyCount):
+    """
+    Returns the key index of each part, taking the hinted key when it is
+    free. The other parts take the keys left, in order
+
+    Parameters:
+
+    hints - (list)
+      The key index hinted for each part, or None
+    keyCount - (int)
+      The number of keys
+    """
+    slots = [None] * len(hints)
+    taken = set()
+    for num, hint in enumerate(hints):
+      if hint is not None and hint < keyCount and hint not in taken:
+        slots[num] = hint
+        taken.add(hint)
+
+    free = iter(slot for slot in range(keyCount) if slot not in taken)
+    for num, slot in enumerate(slots):
+      if slot is None:
+        slots[num] = next(free, None)
+
+    return slots
+
+  @trace.traced
+  def AssignByDisplacement(self, parts, keyPoses, align=False):
+    """
+    Returns the key index of each part, moving the parts the least in total
+    from where they are now, see assign.matchNearest(). Parts parked in the
+    corner or stacked on another part have no useful position, so they take
+    the keys left over, in order
+
+    Parameters:
+
+    parts - (list)
+      The parts of one prefix, sorted by cluster number
+    keyPoses - (list)
+      The poses of the prefix, in key order
+    align - (bool)
+      Line the parts up with the keys before matching, see
+      assign.alignSources()
+    """
+    positions = [tuple(self.GetPartPosition(part)) for part in parts]
+
+    counts = {}
+    for position in positions:
+      counts[position] = counts.get(position, 0) + 1
+
+    placed = []
+    hints = [None] * len(parts)
+    for num, position in enumerate(positions):
+      if position != (config.CORNER_X, config.CORNER_Y) and counts[position] == 1:
+        placed.append(num)
+
+    matched = assign.matchNearest([positions[num] for num in placed], [(x, y) for x, y, _ in keyPoses], align=align)
+    for num, slot in zip(placed, matched):
+      hints[num] = slot
+
+    return self.AssignByHint(hints, len(keyPoses))
+
+  @trace.traced
+  def ApplyPlacement(self, placement, tolerance=config.PLACEMENT_TOLERANCE_MM,
+      angleTolerance=config.PLACEMENT_TOLERANCE_ANGLE):
+    """
+    Write a placement from ComputePlacement() to the board, touching each part
+    at most once. Parts already within tolerance of their pose are skipped.
+    The previous pose of every touched part is recorded in the journal.
+    Returns the number of parts touched and skipped
 
-        # Map coordinate index with part index
-        # This is done to avoid indexing errors with index-to-reference mapping
-        try:
-          part = parts[num]
-        except IndexError as e:
-          print("Error: no components found with this prefix. Skipping...")
+    Parameters:
+
+    placement - (list)
+      The (part, x, y, angle) tuples to apply
+
+    tolerance - (float)
+      The distance in millimetres under which a part counts as in place
+
+    angleTolerance - (float)
+      The rotation in KiCAD angle units under which a part counts as in place
+    """
+    fullTurn = 360.0 * abs(config.ANGLE_SCALING_FACTOR_DEG)
+    touched = 0
+    skipped = 0
+
+    if self.unsavedEdits is None:
+      self.unsavedEdits = self.IsBoardModified()
+
+    for part, x, y, angle in placement:
+      cur_x, cur_y = self.GetPartPosition(part)
+      moved = abs(cur_x - x) > tolerance or abs(cur_y - y) > tolerance
+
+      turned = False
+      cur_angle = None
+      if angle is not None:
+        cur_angle = self.GetPartOrientation(part)
+        delta = (cur_angle - angle) % fullTurn
+        turned = min(delta, fullTurn - delta) > angleTolerance
+
+      if not (moved or turned):
+        skipped += 1
+        continue
+
+      if self.journal is not None:
+        if cur_angle is None:
+          cur_angle = self.GetPartOrientation(part)
+        self.journal.record(self.GetPartReference(part), cur_x, cur_y, cur_angle)
+
+      if moved:
+        self.SetPartPosition(part, x, y)
+      if turned:
+        self.SetPartOrientation(part, angle)
+      touched += 1
+
+    trace.counter("parts touched", touched)
+    trace.counter("parts skipped", skipped)
+    return touched, skipped
+
+  @trace.traced
+  def RollbackTo(self, offset):
+    """
+    Put every part moved after a journal offset back to the pose it had at
+    that offset, in one batch, and forget the journal after it. Returns the
+    number of parts touched and skipped
+
+    Parameters:
+
+    offset - (int)
+      The journal offset to roll back to
+    """
+    poses = self.journal.posesSince(offset)
+    self.GetReferenceIndex()
+
+    placement = []
+    for reference, (x, y, angle) in poses.items():
+      part = self.partsByReference.get(reference)
+      if part is not None:
+        placement.append((part, x, y, angle))
+
+    # Rolling back is not itself recorded
+    recording, self.journal = self.journal, None
+    try:
+      touched, skipped = self.ApplyPlacement(placement)
+    finally:
+      self.journal = recording
+
+    self.journal.truncate(offset)
+    return touched, skipped
+
+  def UndoLastRun(self):
+    """
+    Put the parts moved by the last placement run back where they were.
+    Returns the number of parts touched and skipped, (0, 0) when there is
+    nothing to undo
+    """
+    offset = self.journal.lastRunStart()
+    if offset is None:
+      return 0, 0
+    return self.RollbackTo(offset)
+
+  def Checkpoint(self, name):
+    """
+    Name the current state of the board, for Rollback()
+
+    Parameters:
+
+    name - (str)
+      The name of the checkpoint
+    """
+    self.journal.checkpoint(name)
+
+  def Rollback(self, name):
+    """
+    Put every part moved since a named checkpoint back, see RollbackTo()
+
+    Parameters:
+
+    name - (str)
+      The name given to Checkpoint()
+    """
+    return self.RollbackTo(self.journal.checkpointOffset(name))
+
+  @trace.traced
+  def PlacePrefix(self, layout, entry, prefixTable=None):
+    """
+    Re-place only the parts of one prefix on the board, without saving it.
+    Parts of other prefixes, and parts without a key, are left untouched.
+    The parts are matched to the keys in the way self.assignment names, as
+    Generate does. Returns the number of parts touched and skipped
+
+    Parameters:
+
+    layout - (key.Keyboard or list)
+      The keys, as taken by iterPartPoses()
+
+    entry - (key.Prefix)
+      The prefix to place, with its offsets and angle
+
+    prefixTable - (key.PrefixTable)
+      The rest of the table, for the anchor prefix of the "cluster" mode.
+      entry replaces the row with its id
+    """
+    if self.assignment not in config.ASSIGNMENT_MODES:
+      raise ValueError("Unknown assignment mode " + repr(self.assignment))
+
+    table = key.PrefixTable()
+    if prefixTable is not None:
+      table.table.update(prefixTable.table)
+    table.table[entry.id] = entry
+
+    prefix = entry.prefix.split('_')[0]
+    index = self.GetReferenceIndex()
+
+    # Only the anchor is needed besides the prefix itself
+    needed = {prefix}
+    if self.assignment == "cluster":
+      needed.add(config.ASSIGNMENT_ANCHOR_PREFIX)
+    table.table = {num: row for num, row in table.table.items() if row.prefix.split('_')[0] in needed}
+
+    prefixPoses = computePrefixPoses(layout, table)
+    index = {name: index[name] for name in needed if name in index}
+    slots = self.AssignParts(index, prefixPoses).get(prefix, [])
+
+    keyPoses = prefixPoses.get(prefix, [])
+    placement = [(part,) + keyPoses[slot] for part, slot in zip(index.get(prefix, []), slots) if slot is not None]
+    return self.ApplyPlacement(placement)
+
+  def HasUnsavedEdits(self):
+    """
+    Returns True if the board had edits not saved to its file before its
+    parts were first moved. Moving parts marks the board modified as well,
+    so the state is taken by ApplyPlacement() before the first move
+    """
+    if self.unsavedEdits is None:
+      return self.IsBoardModified()
+    return self.unsavedEdits
+
+  @trace.traced
+  def SavedBoardCopy(self):
+    """
+    Returns a board.HeadlessKlepr of the file the board was last saved to,
+    with every part moved to its pose on this board, or None when the board
+    has no file or has parts the file does not
+    """
+    path = self.pcb.GetFileName()
+    if not path or not os.path.isfile(path):
+      return None
+
+    # Imported here, board.py builds on this module
+    from klepr.kleprtools import board
+    copy = board.HeadlessKlepr(path)
+
+    copies = {}
+    for part in copy.GetParts():
+      copies.setdefault(copy.GetPartReference(part), []).append(part)
+
+    for part in self.GetParts():
+      matches = copies.get(self.GetPartReference(part))
+      if not matches:
+        print("Warning:", self.GetPartReference(part), "is not in", path, "yet. Saving through PCBNew...")
+        return None
+
+      target = matches.pop(0)
+      x, y = self.GetPartPosition(part)
+      copy.SetPartPosition(target, x, y)
+      copy.SetPartOrientation(target, self.GetPartOrientation(part))
+
+    return copy
+
+  @trace.traced
+  def CheckCollisions(self, tolerance=config.COLLISION_TOLERANCE_MM):
+    """
+    Returns the (reference, reference) pairs of parts of the same prefix
+    whose pads overlap, printing a warning when there are any. Parts of
+    different prefixes, such as a LED under its switch, may overlap. Parts
+    without pads and parts parked in the corner are left out
+
+    Parameters:
+
+    tolerance - (float)
+      The depth in millimetres parts may overlap by, see spatial.boxesOverlap()
+    """
+    boxes = []
+    references = []
+    prefixes = []
+
+    for prefix, parts in self.GetReferenceIndex().items():
+      for part in parts:
+        x, y = self.GetPartPosition(part)
+        if (x, y) == (config.CORNER_X, config.CORNER_Y):
+          continue
+
+        outline = self.GetPartOutline(part)
+        if outline is None:
           continue
 
-        # Snap part to coordinate
-        cur_x = self.convertUnit2MM(coordinate.abs_x)
-        cur_y = self.convertUnit2MM(coordinate.abs_y)
-        self.SetPartPosition(part, cur_x, cur_y)
+        boxes.append(spatial.partBox(x, y, self.GetPartOrientation(part), outline))
+        references.append(self.GetPartReference(part))
+        prefixes.append(prefix)
 
-        # Calculate the specified offsets for given prefix
-        off_x = cur_x + float(entry.off_x)
-        off_y = cur_y + float(entry.off_y)
-        off_x, off_y = key.rotateAroundPoint([off_x, off_y], coordinate.angle,[cur_x, cur_y])
-        off_angle = self.angle2KiCADAngle(float(coordinate.angle) + float(entry.angle))
-        
-        # Add offsets to current position
-        self.SetPartPosition(part, off_x, off_y)
-        self.SetPartOrientation(part, off_angle)
+    pairs = spatial.buildGrid(boxes).collisions(tolerance, lambda i, j: prefixes[i] == prefixes[j])
+    collisions = [(references[i], references[j]) for i, j in pairs]
+
+    if collisions:
+      listed = ", ".join("%s/%s" % pair for pair in collisions[:config.COLLISION_REPORT_LIMIT])
+      more = " and %d more" % (len(collisions) - config.COLLISION_REPORT_LIMIT) if len(collisions) > config.COLLISION_REPORT_LIMIT else ""
+      print("Warning: %d pairs of parts overlap: %s%s" % (len(collisions), listed, more))
+
+    return collisions
+
+  def SavePlacement(self, name, executor=None, checkCollisions=True):
+    """
+    Save the board, unless the file was last saved with the same placement.
+    Returns a Future of whether the board was written
+
+    Parameters:
+
+    name - (str)
+      The full path and filename of the modified file
+
+    executor - (concurrent.futures.Executor)
+      Write the board on this executor, when the backend can write from
+      another thread. The board is snapshotted before returning, so parts
+      can be moved again straight away
+
+    checkCollisions - (bool)
+      Warn about overlapping parts first, see CheckCollisions()
+    """
+    if checkCollisions:
+      self.CheckCollisions()
+
+    digest, write = self.PrepareSave(name)
+
+    if digest is not None and isSaved(name, digest):
+      print("Board unchanged since the last save of", name + ". Skipping...")
+      done = Future()
+      done.set_result(False)
+      return done
+
+    def save():
+      write()
+      recordSave(name, digest)
+      return True
+
+    if executor is not None and self.backgroundSaves:
+      return executor.submit(save)
+
+    done = Future()
+    try:
+      done.set_result(save())
+    except Exception as error:
+      done.set_exception(error)
+    return done
+
+  def PlaceParts(self, layout, prefixTable, outputDir, fileName="mod_.kicad_pcb", executor=None):
+    """
+    Position components based on layout and prefix, and export modified PCB to
+    output directory. Returns the number of parts touched and skipped
+
+    Parameters:
+
+    layout - (key.Keyboard or iterable)
+      List of Key objects containing XY coordinates AND numerical references.
+      Either a key.Keyboard, a key.KeyArray, or a stream of Key objects such
+      as the one returned by key.Keyboard.iterLayout(). The keys are only
+      walked once
+
+    prefixTable - (key.PrefixTable)
+      List of part prefixes 
+
+    outputDir - (str)
+      The output directory for resulting PCB
+
+    fileName - (str)
+      The file name of the resulting PCB
+
+    executor - (concurrent.futures.Executor)
+      Write the board on this executor instead of waiting for it, see
+      SavePlacement(). The Future of the save is kept in self.pendingSave
+    """
+
+    # Pick up any parts added or renamed since the last run
+    self.InvalidateReferenceIndex()
+    self.journal.beginRun()
+
+    # A one-shot stream is only walked once, so collect its key boxes while
+    # the placement walks it, and check them afterwards
+    if isinstance(layout, (key.Keyboard, key.KeyArray)):
+      keyBoxes = spatial.iterKeyBoxes(layout)
+    else:
+      keyBoxes = []
+      layout = spatial.recordKeyBoxes(layout, keyBoxes)
+
+    placement = self.ComputePlacement(layout, prefixTable)
+    reportKeyCollisions(keyBoxes)
+    touched, skipped = self.ApplyPlacement(placement)
+    print("Moved", touched, "parts,", skipped, "were already in place")
 
     print("End of component placement. Exporting board to", outputDir)
-    self.SaveBoard(outputDir + "/mod_.kicad_pcb")
+    self.pendingSave = self.SavePlacement(outputDir + "/" + fileName, executor)
+    if executor is None:
+      self.pendingSave.result()
+
+    return touched, skipped
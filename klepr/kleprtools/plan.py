@@ -0,0 +1,271 @@
+""" Placement plans: part poses computed once from a layout, then replayed on any board """
+
+import os
+import json
+import hashlib
+
+from klepr.kleprtools import cache
+from klepr.kleprtools import config
+from klepr.kleprtools import key
+from klepr.kleprtools import pcb
+
+def hashPrefixTable(prefixTable):
+  """
+  Returns a hash of the prefixes and offsets of a prefix table. The random
+  entry ids are left out, so equal tables hash the same
+
+  Parameters:
+
+  prefixTable - (key.PrefixTable)
+    List of part prefixes
+  """
+  entries = sorted(
+    (entry.prefix, float(entry.off_x), float(entry.off_y), float(entry.angle))
+    for entry in prefixTable.table.values()
+  )
+  return hashlib.sha256(json.dumps(entries).encode('utf-8')).hexdigest()
+
+def planKey(layoutHash, prefixTable, clusters=None):
+  """
+  Returns the key of a plan: a hash of the layout, the prefix table, the
+  cluster numbers of the parts, and the plan format version
+
+  Parameters:
+
+  layoutHash - (str)
+    The hash of the KLE file, see cache.hashLayoutFile()
+  prefixTable - (key.PrefixTable)
+    List of part prefixes
+  clusters - (dict)
+    The clusters of every prefix, see netlist.readNetlistPrefixes()
+  """
+  digest = hashlib.sha256()
+  digest.update(b"plan-%d\0" % config.PLAN_FORMAT_VERSION)
+  digest.update(layoutHash.encode('ascii'))
+  digest.update(hashPrefixTable(prefixTable).encode('ascii'))
+  if clusters:
+    digest.update(json.dumps(sorted(clusters.items()), default=str).encode('utf-8'))
+  return digest.hexdigest()
+
+class PlacementPlan():
+  """
+  The target pose of every part placed from a layout, as (reference, x, y,
+  angle) entries in millimetres and KiCAD angles. A plan holds no board
+  objects, so it can be saved and applied to any board backend.
+  """
+
+  def __init__(self, entries=None, digest=""):
+    """
+    Constructor
+
+    Parameters:
+
+    entries - (list)
+      The (reference, x, y, angle) tuples of the plan
+    digest - (str)
+      The key the plan was compiled for, see planKey()
+    """
+    self.entries = entries if entries is not None else []
+    self.key = digest
+
+  def __len__(self):
+    return len(self.entries)
+
+  def save(self, path):
+    """
+    Write the plan to a JSON file, one column per field
+
+    Parameters:
+
+    path - (str)
+      The path of the plan file
+    """
+    references, xs, ys, angles = zip(*self.entries) if self.entries else ((), (), (), ())
+
+    # Parallel jobs may compile the same plan; each writes its own file
+    tmpPath = "%s.%d.tmp" % (path, os.getpid())
+
+    with open(tmpPath, 'w') as fp:
+      json.dump({
+        'version': config.PLAN_FORMAT_VERSION,
+        'key': self.key,
+        'references': references,
+        'x': xs,
+        'y': ys,
+        'angle': angles,
+      }, fp)
+
+    os.replace(tmpPath, path)
+
+  def apply(self, klepr, tolerance=config.PLACEMENT_TOLERANCE_MM,
+      angleTolerance=config.PLACEMENT_TOLERANCE_ANGLE):
+    """
+    Place the parts of a board from the plan. Parts the plan does not mention
+    are sent to the corner, like pcb.Klepr.PlaceParts() does. Returns the
+    number of parts touched and skipped, and the references of the plan that
+    are not on the board
+
+    Parameters:
+
+    klepr - (pcb.Klepr)
+      The board backend to place parts on
+
+    tolerance - (float)
+      The distance in millimetres under which a part counts as in place
+
+    angleTolerance - (float)
+      The rotation in KiCAD angle units under which a part counts as in place
+    """
+    klepr.InvalidateReferenceIndex()
+    if klepr.journal is not None:
+      klepr.journal.beginRun()
+
+    poses = {reference: (x, y, angle) for reference, x, y, angle in self.entries}
+    corner = (config.CORNER_X, config.CORNER_Y, None)
+    found = set()
+
+    placement = []
+    for parts in klepr.GetReferenceIndex().values():
+      for part in parts:
+        reference = klepr.GetPartReference(part)
+        pose = poses.get(reference)
+        if pose is None:
+          pose = corner
+        else:
+          found.add(reference)
+        placement.append((part,) + pose)
+
+    missing = [reference for reference in poses if reference not in found]
+    if missing:
+      print("Error: %d planned components are not on the board. Skipping..." % len(missing))
+
+    touched, skipped = klepr.ApplyPlacement(placement, tolerance, angleTolerance)
+    return touched, skipped, missing
+
+def loadPlan(path):
+  """
+  Returns the PlacementPlan stored in a file
+
+  Parameters:
+
+  path - (str)
+    The path of the plan file
+  """
+  with open(path, 'r') as fp:
+    data = json.load(fp)
+
+  if data.get('version') != config.PLAN_FORMAT_VERSION:
+    raise ValueError("Unsupported plan version in %s" % path)
+
+  entries = list(zip(data['references'], data['x'], data['y'], data['angle']))
+  return PlacementPlan(entries, data.get('key', ""))
+
+def boardClusters(klepr):
+  """
+  Returns a dict of prefix to the cluster numbers of its parts on a board,
+  sorted like pcb.Klepr.GetReferenceIndex(), in the form of
+  netlist.readNetlistPrefixes()
+
+  Parameters:
+
+  klepr - (pcb.Klepr)
+    The board backend to read the references from
+  """
+  clusters = {}
+  for prefix, parts in klepr.GetReferenceIndex().items():
+    numbers = (klepr.GetPartReference(part).partition('_')[2] for part in parts)
+    clusters[prefix] = [int(cluster) if cluster.isdigit() else cluster for cluster in numbers]
+  return clusters
+
+def compilePlan(layout, prefixTable, clusters=None, digest=""):
+  """
+  Compute the plan of a layout without a board. The nth key of the layout
+  places the part with the nth cluster number of each prefix, so the
+  references are taken from the netlist, or from the board with
+  boardClusters(). Without either they are numbered from 0
+
+  Parameters:
+
+  layout - (key.Keyboard or iterable)
+    List of Key objects, as taken by pcb.iterPartPoses()
+
+  prefixTable - (key.PrefixTable)
+    List of part prefixes
+
+  clusters - (dict)
+    The clusters of every prefix, see netlist.readNetlistPrefixes() and
+    boardClusters()
+
+  digest - (str)
+    The key to store with the plan, see planKey()
+  """
+  entries = []
+  for num, entry, x, y, angle in pcb.iterPartPoses(layout, prefixTable):
+    prefix = entry.prefix.split('_')[0]
+
+    if clusters is None:
+      cluster = num
+    elif num < len(clusters.get(prefix, [])):
+      cluster = clusters[prefix][num]
+    else:
+      continue
+
+    entries.append((prefix + '_' + str(cluster), x, y, angle))
+
+  return PlacementPlan(entries, digest)
+
+class PlanStore():
+  """ A directory of compiled plans, keyed by planKey() """
+
+  def __init__(self, planDir=config.PLAN_DIR):
+    """
+    Constructor
+
+    Parameters:
+
+    planDir - (str)
+      The directory the plans are stored in
+    """
+    self.planDir = os.path.expanduser(planDir)
+    os.makedirs(self.planDir, exist_ok=True)
+
+  def planPath(self, digest):
+    """ Returns the path of the plan stored under a key """
+    return os.path.join(self.planDir, digest + ".plan.json")
+
+  def get(self, digest):
+    """ Returns the plan stored under a key, or None """
+    try:
+      return loadPlan(self.planPath(digest))
+    except (OSError, ValueError, KeyError):
+      return None
+
+  def put(self, plan):
+    """ Store a plan under its own key """
+    plan.save(self.planPath(plan.key))
+
+  def planLayout(self, layoutPath, prefixTable, clusters=None):
+    """
+    Returns the plan of a KLE file, compiling and storing it if it is not
+    stored yet
+
+    Parameters:
+
+    layoutPath - (str)
+      The path to the KLE JSON file
+
+    prefixTable - (key.PrefixTable)
+      List of part prefixes
+
+    clusters - (dict)
+      The clusters of every prefix, see netlist.readNetlistPrefixes()
+    """
+    digest = planKey(cache.hashLayoutFile(layoutPath), prefixTable, clusters)
+
+    plan = self.get(digest)
+    if plan is None:
+      keys = key.Keyboard().iterLayout(key.iterLayoutFile(layoutPath))
+      plan = compilePlan(keys, prefixTable, clusters, digest)
+      self.put(plan)
+
+    return plan
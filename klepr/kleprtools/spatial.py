@@ -0,0 +1,293 @@
+""" A uniform grid over rotated rectangles, for overlap checks and point lookups """
+
+import math
+
+from klepr.kleprtools import config
+from klepr.kleprtools import key
+
+# Boxes are (centre x, centre y, half width, half height, angle) tuples in
+# millimetres. The angle is in degrees, clockwise on the board like the KLE
+# rotation, so keys and parts share one convention
+
+def keyBox(abs_x, abs_y, width, height, angle):
+  """
+  Returns the box of a key
+
+  Parameters:
+
+  abs_x, abs_y - (float)
+    The key centre in key units, see key.Key
+  width, height - (float)
+    The key size in key units
+  angle - (float)
+    The key rotation in degrees
+  """
+  return (
+    abs_x * config.UNIT_SPACING_MM, abs_y * config.UNIT_SPACING_MM,
+    width * config.UNIT_SPACING_MM / 2.0, height * config.UNIT_SPACING_MM / 2.0,
+    float(angle)
+  )
+
+def partBox(x, y, orientation, outline):
+  """
+  Returns the box of a part
+
+  Parameters:
+
+  x, y - (float)
+    The part position in millimetres
+  orientation - (float)
+    The part rotation in KiCAD angle units, counterclockwise
+  outline - (tuple)
+    The (min x, min y, max x, max y) of the part in footprint coordinates,
+    see pcb.Klepr.GetPartOutline()
+  """
+  angle = -orientation / 10.0
+  cx = (outline[0] + outline[2]) / 2.0
+  cy = (outline[1] + outline[3]) / 2.0
+
+  cos = math.cos(math.radians(angle))
+  sin = math.sin(math.radians(angle))
+  return (x + cos*cx - sin*cy, y + sin*cx + cos*cy, (outline[2] - outline[0]) / 2.0, (outline[3] - outline[1]) / 2.0, angle)
+
+def boxCorners(box):
+  """ Returns the four corners of a box """
+  cx, cy, hw, hh, angle = box
+  cos = math.cos(math.radians(angle))
+  sin = math.sin(math.radians(angle))
+  return [(cx + cos*dx - sin*dy, cy + sin*dx + cos*dy) for dx, dy in ((-hw, -hh), (hw, -hh), (hw, hh), (-hw, hh))]
+
+def boxBounds(box):
+  """ Returns the axis-aligned (min x, min y, max x, max y) around a box """
+  cx, cy, hw, hh, angle = box
+  cos = abs(math.cos(math.radians(angle)))
+  sin = abs(math.sin(math.radians(angle)))
+  ex = cos*hw + sin*hh
+  ey = sin*hw + cos*hh
+  return (cx - ex, cy - ey, cx + ex, cy + ey)
+
+def unionBounds(a, b):
+  """ Returns the bounds around two (min x, min y, max x, max y) bounds, either of which may be None """
+  if a is None:
+    return b
+  if b is None:
+    return a
+  return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def boxContains(box, x, y):
+  """ Returns True if a point is inside a box or on its edge """
+  cx, cy, hw, hh, angle = box
+  cos = math.cos(math.radians(angle))
+  sin = math.sin(math.radians(angle))
+  dx = x - cx
+  dy = y - cy
+  return abs(cos*dx + sin*dy) <= hw and abs(cos*dy - sin*dx) <= hh
+
+def boxesOverlap(a, b, tolerance=config.COLLISION_TOLERANCE_MM):
+  """
+  Returns True if two boxes overlap by more than a tolerance, testing the
+  four edge directions of the boxes as separating axes
+
+  Parameters:
+
+  a, b - (tuple)
+    The boxes to test
+  tolerance - (float)
+    The depth in millimetres boxes may overlap by, so keys and parts that
+    only touch do not count
+  """
+  dx = b[0] - a[0]
+  dy = b[1] - a[1]
+
+  axes = []
+  for angle in (a[4], b[4]):
+    cos = math.cos(math.radians(angle))
+    sin = math.sin(math.radians(angle))
+    axes.append((cos, sin))
+    axes.append((-sin, cos))
+
+  for ux, uy in axes:
+    radius = 0.0
+    for cx, cy, hw, hh, angle in (a, b):
+      cos = math.cos(math.radians(angle))
+      sin = math.sin(math.radians(angle))
+      radius += hw * abs(cos*ux + sin*uy) + hh * abs(cos*uy - sin*ux)
+
+    if radius - abs(dx*ux + dy*uy) <= tolerance:
+      return False
+
+  return True
+
+class SpatialGrid():
+  """
+  Boxes bucketed into square cells by their bounds. Finding the overlaps of
+  n boxes only compares boxes sharing a cell, and looking up a point only
+  reads one cell
+  """
+
+  def __init__(self, cellSize):
+    """
+    Constructor
+
+    Parameters:
+
+    cellSize - (float)
+      The cell width in millimetres, about the size of a typical box
+    """
+    self.cellSize = float(cellSize)
+    self.boxes = []
+    self.bounds = []
+    self.cells = {}
+
+  def __len__(self):
+    return len(self.boxes)
+
+  def cellOf(self, x, y):
+    """ Returns the cell holding a point """
+    return (math.floor(x / self.cellSize), math.floor(y / self.cellSize))
+
+  def insert(self, box):
+    """ Add a box, returning its index """
+    index = len(self.boxes)
+    bounds = boxBounds(box)
+    self.boxes.append(box)
+    self.bounds.append(bounds)
+
+    size = self.cellSize
+    x0 = math.floor(bounds[0] / size)
+    y0 = math.floor(bounds[1] / size)
+    x1 = math.floor(bounds[2] / size)
+    y1 = math.floor(bounds[3] / size)
+
+    cells = self.cells
+    for cx in range(x0, x1 + 1):
+      for cy in range(y0, y1 + 1):
+        cell = cells.get((cx, cy))
+        if cell is None:
+          cells[(cx, cy)] = [index]
+        else:
+          cell.append(index)
+
+    return index
+
+  def query(self, x, y):
+    """ Returns the indices of the boxes containing a point """
+    return [index for index in self.cells.get(self.cellOf(x, y), ()) if boxContains(self.boxes[index], x, y)]
+
+  def collisions(self, tolerance=config.COLLISION_TOLERANCE_MM, accept=None):
+    """
+    Returns the sorted (i, j) index pairs, i < j, of the boxes that overlap
+
+    Parameters:
+
+    tolerance - (float)
+      See boxesOverlap()
+    accept - (function)
+      Called with (i, j) before testing a pair; pairs it returns False for
+      are never reported
+    """
+    pairs = []
+    for cell, indices in self.cells.items():
+      for num, i in enumerate(indices):
+        a = self.bounds[i]
+        for j in indices[num + 1:]:
+          b = self.bounds[j]
+          if a[0] > b[2] or b[0] > a[2] or a[1] > b[3] or b[1] > a[3]:
+            continue
+
+          # Pairs sharing several cells are only tested in the cell holding
+          # the corner of their bounds' intersection
+          if self.cellOf(max(a[0], b[0]), max(a[1], b[1])) != cell:
+            continue
+
+          pair = (i, j) if i < j else (j, i)
+          if accept is not None and not accept(*pair):
+            continue
+          if boxesOverlap(self.boxes[i], self.boxes[j], tolerance):
+            pairs.append(pair)
+
+    pairs.sort()
+    return pairs
+
+def buildGrid(boxes, cellSize=None):
+  """
+  Returns a SpatialGrid holding boxes, indexed in order
+
+  Parameters:
+
+  boxes - (iterable)
+    The boxes to index
+  cellSize - (float)
+    The cell width in millimetres. Defaults to the median box extent
+  """
+  boxes = list(boxes)
+  if cellSize is None:
+    extents = sorted(2.0 * max(hw, hh) for _, _, hw, hh, _ in boxes)
+    cellSize = max(extents[len(extents) // 2] if extents else 0.0, config.UNIT_SPACING_MM / 4.0)
+
+  grid = SpatialGrid(cellSize)
+  for box in boxes:
+    grid.insert(box)
+  return grid
+
+def iterKeyBoxes(layout):
+  """
+  Yield the box of every key of a layout, in key order
+
+  Parameters:
+
+  layout - (key.Keyboard or iterable)
+    The keys, as taken by pcb.iterPartPoses()
+  """
+  keys = layout.keys if isinstance(layout, key.Keyboard) else layout
+
+  # Read columnar key stores directly, without a view per key
+  if isinstance(keys, key.KeyArray):
+    columns = keys.columns
+    rows = zip(columns['abs_x'], columns['abs_y'], columns['width'], columns['height'], columns['angle'])
+  else:
+    rows = ((k.abs_x, k.abs_y, k.width, k.height, k.angle) for k in keys)
+
+  for abs_x, abs_y, width, height, angle in rows:
+    yield keyBox(abs_x, abs_y, width, height, angle)
+
+def recordKeyBoxes(keys, boxes):
+  """
+  Yield the keys of a stream unchanged, appending the box of every key to
+  boxes, so a one-shot stream can be checked once it was consumed
+
+  Parameters:
+
+  keys - (iterable)
+    The Key objects, such as the stream of key.Keyboard.iterLayout()
+  boxes - (list)
+    Receives the boxes, in key order
+  """
+  for k in keys:
+    boxes.append(keyBox(k.abs_x, k.abs_y, k.width, k.height, k.angle))
+    yield k
+
+def indexKeys(layout):
+  """
+  Returns a SpatialGrid of the keys of a layout, where box i is key i. Use
+  query() on it to find the keys at a point in millimetres
+
+  Parameters:
+
+  layout - (key.Keyboard or iterable)
+    The keys, as taken by pcb.iterPartPoses()
+  """
+  return buildGrid(iterKeyBoxes(layout))
+
+def findKeyCollisions(layout, tolerance=config.COLLISION_TOLERANCE_MM):
+  """
+  Returns the (i, j) index pairs of the keys of a layout that overlap
+
+  Parameters:
+
+  layout - (key.Keyboard or iterable)
+    The keys, as taken by pcb.iterPartPoses()
+  tolerance - (float)
+    See boxesOverlap()
+  """
+  return indexKeys(layout).collisions(tolerance)
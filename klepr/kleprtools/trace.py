@@ -0,0 +1,179 @@
+""" Opt-in tracing of the hot paths, exported as Chrome/Perfetto trace JSON """
+
+import os
+import json
+import time
+import functools
+import threading
+import contextlib
+
+# The tracer recording spans, or None when tracing is off
+activeTracer = None
+
+class Tracer():
+  """
+  Records timed spans and counters in memory. Spans are kept as raw tuples
+  and only turned into trace events when written out, so recording stays
+  cheap on calls made once per part.
+  """
+
+  def __init__(self):
+    self.spans = []
+    self.counters = []
+    self.origin = time.perf_counter_ns()
+    self.pid = os.getpid()
+
+  def record(self, name, category, start, end):
+    """
+    Record a span
+
+    Parameters:
+
+    name - (str)
+      The name of the span, such as "Klepr.SetPartPosition"
+    category - (str)
+      The module the span belongs to
+    start, end - (int)
+      The span bounds, from time.perf_counter_ns()
+    """
+    self.spans.append((name, category, start, end, threading.get_ident()))
+
+  def counter(self, name, value):
+    """ Record the value of a counter at the current time """
+    self.counters.append((name, time.perf_counter_ns(), value))
+
+  @contextlib.contextmanager
+  def span(self, name, category="klepr"):
+    """ Record the duration of a block as a span """
+    start = time.perf_counter_ns()
+    try:
+      yield
+    finally:
+      self.record(name, category, start, time.perf_counter_ns())
+
+  def chromeEvents(self):
+    """ Returns the recorded spans and counters as Chrome trace events """
+    events = []
+    for name, category, start, end, tid in self.spans:
+      events.append({
+        'name': name,
+        'cat': category,
+        'ph': "X",
+        'ts': (start - self.origin) / 1000.0,
+        'dur': (end - start) / 1000.0,
+        'pid': self.pid,
+        'tid': tid,
+      })
+
+    for name, at, value in self.counters:
+      events.append({
+        'name': name,
+        'ph': "C",
+        'ts': (at - self.origin) / 1000.0,
+        'pid': self.pid,
+        'args': {name: value},
+      })
+
+    return events
+
+  def writeChromeTrace(self, path):
+    """
+    Write the trace as Chrome trace JSON, which chrome://tracing and
+    ui.perfetto.dev open directly
+
+    Parameters:
+
+    path - (str)
+      The path of the trace file
+    """
+    with open(path, "w") as fp:
+      json.dump({'traceEvents': self.chromeEvents(), 'displayTimeUnit': "ms"}, fp)
+
+  def summary(self):
+    """
+    Returns (name, calls, total seconds, longest seconds) for every span
+    name, longest total first
+    """
+    totals = {}
+    for name, _, start, end, _ in self.spans:
+      entry = totals.setdefault(name, [0, 0, 0])
+      entry[0] += 1
+      entry[1] += end - start
+      entry[2] = max(entry[2], end - start)
+
+    rows = [(name, calls, total / 1e9, longest / 1e9) for name, (calls, total, longest) in totals.items()]
+    rows.sort(key=lambda row: row[2], reverse=True)
+    return rows
+
+  def printSummary(self, top=15):
+    """ Print a table of the spans with the longest total time """
+    print("%-40s %10s %12s %12s %12s" % ("Span", "Calls", "Total (ms)", "Mean (us)", "Max (ms)"))
+    for name, calls, total, longest in self.summary()[:top]:
+      print("%-40s %10d %12.3f %12.3f %12.3f" % (name, calls, total * 1e3, total / calls * 1e6, longest * 1e3))
+
+def enable():
+  """ Start recording into a new Tracer, and return it """
+  global activeTracer
+  activeTracer = Tracer()
+  return activeTracer
+
+def disable():
+  """ Stop recording, and return the Tracer that was recording """
+  global activeTracer
+  tracer, activeTracer = activeTracer, None
+  return tracer
+
+@contextlib.contextmanager
+def tracing(path=None, top=15):
+  """
+  Trace a block. On exit the trace is written to path when given, and the
+  summary of the top spans is printed
+
+  Parameters:
+
+  path - (str)
+    Where to write the Chrome trace JSON
+  top - (int)
+    The number of spans in the summary
+  """
+  tracer = enable()
+  try:
+    yield tracer
+  finally:
+    disable()
+    if path:
+      tracer.writeChromeTrace(path)
+    tracer.printSummary(top)
+
+def span(name, category="klepr"):
+  """ Record the duration of a block as a span, when tracing is on """
+  if activeTracer is None:
+    return contextlib.nullcontext()
+  return activeTracer.span(name, category)
+
+def counter(name, value):
+  """ Record the value of a counter, when tracing is on """
+  if activeTracer is not None:
+    activeTracer.counter(name, value)
+
+def traced(function):
+  """
+  Decorator recording every call of a function as a span named after its
+  qualified name. When tracing is off it costs one global lookup per call
+  """
+  name = function.__qualname__
+  category = function.__module__.rsplit('.', 1)[-1]
+
+  @functools.wraps(function)
+  def wrapper(*args, **kwargs):
+    tracer = activeTracer
+    if tracer is None:
+      return function(*args, **kwargs)
+
+    start = time.perf_counter_ns()
+    try:
+      return function(*args, **kwargs)
+    finally:
+      tracer.record(name, category, start, time.perf_counter_ns())
+
+  return wrapper
@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+"""
+Synthetic keyboards of any size for testing and benchmarking: a KLE layout,
+a matching netlist and board, and the expected coordinates of every key and
+part, computed independently of the parser
+"""
+
+import os
+import io
+import sys
+import json
+import math
+import random
+import argparse
+import contextlib
+
+from klepr.kleprtools import board
+from klepr.kleprtools import key
+
+# Key sizes as (width, height), weighted towards 1u keys. Sizes with h > w
+# are vertical keys, whose stabilizers are turned
+KEY_SIZES = [(1, 1)] * 12 + [(1.25, 1), (1.5, 1), (1.75, 1), (2, 1), (2.25, 1), (6.25, 1), (1, 2), (1.25, 2), (1.5, 2)]
+
+# Cluster rotations in degrees, weighted towards unrotated clusters
+CLUSTER_ANGLES = [0] * 6 + [10, -10, 15, -15, 22.5, -30, 45, 90, -90]
+
+# Horizontal gaps before a key, and vertical offsets before a row. Negative
+# offsets stack rows upwards, like the thumb clusters of the atreus layout
+KEY_GAPS = [0] * 8 + [0.25, 0.5, 1]
+ROW_OFFSETS = [0] * 4 + [0.25, 0.5, -0.25, -0.5, -0.75, -0.9]
+
+# Prefix table of the synthetic boards; diodes are offset and turned
+SYNTHETIC_PREFIXES = [
+  ("K_", 0.0, 0.0, 0.0),
+  ("D_", -3.81, 5.0, 90.0),
+]
+
+# Footprint of a synthetic part, formatted with its reference
+SYNTHETIC_FOOTPRINT = """  (module Synthetic:Part (layer F.Cu) (tedit 0)
+    (at 300 300)
+    (fp_text reference %s (at 0 -3) (layer F.SilkS)
+      (effects (font (size 1 1) (thickness 0.15)))
+    )
+    (pad 1 thru_hole circle (at -3.81 0) (size 2.2 2.2) (drill 1.5) (layers *.Cu *.Mask))
+    (pad 2 thru_hole circle (at 3.81 0) (size 2.2 2.2) (drill 1.5) (layers *.Cu *.Mask))
+  )
+"""
+
+# Offset of the shifted board matched back to its keys by displacement
+ASSIGNMENT_OFFSET_MM = (300.0, 300.0)
+
+# Units and scaling of the expected part poses, restated here so the oracle
+# does not depend on the code it checks
+SPACING_MM = 19.05
+KICAD_ANGLE_SCALE = -10.0
+
+def generateModel(keyCount, seed=0):
+  """
+  Returns a random keyboard of keyCount keys as a list of clusters. Each
+  cluster is a dict with its rotation "r" around ("rx", "ry"), and "rows" of
+  (row offset, [(gap, width, height), ...]) tuples
+
+  Parameters:
+
+  keyCount - (int)
+    The number of keys
+  seed - (int)
+    The random seed; equal seeds give equal keyboards
+  """
+  rng = random.Random(seed)
+  clusters = []
+  count = 0
+  top = 0.0
+
+  while count < keyCount:
+    cluster = {
+      'r': rng.choice(CLUSTER_ANGLES),
+      'rx': rng.randint(0, 40) / 4.0,
+      'ry': top,
+      'rows': [],
+    }
+
+    for _ in range(rng.randint(1, 6)):
+      if count >= keyCount:
+        break
+
+      keys = []
+      for _ in range(min(rng.randint(1, 14), keyCount - count)):
+        width, height = rng.choice(KEY_SIZES)
+        keys.append((rng.choice(KEY_GAPS), width, height))
+      count += len(keys)
+
+      cluster['rows'].append((rng.choice(ROW_OFFSETS), keys))
+
+    clusters.append(cluster)
+    top += len(cluster['rows']) + 2
+
+  return clusters
+
+def modelToLayout(clusters):
+  """
+  Returns the KLE rows of a keyboard from generateModel(). Every cluster
+  sets its rotation and origin on its first key; later rows only carry
+  their offsets
+
+  Parameters:
+
+  clusters - (list)
+    The clusters returned by generateModel()
+  """
+  rows = []
+  for cluster in clusters:
+    for rowNum, (offset, keys) in enumerate(cluster['rows']):
+      row = []
+      for keyNum, (gap, width, height) in enumerate(keys):
+        descriptor = {}
+        if rowNum == 0 and keyNum == 0:
+          descriptor['r'] = cluster['r']
+          descriptor['rx'] = cluster['rx']
+          descriptor['ry'] = cluster['ry']
+        if keyNum == 0 and offset != 0:
+          descriptor['y'] = offset
+        if gap != 0:
+          descriptor['x'] = gap
+        if width != 1:
+          descriptor['w'] = width
+        if height != 1:
+          descriptor['h'] = height
+
+        if descriptor:
+          row.append(descriptor)
+        row.append("K")
+      rows.append(row)
+
+  return rows
+
+def expectedKeys(clusters):
+  """
+  Returns the expected coordinate map of a keyboard from generateModel(), in
+  the format of key.Keyboard.exportCoordinateMap(). Each key centre is
+  rotated around its cluster origin by the cluster angle
+
+  Parameters:
+
+  clusters - (list)
+    The clusters returned by generateModel()
+  """
+  keys = []
+  for cluster in clusters:
+    angle = cluster['r']
+    cos = math.cos(math.radians(angle))
+    sin = math.sin(math.radians(angle))
+    y = cluster['ry']
+
+    for offset, row in cluster['rows']:
+      y += offset
+      x = cluster['rx']
+
+      for gap, width, height in row:
+        x += gap
+        dx = x + width / 2.0 - cluster['rx']
+        dy = y + height / 2.0 - cluster['ry']
+
+        keys.append({
+          'ref': len(keys),
+          'abs_x': cluster['rx'] + dx*cos - dy*sin,
+          'abs_y': cluster['ry'] + dx*sin + dy*cos,
+          'width': width,
+          'height': height,
+          'angle': angle,
+          'stab_angle': angle + 90 if height > width else angle,
+        })
+        x += width
+
+      y += 1
+
+  return keys
+
+def expectedParts(keys, prefixes=SYNTHETIC_PREFIXES):
+  """
+  Returns a dict of reference to the expected (x, y, angle) of every part in
+  millimetres and KiCAD angles, for the keys returned by expectedKeys()
+
+  Parameters:
+
+  keys - (list)
+    The expected keys
+  prefixes - (list)
+    The (prefix, off_x, off_y, angle) of every prefix
+  """
+  parts = {}
+  for expected in keys:
+    angle = expected['angle']
+    cos = math.cos(math.radians(angle))
+    sin = math.sin(math.radians(angle))
+    x = expected['abs_x'] * SPACING_MM
+    y = expected['abs_y'] * SPACING_MM
+
+    for prefix, off_x, off_y, off_angle in prefixes:
+      parts[prefix + str(expected['ref'])] = (
+        x + off_x*cos - off_y*sin,
+        y + off_x*sin + off_y*cos,
+        (angle + off_angle) * KICAD_ANGLE_SCALE,
+      )
+
+  return parts
+
+def writeSynthetic(outputDir, keyCount, seed=0, prefixes=SYNTHETIC_PREFIXES):
+  """
+  Write a synthetic keyboard to a board directory named synthetic_<keyCount>,
+  and return its path. The directory holds the KLE layout, netlist, board
+  and refTable.json like the example boards, plus expected.json with the
+  expected keys and part poses
+
+  Parameters:
+
+  outputDir - (str)
+    The directory to create the board directory in
+  keyCount - (int)
+    The number of keys
+  seed - (int)
+    The random seed of the layout
+  prefixes - (list)
+    The (prefix, off_x, off_y, angle) of every prefix
+  """
+  name = "synthetic_%d" % keyCount
+  directory = os.path.join(outputDir, name)
+  os.makedirs(directory, exist_ok=True)
+
+  clusters = generateModel(keyCount, seed)
+  keys = expectedKeys(clusters)
+
+  with open(os.path.join(directory, name + ".json"), "w") as fp:
+    fp.write("[")
+    for num, row in enumerate(modelToLayout(clusters)):
+      if num > 0:
+        fp.write(",\n")
+      fp.write(json.dumps(row))
+    fp.write("]")
+
+  with open(os.path.join(directory, name + ".net"), "w") as fp:
+    fp.write("(export (version D)\n  (components\n")
+    for prefix, _, _, _ in prefixes:
+      for num in range(keyCount):
+        fp.write("    (comp (ref %s%d)\n      (value %s))\n" % (prefix, num, prefix.rstrip('_')))
+    fp.write("  ))\n")
+
+  with open(os.path.join(directory, name + ".kicad_pcb"), "w") as fp:
+    fp.write("(kicad_pcb (version 20171130) (host pcbnew synthetic)\n")
+    for prefix, _, _, _ in prefixes:
+      for num in range(keyCount):
+        fp.write(SYNTHETIC_FOOTPRINT % (prefix + str(num)))
+    fp.write(")\n")
+
+  prefixTable = key.PrefixTable()
+  for num, (prefix, off_x, off_y, angle) in enumerate(prefixes):
+    prefixTable.table[num + 1] = key.Prefix(obj_id=num + 1, prefix=prefix, off_x=off_x, off_y=off_y, angle=angle)
+  prefixTable.exportPrefixTable(directory)
+
+  with open(os.path.join(directory, "expected.json"), "w") as fp:
+    json.dump({'seed': seed, 'keys': keys, 'parts': expectedParts(keys, prefixes)}, fp)
+
+  return directory
+
+def compareKeys(expected, keys, tolerance=1e-9):
+  """
+  Returns a list of (ref, field, expected, actual) for every key field that
+  differs from the expected coordinate map
+
+  Parameters:
+
+  expected - (list)
+    The expected keys, as returned by expectedKeys()
+  keys - (iterable)
+    The parsed Key objects, or views of a key.KeyArray
+  tolerance - (float)
+    The largest difference allowed, in units
+  """
+  mismatches = []
+  count = 0
+
+  for want, got in zip(expected, keys):
+    count += 1
+    for field in key.Key.ARRAY_FIELDS:
+      if abs(want[field] - getattr(got, field)) > tolerance:
+        mismatches.append((want['ref'], field, want[field], getattr(got, field)))
+
+  if count != len(expected):
+    mismatches.append((None, "count", len(expected), count))
+
+  return mismatches
+
+def compareParts(expected, klepr, tolerance=1e-5):
+  """
+  Returns a list of (reference, expected pose, actual pose) for every part of
+  a placed board whose pose differs from the expected one
+
+  Parameters:
+
+  expected - (dict)
+    The expected part poses, as returned by expectedParts()
+  klepr - (pcb.Klepr)
+    The placed board
+  tolerance - (float)
+    The largest difference allowed, in millimetres and KiCAD angle units
+  """
+  fullTurn = 360.0 * abs(KICAD_ANGLE_SCALE)
+  mismatches = []
+
+  for part in klepr.GetParts():
+    reference = klepr.GetPartReference(part)
+    want = expected.get(reference)
+    if want is None:
+      continue
+
+    x, y = klepr.GetPartPosition(part)
+    angle = klepr.GetPartOrientation(part)
+    turn = (angle - want[2]) % fullTurn
+
+    if abs(x - want[0]) > tolerance or abs(y - want[1]) > tolerance or min(turn, fullTurn - turn) > tolerance:
+      mismatches.append((reference, tuple(want), (x, y, angle)))
+
+  return mismatches
+
+def checkSynthetic(directory):
+  """
+  Parse and place a synthetic keyboard with every parser path, and return a
+  dict of path name to its mismatches against expected.json
+
+  Parameters:
+
+  directory - (str)
+    A directory written by writeSynthetic()
+  """
+  name = os.path.basename(os.path.normpath(directory))
+  layoutPath = os.path.join(directory, name + ".json")
+
+  with open(os.path.join(directory, "expected.json"), "r") as fp:
+    expected = json.load(fp)
+
+  results = {}
+  with contextlib.redirect_stdout(io.StringIO()):
+    keyboard = key.Keyboard()
+    keyboard.parseLayout(key.iterLayoutFile(layoutPath))
+    results['parse'] = compareKeys(expected['keys'], keyboard.keys)
+
+    compact = key.Keyboard(compact=True)
+    compact.parseLayout(key.iterLayoutFile(layoutPath))
+    results['compact'] = compareKeys(expected['keys'], compact.keys)
+
+    if key.np is not None:
+      batch = key.Keyboard()
+      batch.parseLayout(key.iterLayoutFile(layoutPath), batch=True)
+      results['batch'] = compareKeys(expected['keys'], batch.keys)
+
+    prefixTable = key.PrefixTable()
+    prefixTable.importPrefixTable(os.path.join(directory, "refTable.json"))
+
+    klepr = board.HeadlessKlepr(os.path.join(directory, name + ".kicad_pcb"))
+    klepr.checkKicadFileFormatVersion()
+    klepr.InvalidateReferenceIndex()
+    klepr.ApplyPlacement(klepr.ComputePlacement(keyboard, prefixTable))
+    results['place'] = compareParts(expected['parts'], klepr)
+
+    # Parts shifted as a whole still go back to their own keys once aligned
+    shiftParts(klepr, *ASSIGNMENT_OFFSET_MM)
+    klepr.assignment = "aligned"
+    klepr.ApplyPlacement(klepr.ComputePlacement(keyboard, prefixTable))
+    results['offset'] = compareParts(expected['parts'], klepr)
+
+  return results
+
+def shiftParts(klepr, dx, dy):
+  """
+  Move every part of a board by the same offset, like a board drawn away
+  from the layout origin
+
+  Parameters:
+
+  klepr - (pcb.Klepr)
+    The board to shift
+  dx, dy - (float)
+    The offset in millimetres
+  """
+  placement = []
+  for part in klepr.GetParts():
+    x, y = klepr.GetPartPosition(part)
+    placement.append((part, x + dx, y + dy, None))
+  klepr.ApplyPlacement(placement)
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(
+    prog="python -m klepr.synth",
+    description="Generate synthetic keyboards, and check the parser and placement against them"
+  )
+  parser.add_argument("--sizes", type=int, nargs="*", default=[1000],
+    help="key counts of the keyboards to generate")
+  parser.add_argument("--seed", type=int, default=0,
+    help="random seed of the layouts")
+  parser.add_argument("--output", default="klepr_output/synthetic",
+    help="directory to write the board directories to")
+  parser.add_argument("--check", action="store_true",
+    help="check every parser path, the placement, and the matching of a shifted board against the expected coordinates")
+  args = parser.parse_args(argv)
+
+  failed = False
+  for size in args.sizes:
+    directory = writeSynthetic(args.output, size, args.seed)
+    print("Wrote", directory)
+
+    if not args.check:
+      continue
+
+    for path, mismatches in checkSynthetic(directory).items():
+      print("  %-8s %s" % (path, "ok" if not mismatches else "%d mismatches" % len(mismatches)))
+      for mismatch in mismatches[:10]:
+        print("    ", mismatch)
+      failed = failed or bool(mismatches)
+
+  return 1 if failed else 0
+
+if __name__ == '__main__':
+  sys.exit(main())